@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from web3 import Web3
+
+# Maximum number of agreements kept in memory
+AGREEMENT_CACHE_SIZE = int(os.getenv("AGREEMENT_CACHE_SIZE", 10000))
+
+# Upper bound in seconds on how long a cached is_active flag can be served,
+# even if a status change event is missed
+AGREEMENT_CACHE_TTL = float(os.getenv("AGREEMENT_CACHE_TTL", 60))
+
+# Seconds between scans for AgreementStatusChanged events
+AGREEMENT_CACHE_POLL_INTERVAL = float(os.getenv("AGREEMENT_CACHE_POLL_INTERVAL", 5))
+
+# Largest block range requested from eth_getLogs at once
+AGREEMENT_CACHE_MAX_LOG_RANGE = int(os.getenv("AGREEMENT_CACHE_MAX_LOG_RANGE", 2000))
+
+STATUS_CHANGED_TOPIC = Web3.keccak(text="AgreementStatusChanged(bytes32,bool)").hex()
+
+def _key(contract_address, agreement_id):
+    if isinstance(agreement_id, (bytes, bytearray)):
+        agreement_id = agreement_id.hex()
+    agreement_id = agreement_id.lower()
+    if agreement_id.startswith("0x"):
+        agreement_id = agreement_id[2:]
+    return (contract_address.lower(), agreement_id)
+
+class AgreementCache:
+    """LRU/TTL cache of agreement reads, invalidated by status change events"""
+
+    def __init__(self, max_size=AGREEMENT_CACHE_SIZE, ttl=AGREEMENT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+        self._thread = None
+        self._stop = threading.Event()
+        self._last_block = None
+
+    def get(self, contract_address, agreement_id):
+        """Get a cached agreement, or None if it is missing or expired"""
+        key = _key(contract_address, agreement_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, agreement_data = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(agreement_data)
+
+    def put(self, contract_address, agreement_id, agreement_data):
+        """Cache an agreement read from the chain"""
+        key = _key(contract_address, agreement_id)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, dict(agreement_data))
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, contract_address, agreement_id):
+        """Drop a cached agreement after its status changed"""
+        with self._lock:
+            if self._entries.pop(_key(contract_address, agreement_id), None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        """Drop every cached agreement"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Get hit/miss counters for sizing the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+    def poll_status_changes(self, web3):
+        """Invalidate agreements whose AgreementStatusChanged event was emitted since the last poll"""
+        latest = web3.eth.block_number
+
+        with self._lock:
+            contract_addresses = sorted({key[0] for key in self._entries})
+
+        if self._last_block is None or not contract_addresses:
+            self._last_block = latest
+            return
+
+        from_block = self._last_block + 1
+        while from_block <= latest:
+            to_block = min(from_block + AGREEMENT_CACHE_MAX_LOG_RANGE - 1, latest)
+            logs = web3.eth.get_logs({
+                'fromBlock': from_block,
+                'toBlock': to_block,
+                'address': [Web3.to_checksum_address(address) for address in contract_addresses],
+                'topics': [STATUS_CHANGED_TOPIC],
+            })
+
+            for log in logs:
+                self.invalidate(log['address'], bytes(log['topics'][1]))
+
+            self._last_block = to_block
+            from_block = to_block + 1
+
+    def watch(self, web3, interval=AGREEMENT_CACHE_POLL_INTERVAL):
+        """Start a background thread that polls for status change events"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(web3, interval), name="agreement-cache-watcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background watcher thread"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, web3, interval):
+        while not self._stop.is_set():
+            try:
+                self.poll_status_changes(web3)
+            except Exception:
+                # Missed events are still bounded by the TTL, retry on the next poll
+                pass
+            self._stop.wait(interval)
+
+# Shared cache used by verify_agreement
+agreement_cache = AgreementCache()
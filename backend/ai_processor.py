@@ -1,93 +1,250 @@
 import os
+import time
+from concurrent.futures import FIRST_COMPLETED, as_completed, wait
 import torch
 from PIL import Image
 import numpy as np
 from transformers import AutoProcessor, AutoModelForVision2Seq
 from transformers import AutoTokenizer, AutoModelForSequenceClassification
+from caption_batcher import CaptionBatcher
+from inference_backends import prepare_document_model, INFERENCE_BACKEND
+from result_cache import analysis_cache, content_digest, result_key
+from model_registry import ModelRegistry
+from image_preprocessing import decode_image, is_pdf, iter_pdf_pages
+from field_extraction import extract_fields, extractors
+from generation_profiles import available_profiles, resolve_profile
+from metrics import span
+
+# Models used for document analysis and identity verification
+DOCUMENT_MODEL_NAME = os.getenv("DOCUMENT_MODEL_NAME", "Salesforce/blip-image-captioning-large")
+IDENTITY_MODEL_NAME = os.getenv("IDENTITY_MODEL_NAME", "distilbert-base-uncased")
+
+# Local directory models are loaded from (and downloaded to, unless MODEL_LOCAL_FILES_ONLY is set)
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR") or None
+MODEL_LOCAL_FILES_ONLY = os.getenv("MODEL_LOCAL_FILES_ONLY", "0") == "1"
+
+# PDF pages rasterized ahead of captioning, bounds memory while keeping the batcher busy
+PDF_PAGES_IN_FLIGHT = int(os.getenv("PDF_PAGES_IN_FLIGHT", 16))
+
+# Part of every cached analysis key, so changing the model or backend never serves stale analyses
+DOCUMENT_MODEL_VERSION = f"{DOCUMENT_MODEL_NAME}:{INFERENCE_BACKEND}"
+
+# Generation profiles requests may ask for, the onnx backend cannot run beam search
+GENERATION_PROFILE_NAMES = available_profiles(INFERENCE_BACKEND)
+
+# Models loaded and warmed up before the app accepts traffic, comma separated ("document", "identity")
+PREWARM_MODELS = [name.strip() for name in os.getenv("PREWARM_MODELS", "").split(",") if name.strip()]
+
+# Models loaded by the gunicorn master before it forks workers (see gunicorn.conf.py), comma separated.
+# Workers share their weights copy-on-write instead of each loading a copy.
+PRELOAD_MODELS = [name.strip() for name in os.getenv("PRELOAD_MODELS", "").split(",") if name.strip()]
 
 # Initialize models
-def get_document_analysis_model():
-    """Get the document analysis model"""
-    processor = AutoProcessor.from_pretrained("Salesforce/blip-image-captioning-large")
-    model = AutoModelForVision2Seq.from_pretrained("Salesforce/blip-image-captioning-large")
-    return processor, model
+def get_document_analysis_model(backend=INFERENCE_BACKEND):
+    """Get the document analysis model, running on the given inference backend"""
+    processor = AutoProcessor.from_pretrained(
+        DOCUMENT_MODEL_NAME, cache_dir=MODEL_CACHE_DIR, local_files_only=MODEL_LOCAL_FILES_ONLY
+    )
+    model = AutoModelForVision2Seq.from_pretrained(
+        DOCUMENT_MODEL_NAME, cache_dir=MODEL_CACHE_DIR, local_files_only=MODEL_LOCAL_FILES_ONLY
+    )
+    return processor, prepare_document_model(model, DOCUMENT_MODEL_NAME, backend)
 
 def get_identity_verification_model():
     """Get the identity verification model"""
-    tokenizer = AutoTokenizer.from_pretrained("distilbert-base-uncased")
-    model = AutoModelForSequenceClassification.from_pretrained("distilbert-base-uncased", num_labels=2)
+    tokenizer = AutoTokenizer.from_pretrained(
+        IDENTITY_MODEL_NAME, cache_dir=MODEL_CACHE_DIR, local_files_only=MODEL_LOCAL_FILES_ONLY
+    )
+    model = AutoModelForSequenceClassification.from_pretrained(
+        IDENTITY_MODEL_NAME, num_labels=2, cache_dir=MODEL_CACHE_DIR, local_files_only=MODEL_LOCAL_FILES_ONLY
+    )
     return tokenizer, model
 
-# Lazy loading of models
-document_analysis_model = None
-identity_verification_model = None
-
-def analyze_document(document_file, document_type="lease"):
-    """Analyze a document using AI"""
-    global document_analysis_model
-    
-    # Lazy load the model
-    if document_analysis_model is None:
-        document_analysis_model = get_document_analysis_model()
-    
+def warm_up_document_analysis_model(document_analysis_model):
+    """Run one tiny caption so lazy kernel initialization happens before real traffic"""
     processor, model = document_analysis_model
-    
-    # Read the image
-    image = Image.open(document_file).convert("RGB")
-    
-    # Process the image
-    inputs = processor(images=image, return_tensors="pt")
-    
-    # Generate caption
+    inputs = processor(images=Image.new("RGB", (384, 384), "white"), return_tensors="pt")
     with torch.no_grad():
-        outputs = model.generate(**inputs, max_length=100)
-    
-    # Decode the caption
-    caption = processor.decode(outputs[0], skip_special_tokens=True)
-    
-    # Analyze based on document type
-    if document_type == "lease":
-        analysis = analyze_lease_document(caption)
-    elif document_type == "id":
-        analysis = analyze_id_document(caption)
-    else:
-        analysis = {"caption": caption, "type": "unknown"}
-    
+        model.generate(**inputs, max_length=5)
+
+def warm_up_identity_verification_model(identity_verification_model):
+    """Run one tiny classification so lazy kernel initialization happens before real traffic"""
+    tokenizer, model = identity_verification_model
+    inputs = tokenizer("warm up", return_tensors="pt", return_token_type_ids=False)
+    with torch.no_grad():
+        model(**inputs)
+
+# Declared footprints in MB, used to make room before a model is loaded for the first time
+DOCUMENT_MODEL_ESTIMATED_MB = {"fp32": 1900, "int8": 700, "onnx": 1900}.get(INFERENCE_BACKEND, 1900)
+IDENTITY_MODEL_ESTIMATED_MB = 270
+
+# Models are only loaded when a code path uses them
+model_registry = ModelRegistry()
+model_registry.register("document", get_document_analysis_model, DOCUMENT_MODEL_ESTIMATED_MB,
+                        warm_up_document_analysis_model)
+model_registry.register("identity", get_identity_verification_model, IDENTITY_MODEL_ESTIMATED_MB,
+                        warm_up_identity_verification_model)
+
+_prewarmed = False
+_prewarm_error = None
+
+def get_model(name):
+    """Get a loaded model by name, loading it on first use"""
+    return model_registry.get(name)
+
+def prewarm_models(names=None):
+    """Load models and run one dummy inference on each before serving traffic"""
+    global _prewarmed, _prewarm_error
+    names = PREWARM_MODELS if names is None else names
+    try:
+        for name in names:
+            model_registry.warm_up(name)
+        _prewarmed, _prewarm_error = True, None
+    except Exception as e:
+        _prewarm_error = str(e)
+
+def preload_models(names=None):
+    """Load models without running them, in a process about to fork workers that share the weights"""
+    names = PRELOAD_MODELS if names is None else names
+    for name in names:
+        if name == "document" and INFERENCE_BACKEND == "onnx":
+            # ONNX Runtime sessions hold thread pools that do not survive fork, each worker builds its own
+            continue
+        # No warm-up inference here, OpenMP threads started in the master can hang the forked
+        # workers. Workers warm up with PREWARM_MODELS instead.
+        model_registry.get(name)
+
+def model_status():
+    """Readiness of the models configured for prewarming, and what is resident"""
+    return {
+        # Prewarmed models may be evicted later under the memory budget, that does not make the app unready
+        "ready": _prewarm_error is None and (_prewarmed or not PREWARM_MODELS),
+        "backend": INFERENCE_BACKEND,
+        "prewarm": PREWARM_MODELS,
+        "preload": PRELOAD_MODELS,
+        "registry": model_registry.stats(),
+        "error": _prewarm_error,
+    }
+
+# Concurrent caption requests share one padded generate() call
+caption_batcher = CaptionBatcher(lambda: get_model("document"))
+
+def analyze_caption(caption, document_type="lease"):
+    """Analyze a caption based on the document type"""
+    with span("field_extraction"):
+        if document_type == "lease":
+            return analyze_lease_document(caption)
+        elif document_type == "id":
+            return analyze_id_document(caption)
+        else:
+            return {"caption": caption, "type": "unknown"}
+
+def generation_kwargs(document_type, profile=None):
+    """Profile name and caption generate() arguments for a document type"""
+    name, settings = resolve_profile(document_type, profile, INFERENCE_BACKEND)
+    # Fast profiles stop once every field of the document type has been found
+    if settings.pop("early_exit", False) and document_type in extractors:
+        settings["stop_when"] = extractors[document_type].complete
+    return name, settings
+
+def analyze_pdf_pages(document_file, document_type="lease", generate_kwargs=None):
+    """Caption the pages of a PDF in batches, yielding (page_number, analysis, tokens) as pages finish"""
+    generate_kwargs = generate_kwargs or {"max_length": 100}
+    pending = {}
+    for page_number, image in enumerate(iter_pdf_pages(document_file), start=1):
+        pending[caption_batcher.submit(image, **generate_kwargs)] = page_number
+
+        # Pages are rasterized lazily, only a bounded number waits for the model at once
+        if len(pending) >= PDF_PAGES_IN_FLIGHT:
+            wait(pending, return_when=FIRST_COMPLETED)
+        for future in [future for future in pending if future.done()]:
+            result = future.result()
+            yield pending.pop(future), analyze_caption(result.caption, document_type), result.tokens
+
+    for future in as_completed(list(pending)):
+        result = future.result()
+        yield pending.pop(future), analyze_caption(result.caption, document_type), result.tokens
+
+def merge_page_analyses(page_analyses, document_type="lease"):
+    """Merge per-page analyses, each field is taken from the first page it was found on"""
+    pages = [dict(page_analyses[page_number], page=page_number) for page_number in sorted(page_analyses)]
+    extracted_info = {}
+    for page in pages:
+        for field, value in page.get("extracted_info", {}).items():
+            extracted_info.setdefault(field, value)
+
+    analysis = analyze_caption("\n".join(page["caption"] for page in pages), document_type)
+    if "extracted_info" in analysis:
+        analysis["extracted_info"] = extracted_info
+    analysis["pages"] = pages
     return analysis
 
+def iter_document_analysis(document_file, document_type="lease", profile=None):
+    """Analyze a document or PDF, yielding {"page", "analysis"} as pages finish and the merged {"analysis"} last
+
+    The merged analysis reports the generation profile, tokens generated and seconds spent under "generation".
+    """
+    started = time.perf_counter()
+    profile, generate_kwargs = generation_kwargs(document_type, profile)
+
+    # The same upload analyzed before with the same profile is served from the cache
+    cache_key = result_key(content_digest(document_file), "analysis", document_type, DOCUMENT_MODEL_VERSION, profile)
+    analysis = analysis_cache.get(cache_key)
+    cached = analysis is not None
+    tokens = 0
+
+    if cached:
+        for page in analysis.get("pages", []):
+            yield {"page": page["page"], "analysis": page}
+    elif is_pdf(document_file):
+        page_analyses = {}
+        for page_number, page_analysis, page_tokens in analyze_pdf_pages(document_file, document_type, generate_kwargs):
+            page_analyses[page_number] = page_analysis
+            tokens += page_tokens
+            yield {"page": page_number, "analysis": page_analysis}
+        analysis = merge_page_analyses(page_analyses, document_type)
+    else:
+        # Read the image, decoded at bounded size
+        with span("image_decode"):
+            image = decode_image(document_file)
+
+        # Generate caption, the model is lazy loaded by the batcher. Includes the wait for the batch.
+        with span("caption"):
+            result = caption_batcher.caption(image, **generate_kwargs)
+        tokens = result.tokens
+
+        # Analyze based on document type
+        analysis = analyze_caption(result.caption, document_type)
+
+    if not cached:
+        analysis_cache.put(cache_key, analysis)
+
+    analysis["generation"] = {
+        "profile": profile,
+        "tokens": tokens,
+        "seconds": round(time.perf_counter() - started, 4),
+        "cached": cached,
+    }
+    yield {"analysis": analysis}
+
+def analyze_document(document_file, document_type="lease", profile=None):
+    """Analyze a document using AI"""
+    for result in iter_document_analysis(document_file, document_type, profile):
+        pass
+    return result["analysis"]
+
 def analyze_lease_document(caption):
     """Analyze a lease document based on its caption"""
     # This is a simplified analysis - in a real application, you would use
     # more sophisticated NLP techniques to extract specific information
     
+    # Fields and their keywords are declared in field_extraction.EXTRACTION_SPECS
     analysis = {
         "caption": caption,
         "type": "lease",
-        "extracted_info": {}
+        "extracted_info": extract_fields("lease", caption)
     }
     
-    # Extract property address
-    if "address" in caption.lower():
-        # Simple extraction - in reality, you'd use NER or regex
-        address_idx = caption.lower().find("address")
-        if address_idx != -1:
-            address_text = caption[address_idx:address_idx+100]
-            analysis["extracted_info"]["property_address"] = address_text
-    
-    # Extract rent amount
-    if "rent" in caption.lower():
-        rent_idx = caption.lower().find("rent")
-        if rent_idx != -1:
-            rent_text = caption[rent_idx:rent_idx+50]
-            analysis["extracted_info"]["rent_amount"] = rent_text
-    
-    # Extract lease term
-    if "term" in caption.lower() or "duration" in caption.lower():
-        term_idx = caption.lower().find("term") if "term" in caption.lower() else caption.lower().find("duration")
-        if term_idx != -1:
-            term_text = caption[term_idx:term_idx+50]
-            analysis["extracted_info"]["lease_term"] = term_text
-    
     return analysis
 
 def analyze_id_document(caption):
@@ -95,44 +252,15 @@ def analyze_id_document(caption):
     analysis = {
         "caption": caption,
         "type": "id",
-        "extracted_info": {}
+        "extracted_info": extract_fields("id", caption)
     }
     
-    # Extract name
-    if "name" in caption.lower():
-        name_idx = caption.lower().find("name")
-        if name_idx != -1:
-            name_text = caption[name_idx:name_idx+50]
-            analysis["extracted_info"]["name"] = name_text
-    
-    # Extract ID number
-    if "number" in caption.lower() or "id" in caption.lower():
-        id_idx = caption.lower().find("number") if "number" in caption.lower() else caption.lower().find("id")
-        if id_idx != -1:
-            id_text = caption[id_idx:id_idx+30]
-            analysis["extracted_info"]["id_number"] = id_text
-    
-    # Extract date of birth
-    if "birth" in caption.lower() or "dob" in caption.lower():
-        dob_idx = caption.lower().find("birth") if "birth" in caption.lower() else caption.lower().find("dob")
-        if dob_idx != -1:
-            dob_text = caption[dob_idx:dob_idx+30]
-            analysis["extracted_info"]["date_of_birth"] = dob_text
-    
     return analysis
 
-def verify_identity(id_document, id_type="passport"):
+def verify_identity(id_document, id_type="passport", profile=None):
     """Verify an identity document using AI"""
-    global identity_verification_model
-    
-    # Lazy load the model
-    if identity_verification_model is None:
-        identity_verification_model = get_identity_verification_model()
-    
-    tokenizer, model = identity_verification_model
-    
     # First, analyze the document to extract text
-    analysis = analyze_document(id_document, document_type="id")
+    analysis = analyze_document(id_document, document_type="id", profile=profile)
     
     # In a real application, you would:
     # 1. Extract facial biometrics from the ID
@@ -146,7 +274,8 @@ def verify_identity(id_document, id_type="passport"):
         "confidence": 0.95,  # Simulated confidence score
         "extracted_info": analysis["extracted_info"],
         "id_type": id_type,
-        "verification_method": "AI document analysis"
+        "verification_method": "AI document analysis",
+        "generation": analysis["generation"]
     }
     
     return verification_result 
\ No newline at end of file
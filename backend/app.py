@@ -1,27 +1,159 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 from flask_cors import CORS
 import os
 from dotenv import load_dotenv
-import json
-from web3 import Web3
-from blockchain import deploy_contract, get_contract, create_agreement, verify_agreement
-from ai_processor import analyze_document, verify_identity
-from qr_handler import generate_qr_code, scan_qr_code
 
-# Load environment variables
+# Load environment variables first, the modules imported below read their settings at import time
 load_dotenv()
 
+import json
+import time
+from eth_account import Account
+from blockchain import ChainIdMismatchError, deploy_contract, get_contract, get_chain_id, create_agreements, create_agreements_batched, submit_agreement, wait_for_agreement, verify_agreement, verify_agreements
+from ai_processor import analyze_document, iter_document_analysis, verify_identity, prewarm_models, model_status, caption_batcher, PREWARM_MODELS, GENERATION_PROFILE_NAMES
+from qr_handler import generate_qr_code, scan_qr_code, scan_qr_batch, start_scan_pool, qr_code_cache, QR_FORMATS
+from receipt_tracker import ReceiptTracker
+from agreement_cache import agreement_cache
+from event_indexer import EventIndexer, INDEXER_CONTRACTS
+from fee_oracle import fee_oracle
+from rpc_client import RPCClient, RPC_URLS
+from result_cache import HashingRequest, analysis_cache
+from image_preprocessing import ImageTooLargeError, UnreadableImageError
+from metrics import metrics
+from qr_payload import signing_enabled, encode_agreement_payload, is_signed_payload, verify_agreement_payload, InvalidPayloadError, PayloadTooLargeError
+
 app = Flask(__name__)
+# Uploads are hashed while they stream in, for the analysis cache
+app.request_class = HashingRequest
 CORS(app)
 
-# Initialize Web3 connection
+# Fork the QR scanning processes while this process has no threads yet
+start_scan_pool()
+
+# Load and warm up the configured models before accepting traffic
+if PREWARM_MODELS:
+    prewarm_models()
+
+# Initialize Web3 connection once, with pooled sessions, failover and background health checks
 INFURA_URL = os.getenv("INFURA_URL", "https://sepolia.infura.io/v3/your-infura-key")
-web3 = Web3(Web3.HTTPProvider(INFURA_URL))
+rpc_client = RPCClient(RPC_URLS or [INFURA_URL])
+rpc_client.start()
+web3 = rpc_client.web3
+
+# Refuse to start against a node serving another chain than CHAIN_ID
+try:
+    get_chain_id(web3)
+except ChainIdMismatchError:
+    raise
+except Exception:
+    # No node reachable yet, the chain ID is checked on first use instead
+    pass
+
+# Largest number of agreements accepted by a single batch request
+BATCH_MAX_AGREEMENTS = int(os.getenv("BATCH_MAX_AGREEMENTS", 500))
+
+# Largest number of agreements accepted by a single verification request
+VERIFY_MAX_AGREEMENTS = int(os.getenv("VERIFY_MAX_AGREEMENTS", 1000))
+
+# Largest number of images accepted by a single batch scan request
+SCAN_BATCH_MAX_IMAGES = int(os.getenv("SCAN_BATCH_MAX_IMAGES", 200))
+
+def generate_agreement_qr_code(contract_address, agreement_id, landlord_address, tenant_address,
+                               property_details=None, rent_amount=None, duration=None, block_number=None):
+    """Generate the QR code that identifies an agreement, returns its URL and, if written to disk, its path"""
+    qr_data = None
+    if signing_enabled() and None not in (property_details, rent_amount, duration):
+        # Signed payloads carry the whole agreement, so scans can be verified without the chain
+        try:
+            qr_data = encode_agreement_payload(
+                get_chain_id(web3),
+                contract_address,
+                agreement_id,
+                landlord_address,
+                tenant_address,
+                property_details,
+                rent_amount,
+                duration,
+                block_number
+            )
+        except PayloadTooLargeError:
+            # The agreement is already on chain, long property details get a QR code verified there instead
+            pass
+    if qr_data is None:
+        qr_data = json.dumps({
+            "contract_address": contract_address,
+            "agreement_id": agreement_id,
+            "landlord": landlord_address,
+            "tenant": tenant_address
+        })
+    qr_hash, qr_code_path = generate_qr_code(qr_data)
+    return {"qr_code_url": f"/api/qr/{qr_hash}", "qr_code_path": qr_code_path}
+
+def on_agreement_confirmed(record):
+    """Generate the QR code once a non-blocking submission has been mined"""
+    metadata = record['metadata']
+    qr_code = generate_agreement_qr_code(
+        record['contract_address'],
+        record['agreement_id'],
+        metadata.get('landlord'),
+        metadata.get('tenant'),
+        metadata.get('property_details'),
+        metadata.get('rent_amount'),
+        metadata.get('duration'),
+        record['block_number']
+    )
+    receipt_tracker.annotate(record['transaction_hash'], **qr_code)
+
+# Keep fees fresh in the background so transactions never wait on a gas price lookup
+fee_oracle.start(web3)
+
+# Track receipts of agreements submitted without waiting for them to be mined. Block scans read one
+# node's view of the chain, and each app process only polls the submissions it has claimed in the
+# shared database, so listeners run once per submission.
+receipt_tracker = ReceiptTracker(rpc_client.pinned_web3)
+receipt_tracker.add_listener(on_agreement_confirmed)
+receipt_tracker.start()
+
+# Drop cached agreement reads as soon as their status changes on chain
+agreement_cache.watch(web3)
+
+# Index agreement events locally so agreements can be listed without scanning the chain.
+# Contracts without a start block are registered once a node answers, so startup does not need one.
+event_indexer = EventIndexer(web3)
+for indexed_contract, start_block in INDEXER_CONTRACTS.items():
+    event_indexer.add_contract(indexed_contract, start_block)
+event_indexer.start()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    # Streamed responses are recorded once their first chunk is ready, not when they finish
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        metrics.observe_request(endpoint, request.method, response.status_code, time.perf_counter() - started)
+    return response
+
+@app.route('/api/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Stage latencies and request metrics in the Prometheus text format"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({"status": "healthy", "blockchain_connected": web3.is_connected()})
+    # Served from the background health monitor, probes never touch the node
+    rpc_health = rpc_client.health()
+    models = model_status()
+    return jsonify({
+        "status": "healthy" if models['ready'] else "starting",
+        "blockchain_connected": rpc_health['connected'],
+        "rpc": rpc_health,
+        "models": models
+    }), 200 if models['ready'] else 503
 
 @app.route('/api/deploy-contract', methods=['POST'])
 def deploy_smart_contract():
@@ -29,9 +161,21 @@ def deploy_smart_contract():
     try:
         data = request.json
         private_key = data.get('private_key')
+        # The variant with createAgreements, for batch creation in a single transaction
+        batch = data.get('batch', False)
+        
+        contract_address = deploy_contract(web3, private_key, batch=batch)
+        
+        response = {"success": True, "contract_address": contract_address}
+        
+        # Index the new contract from its deployment onwards
+        try:
+            event_indexer.add_contract(contract_address)
+        except Exception as e:
+            # The contract is deployed either way, the client must still learn its address
+            response["indexer_error"] = str(e)
         
-        contract_address = deploy_contract(web3, private_key)
-        return jsonify({"success": True, "contract_address": contract_address})
+        return jsonify(response)
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -47,9 +191,43 @@ def create_rent_agreement():
         rent_amount = data.get('rent_amount')
         duration = data.get('duration')
         private_key = data.get('private_key')
+        wait = data.get('wait', True)
+        
+        if not wait:
+            # Return as soon as the transaction is broadcast, the receipt
+            # tracker picks up the agreement ID once it is mined
+            tx_hash = submit_agreement(
+                web3,
+                contract_address,
+                landlord_address,
+                tenant_address,
+                property_details,
+                rent_amount,
+                duration,
+                private_key
+            )
+            tx_hash = receipt_tracker.track(
+                tx_hash,
+                contract_address,
+                sender=Account.from_key(private_key).address,
+                metadata={
+                    "landlord": landlord_address,
+                    "tenant": tenant_address,
+                    "property_details": property_details,
+                    "rent_amount": rent_amount,
+                    "duration": duration
+                }
+            )
+            
+            return jsonify({
+                "success": True,
+                "status": "pending",
+                "transaction_hash": tx_hash,
+                "status_url": f"/api/agreement-status/{tx_hash}"
+            }), 202
         
         # Create agreement on blockchain
-        tx_hash = create_agreement(
+        tx_hash = submit_agreement(
             web3, 
             contract_address, 
             landlord_address, 
@@ -59,24 +237,125 @@ def create_rent_agreement():
             duration, 
             private_key
         )
+        agreement_id, block_number = wait_for_agreement(web3, contract_address, tx_hash)
         
         # Generate QR code for the agreement
-        qr_data = {
-            "contract_address": contract_address,
-            "agreement_id": tx_hash,
-            "landlord": landlord_address,
-            "tenant": tenant_address
-        }
-        qr_code_path = generate_qr_code(json.dumps(qr_data))
+        qr_code = generate_agreement_qr_code(
+            contract_address,
+            agreement_id,
+            landlord_address,
+            tenant_address,
+            property_details,
+            rent_amount,
+            duration,
+            block_number
+        )
         
         return jsonify({
             "success": True, 
-            "transaction_hash": tx_hash,
-            "qr_code_path": qr_code_path
+            "transaction_hash": tx_hash.hex(),
+            "agreement_id": agreement_id,
+            "block_number": block_number,
+            **qr_code
+        })
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/api/create-agreements/batch', methods=['POST'])
+def create_rent_agreements_batch():
+    """Create many rent agreements on the blockchain in one request"""
+    try:
+        data = request.json
+        contract_address = data.get('contract_address')
+        private_key = data.get('private_key')
+        agreements = data.get('agreements') or []
+        batched = data.get('batched', False)
+        
+        if not agreements:
+            return jsonify({"success": False, "error": "No agreements provided"}), 400
+        
+        if len(agreements) > BATCH_MAX_AGREEMENTS:
+            return jsonify({
+                "success": False,
+                "error": f"At most {BATCH_MAX_AGREEMENTS} agreements can be created per batch"
+            }), 400
+        
+        if batched:
+            # Few createAgreements transactions sized to the block gas limit, needs a contract deployed with batch
+            results = create_agreements_batched(web3, contract_address, agreements, private_key)
+        else:
+            # Sign and send everything up front, then wait for all receipts together
+            results = create_agreements(web3, contract_address, agreements, private_key)
+        
+        # Generate QR codes for the agreements that were created
+        for result in results:
+            if result['success']:
+                item = agreements[result['index']]
+                result.update(generate_agreement_qr_code(
+                    contract_address,
+                    result['agreement_id'],
+                    item['landlord_address'],
+                    item['tenant_address'],
+                    item['property_details'],
+                    item['rent_amount'],
+                    item['duration'],
+                    result['block_number']
+                ))
+        
+        failed = sum(1 for result in results if not result['success'])
+        
+        return jsonify({
+            "success": failed == 0,
+            "created": len(results) - failed,
+            "failed": failed,
+            "results": results
+        })
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/api/agreement-status/<tx_hash>', methods=['GET'])
+def agreement_status(tx_hash):
+    """Get the status of an agreement submitted without waiting"""
+    try:
+        record = receipt_tracker.get_status(tx_hash)
+        
+        if record is None:
+            return jsonify({"success": False, "error": "Unknown transaction"}), 404
+        
+        return jsonify({
+            "success": True,
+            "transaction_hash": record['transaction_hash'],
+            "status": record['status'],
+            "agreement_id": record['agreement_id'],
+            "block_number": record['block_number'],
+            "error": record['error'],
+            "qr_code_url": record['metadata'].get('qr_code_url'),
+            "qr_code_path": record['metadata'].get('qr_code_path')
         })
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route('/api/qr/<qr_hash>', methods=['GET'])
+def get_qr_code(qr_hash):
+    """Serve a rendered QR code by its content address"""
+    fmt = request.args.get('format', 'png')
+    if fmt not in QR_FORMATS:
+        return jsonify({"success": False, "error": f"Unknown format, expected one of {', '.join(QR_FORMATS)}"}), 400
+    
+    # The content behind a hash never changes, so clients and proxies may cache it forever
+    etag = f"{qr_hash}.{fmt}"
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+    
+    image = qr_code_cache.get(qr_hash, fmt)
+    if image is None:
+        return jsonify({"success": False, "error": "Unknown QR code"}), 404
+    
+    return Response(image, mimetype=QR_FORMATS[fmt], headers={
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "ETag": f'"{etag}"'
+    })
+
 @app.route('/api/verify-agreement', methods=['POST'])
 def verify_rent_agreement():
     """Verify a rent agreement using QR code"""
@@ -89,21 +368,154 @@ def verify_rent_agreement():
         
         if not qr_data:
             return jsonify({"success": False, "error": "Invalid QR code"}), 400
-            
-        qr_json = json.loads(qr_data)
-        contract_address = qr_json.get('contract_address')
-        agreement_id = qr_json.get('agreement_id')
+        
+        # Only a freshness check of signed QR codes needs the chain, e.g. to see a terminated agreement
+        fresh = request.form.get('fresh', 'false').lower() == 'true'
+        
+        if is_signed_payload(qr_data):
+            payload = verify_agreement_payload(qr_data, get_chain_id(web3))
+            if not fresh:
+                return jsonify({
+                    "success": True,
+                    "verified_by": "signature",
+                    "issuer": payload['issuer'],
+                    "block_number": payload['block_number'],
+                    "agreement_data": payload['agreement_data']
+                })
+            contract_address = payload['contract_address']
+            agreement_id = payload['agreement_id']
+        else:
+            qr_json = json.loads(qr_data)
+            contract_address = qr_json.get('contract_address')
+            agreement_id = qr_json.get('agreement_id')
         
         # Verify agreement on blockchain
         agreement_data = verify_agreement(web3, contract_address, agreement_id)
         
         return jsonify({
             "success": True,
+            "verified_by": "chain",
             "agreement_data": agreement_data
         })
+    except (InvalidPayloadError, UnreadableImageError) as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except ImageTooLargeError as e:
+        return jsonify({"success": False, "error": str(e)}), 413
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/api/scan-qr/batch', methods=['POST'])
+def scan_qr_codes_batch():
+    """Scan many QR code images in one request"""
+    try:
+        qr_images = request.files.getlist('qr_images')
+        
+        if not qr_images:
+            return jsonify({"success": False, "error": "No QR code images provided"}), 400
+        
+        if len(qr_images) > SCAN_BATCH_MAX_IMAGES:
+            return jsonify({
+                "success": False,
+                "error": f"At most {SCAN_BATCH_MAX_IMAGES} images can be scanned per batch"
+            }), 400
+        
+        # Images are decoded and scanned in parallel across the scan process pool
+        results = scan_qr_batch([qr_image.read() for qr_image in qr_images])
+        
+        return jsonify({
+            "success": True,
+            "results": [
+                dict(result, index=index, filename=qr_image.filename)
+                for index, (qr_image, result) in enumerate(zip(qr_images, results))
+            ]
+        })
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/api/verify-agreements', methods=['POST'])
+def verify_rent_agreements():
+    """Verify many rent agreements in one request"""
+    try:
+        data = request.json
+        contract_address = data.get('contract_address')
+        agreement_ids = data.get('agreement_ids') or []
+        
+        if not agreement_ids:
+            return jsonify({"success": False, "error": "No agreement IDs provided"}), 400
+        
+        if len(agreement_ids) > VERIFY_MAX_AGREEMENTS:
+            return jsonify({
+                "success": False,
+                "error": f"At most {VERIFY_MAX_AGREEMENTS} agreements can be verified per request"
+            }), 400
+        
+        # All getAgreement calls go out as one JSON-RPC batch
+        results = verify_agreements(web3, contract_address, agreement_ids)
+        failed = sum(1 for result in results if not result['success'])
+        
+        return jsonify({
+            "success": True,
+            "verified": len(results) - failed,
+            "failed": failed,
+            "results": results
+        })
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route('/api/agreement-cache/stats', methods=['GET'])
+def agreement_cache_stats():
+    """Get hit/miss counters of the agreement read cache"""
+    return jsonify({"success": True, "cache": agreement_cache.stats()})
+
+@app.route('/api/agreements', methods=['GET'])
+def list_agreements():
+    """List agreements from the local event index"""
+    try:
+        status = request.args.get('status')
+        if status not in (None, 'active', 'inactive'):
+            return jsonify({"success": False, "error": "status must be 'active' or 'inactive'"}), 400
+        
+        result = event_indexer.query_agreements(
+            landlord=request.args.get('landlord'),
+            tenant=request.args.get('tenant'),
+            status=None if status is None else status == 'active',
+            contract_address=request.args.get('contract_address'),
+            created_from=request.args.get('from', type=int),
+            created_to=request.args.get('to', type=int),
+            limit=request.args.get('limit', 50, type=int),
+            offset=request.args.get('offset', 0, type=int)
+        )
+        
+        return jsonify({"success": True, **result})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/api/indexer/status', methods=['GET'])
+def indexer_status():
+    """Get the progress of the local event index"""
+    return jsonify({"success": True, "indexer": event_indexer.status()})
+
+@app.route('/api/inference/stats', methods=['GET'])
+def inference_stats():
+    """Get queue depth and batch size histograms of the caption batcher"""
+    return jsonify({"success": True, "captions": caption_batcher.stats()})
+
+@app.route('/api/analysis-cache/stats', methods=['GET'])
+def analysis_cache_stats():
+    """Get hit/miss counters of the document analysis cache"""
+    return jsonify({"success": True, "cache": analysis_cache.stats()})
+
+def stream_document_analysis(document, document_type, profile=None):
+    """NDJSON lines of one document analysis, a line per page and the merged analysis last"""
+    try:
+        for result in iter_document_analysis(document, document_type, profile):
+            if "page" in result:
+                yield json.dumps({"page": result["page"], "analysis": result["analysis"]}) + "\n"
+            else:
+                yield json.dumps({"success": True, "analysis": result["analysis"]}) + "\n"
+    except Exception as e:
+        yield json.dumps({"success": False, "error": str(e)}) + "\n"
+
 @app.route('/api/analyze-document', methods=['POST'])
 def analyze_document_endpoint():
     """Analyze a document using AI"""
@@ -113,13 +525,24 @@ def analyze_document_endpoint():
             
         document = request.files['document']
         document_type = request.form.get('document_type', 'lease')
+        profile = request.form.get('profile')
         
-        analysis_result = analyze_document(document, document_type)
+        if profile is not None and profile not in GENERATION_PROFILE_NAMES:
+            return jsonify({"success": False, "error": f"Unsupported profile, expected one of {', '.join(GENERATION_PROFILE_NAMES)}"}), 400
+        
+        # Stream per-page results of PDFs as newline-delimited JSON as pages finish
+        if request.form.get('stream', 'false').lower() == 'true':
+            return Response(stream_with_context(stream_document_analysis(document, document_type, profile)),
+                            mimetype='application/x-ndjson')
+        
+        analysis_result = analyze_document(document, document_type, profile)
         
         return jsonify({
             "success": True,
             "analysis": analysis_result
         })
+    except ImageTooLargeError as e:
+        return jsonify({"success": False, "error": str(e)}), 413
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -132,13 +555,19 @@ def verify_identity_endpoint():
             
         id_document = request.files['id_document']
         id_type = request.form.get('id_type', 'passport')
+        profile = request.form.get('profile')
+        
+        if profile is not None and profile not in GENERATION_PROFILE_NAMES:
+            return jsonify({"success": False, "error": f"Unsupported profile, expected one of {', '.join(GENERATION_PROFILE_NAMES)}"}), 400
         
-        verification_result = verify_identity(id_document, id_type)
+        verification_result = verify_identity(id_document, id_type, profile)
         
         return jsonify({
             "success": True,
             "verification": verification_result
         })
+    except ImageTooLargeError as e:
+        return jsonify({"success": False, "error": str(e)}), 413
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -0,0 +1,307 @@
+import asyncio
+import functools
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_to_bytes
+from aiohttp import web
+from app import app as flask_app, rpc_client, VERIFY_MAX_AGREEMENTS
+from blockchain import async_verify_agreement, async_verify_agreements, get_chain_id
+from image_preprocessing import ImageTooLargeError, UnreadableImageError
+from metrics import metrics
+from qr_handler import scan_qr_code
+from qr_payload import is_signed_payload, verify_agreement_payload, InvalidPayloadError
+
+# Threads running model inference, QR decoding and the synchronous endpoints
+ASYNC_EXECUTOR_WORKERS = int(os.getenv("ASYNC_EXECUTOR_WORKERS", 32))
+
+# Largest request body accepted, uploads are read into memory before they are handled
+ASYNC_MAX_BODY_MB = float(os.getenv("ASYNC_MAX_BODY_MB", 64))
+
+# Requests handled at once per route. A route queues as many again as its limit and answers 503 beyond that.
+ROUTE_CONCURRENCY = {
+    "/api/verify-agreement": 512,
+    "/api/verify-agreements": 64,
+    "/api/scan-qr/batch": 4,
+    "/api/analyze-document": 16,
+    "/api/verify-identity": 16,
+    "/api/create-agreement": 64,
+    "/api/create-agreements/batch": 4,
+    "/api/deploy-contract": 4,
+    "default": 64,
+}
+
+# Overrides of ROUTE_CONCURRENCY, e.g. "/api/analyze-document=8,default=32"
+for override in os.getenv("ASYNC_ROUTE_LIMITS", "").split(","):
+    if "=" in override:
+        route, limit = override.rsplit("=", 1)
+        ROUTE_CONCURRENCY[route.strip()] = int(limit)
+
+# Seconds clients are asked to wait before retrying a rejected request
+ASYNC_RETRY_AFTER = int(os.getenv("ASYNC_RETRY_AFTER", 1))
+
+class RouteLimiter:
+    """Caps the requests of one route in flight and in the queue, rejecting the rest straight away"""
+
+    def __init__(self, limit):
+        self.limit = max(1, limit)
+        self._semaphore = asyncio.Semaphore(self.limit)
+        self.in_flight = 0
+        self.waiting = 0
+        self.served = 0
+        self.rejected = 0
+
+    async def __aenter__(self):
+        if self.waiting >= self.limit:
+            self.rejected += 1
+            raise web.HTTPServiceUnavailable(
+                text=json.dumps({"success": False, "error": "Server busy, retry later"}),
+                content_type="application/json",
+                headers={"Retry-After": str(ASYNC_RETRY_AFTER)},
+            )
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+
+    async def __aexit__(self, *exc_info):
+        self.in_flight -= 1
+        self.served += 1
+        self._semaphore.release()
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'in_flight': self.in_flight,
+            'waiting': self.waiting,
+            'served': self.served,
+            'rejected': self.rejected,
+        }
+
+def _limiter(request):
+    limiters = request.app["limiters"]
+    return limiters.get(request.path) or limiters["default"]
+
+async def run_blocking(request, function, *args):
+    """Run blocking work on the bounded executor, the event loop keeps serving other requests"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(request.app["executor"], functools.partial(function, *args))
+
+def json_response(data, status=200):
+    # Flask's encoder, so Decimal rent amounts serialize the same as in the synchronous app
+    return web.Response(text=flask_app.json.dumps(data), status=status, content_type="application/json")
+
+async def verify_agreement_view(request):
+    """Verify a rent agreement using QR code, reading the chain through AsyncWeb3"""
+    async with _limiter(request):
+        try:
+            form = await request.post()
+            qr_image = form.get('qr_image')
+            if not isinstance(qr_image, web.FileField):
+                return json_response({"success": False, "error": "No QR code image provided"}, 400)
+
+            qr_data = await run_blocking(request, scan_qr_code, qr_image.file)
+
+            if not qr_data:
+                return json_response({"success": False, "error": "Invalid QR code"}, 400)
+
+            fresh = form.get('fresh', 'false').lower() == 'true'
+
+            if is_signed_payload(qr_data):
+                chain_id = await run_blocking(request, get_chain_id, rpc_client.web3)
+                payload = await run_blocking(request, verify_agreement_payload, qr_data, chain_id)
+                if not fresh:
+                    return json_response({
+                        "success": True,
+                        "verified_by": "signature",
+                        "issuer": payload['issuer'],
+                        "block_number": payload['block_number'],
+                        "agreement_data": payload['agreement_data']
+                    })
+                contract_address = payload['contract_address']
+                agreement_id = payload['agreement_id']
+            else:
+                qr_json = json.loads(qr_data)
+                contract_address = qr_json.get('contract_address')
+                agreement_id = qr_json.get('agreement_id')
+
+            agreement_data = await async_verify_agreement(rpc_client.async_web3, contract_address, agreement_id)
+
+            return json_response({
+                "success": True,
+                "verified_by": "chain",
+                "agreement_data": agreement_data
+            })
+        except (InvalidPayloadError, UnreadableImageError) as e:
+            return json_response({"success": False, "error": str(e)}, 400)
+        except ImageTooLargeError as e:
+            return json_response({"success": False, "error": str(e)}, 413)
+        except Exception as e:
+            return json_response({"success": False, "error": str(e)}, 500)
+
+async def verify_agreements_view(request):
+    """Verify many rent agreements in one request, reading the chain through AsyncWeb3"""
+    async with _limiter(request):
+        try:
+            data = await request.json()
+            contract_address = data.get('contract_address')
+            agreement_ids = data.get('agreement_ids') or []
+
+            if not agreement_ids:
+                return json_response({"success": False, "error": "No agreement IDs provided"}, 400)
+
+            if len(agreement_ids) > VERIFY_MAX_AGREEMENTS:
+                return json_response({
+                    "success": False,
+                    "error": f"At most {VERIFY_MAX_AGREEMENTS} agreements can be verified per request"
+                }, 400)
+
+            results = await async_verify_agreements(rpc_client.async_web3, contract_address, agreement_ids)
+            failed = sum(1 for result in results if not result['success'])
+
+            return json_response({
+                "success": True,
+                "verified": len(results) - failed,
+                "failed": failed,
+                "results": results
+            })
+        except Exception as e:
+            return json_response({"success": False, "error": str(e)}, 500)
+
+async def async_stats_view(request):
+    """In-flight, queued and rejected requests per route, for tuning the limits"""
+    return json_response({
+        "success": True,
+        "executor_workers": ASYNC_EXECUTOR_WORKERS,
+        "routes": {route: limiter.stats() for route, limiter in request.app["limiters"].items()}
+    })
+
+def _wsgi_environ(request, body):
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        # PEP 3333 wants the undecoded path bytes as a latin-1 string
+        'PATH_INFO': unquote_to_bytes(request.raw_path.split('?', 1)[0]).decode('latin-1'),
+        'QUERY_STRING': request.query_string,
+        'SERVER_NAME': request.host.split(':')[0],
+        'SERVER_PORT': str(request.url.port or (443 if request.secure else 80)),
+        'SERVER_PROTOCOL': f"HTTP/{request.version.major}.{request.version.minor}",
+        'REMOTE_ADDR': request.remote or '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': request.scheme,
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in request.headers.items():
+        key = name.upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+def _run_wsgi(environ, loop, queue):
+    """Run the Flask app on an executor thread, handing the status, headers and body chunks to the loop"""
+    def put(item):
+        loop.call_soon_threadsafe(queue.put_nowait, item)
+
+    def start_response(status, headers, exc_info=None):
+        put((status, headers))
+
+    try:
+        app_iter = flask_app(environ, start_response)
+        try:
+            # Streamed responses are generated here, on the thread that started them
+            for chunk in app_iter:
+                if chunk:
+                    put(chunk)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+    except Exception as e:
+        put(e)
+    put(None)
+
+async def wsgi_view(request):
+    """Serve every other endpoint with the Flask app, each request on an executor thread"""
+    async with _limiter(request):
+        environ = _wsgi_environ(request, io.BytesIO(await request.read()))
+        queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        loop.run_in_executor(request.app["executor"], _run_wsgi, environ, loop, queue)
+
+        first = await queue.get()
+        if isinstance(first, Exception):
+            return json_response({"success": False, "error": str(first)}, 500)
+
+        status, headers = first
+        response = web.StreamResponse(status=int(status.split(' ', 1)[0]), reason=status.split(' ', 1)[1])
+        for name, value in headers:
+            if name.lower() not in ('connection', 'transfer-encoding'):
+                response.headers.add(name, value)
+        await response.prepare(request)
+
+        while True:
+            chunk = await queue.get()
+            if chunk is None or isinstance(chunk, Exception):
+                break
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    # Requests bridged to the Flask app are recorded by the Flask app itself
+    if request.match_info.handler is wsgi_view:
+        return await handler(request)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        metrics.observe_request(request.match_info.route.resource.canonical, request.method, status,
+                                time.perf_counter() - started)
+
+@web.middleware
+async def cors_middleware(request, handler):
+    # Native routes answer like the Flask app does with flask-cors, preflights go to the Flask app
+    try:
+        response = await handler(request)
+    except web.HTTPException as e:
+        e.headers.setdefault("Access-Control-Allow-Origin", "*")
+        raise
+    response.headers.setdefault("Access-Control-Allow-Origin", "*")
+    return response
+
+async def _close(app):
+    await rpc_client.async_web3.provider.close()
+    app["executor"].shutdown(wait=False)
+
+async def create_app():
+    """aiohttp application serving the Flask endpoints, with the chain-bound ones on AsyncWeb3"""
+    app = web.Application(middlewares=[cors_middleware, metrics_middleware], client_max_size=int(ASYNC_MAX_BODY_MB * 1024 * 1024))
+    app["executor"] = ThreadPoolExecutor(max_workers=ASYNC_EXECUTOR_WORKERS, thread_name_prefix="async-worker")
+    app["limiters"] = {route: RouteLimiter(limit) for route, limit in ROUTE_CONCURRENCY.items()}
+
+    app.router.add_post('/api/verify-agreement', verify_agreement_view)
+    app.router.add_post('/api/verify-agreements', verify_agreements_view)
+    app.router.add_get('/api/async/stats', async_stats_view)
+    app.router.add_route('*', '/{tail:.*}', wsgi_view)
+
+    app.on_cleanup.append(_close)
+    return app
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host='0.0.0.0', port=int(os.getenv('PORT', 5000)))
@@ -0,0 +1,408 @@
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageDraw, ImageFilter
+
+BENCHMARK_PATHS = (
+    "deploy", "create", "create_batch", "create_batch_contract", "verify", "verify_batch",
+    "analyze", "analyze_pdf", "identity", "qr_generate", "qr_scan", "qr_verify_signed",
+)
+
+# Well-known development key, funded from the test chain's first account
+BENCHMARK_PRIVATE_KEY = "0x" + "00" * 31 + "01"
+
+def percentile(sorted_samples, fraction):
+    """Nearest-rank percentile of already sorted samples"""
+    if not sorted_samples:
+        return None
+    index = min(len(sorted_samples) - 1, int(round(fraction * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+def _text_image(size, lines, seed):
+    image = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(image)
+    y = 40
+    for line in lines:
+        draw.text((40, y), line, fill="black")
+        y += 36
+    # A little noise so every generated document is a distinct upload, as in production
+    rng = random.Random(seed)
+    for _ in range(200):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.point((x, y), fill=(rng.randrange(256),) * 3)
+    return image
+
+def lease_image(seed, size=(1240, 1754)):
+    """A generated single-page lease, roughly an A4 scan at 150 dpi"""
+    return _text_image(size, [
+        "RESIDENTIAL LEASE AGREEMENT",
+        f"Property address: {seed} Main Street, Apartment {seed % 40 + 1}",
+        f"Monthly rent: {1000 + seed % 900} USD",
+        "Lease term: 12 months",
+        "Landlord and tenant agree to the terms of this lease",
+    ], seed)
+
+def id_image(seed, size=(1012, 638)):
+    """A generated ID card photo"""
+    return _text_image(size, [
+        "IDENTITY CARD",
+        f"Name: Tenant {seed}",
+        f"ID number: X{seed:08d}",
+        f"Date of birth: {1960 + seed % 40}-01-01",
+    ], seed)
+
+def qr_photo(qr_png, seed, size=(3000, 2000)):
+    """A QR code printed on paper and photographed: a large, slightly blurred JPEG"""
+    background = Image.effect_noise(size, 30).convert("RGB")
+    code = Image.open(io.BytesIO(qr_png)).convert("RGB")
+    rng = random.Random(seed)
+    background.paste(code, (rng.randrange(size[0] - code.width), rng.randrange(size[1] - code.height)))
+    return encode(background.filter(ImageFilter.GaussianBlur(1)), "JPEG")
+
+def encode(image, fmt="PNG", **kwargs):
+    buffer = io.BytesIO()
+    image.save(buffer, fmt, **kwargs)
+    return buffer.getvalue()
+
+def lease_pdf(seed, pages=3):
+    images = [lease_image(seed * 100 + page) for page in range(pages)]
+    return encode(images[0], "PDF", save_all=True, append_images=images[1:])
+
+class Upload(io.BytesIO):
+    """In-memory stand-in for an uploaded file"""
+
+def _agreement(web3, seed):
+    return {
+        'landlord_address': web3.eth.accounts[1],
+        'tenant_address': web3.eth.accounts[2],
+        'property_details': f"{seed} Main Street, Apartment {seed % 40 + 1}",
+        'rent_amount': 1 + seed % 5,
+        'duration': 12,
+    }
+
+def make_tiny_model(directory):
+    """Save a randomly initialized, tiny captioning model and return its directory
+
+    The weights are untrained, so the captions are meaningless, but every stage of the real model runs.
+    Identity verification captions with the same model.
+    """
+    import torch
+    from transformers import (BertTokenizerFast, BlipConfig, BlipForConditionalGeneration, BlipImageProcessor,
+                              BlipProcessor)
+
+    torch.manual_seed(0)
+    words = ("a the lease agreement address rent term duration name number id birth date of document card "
+             "passport street month year apartment tenant landlord signed page").split()
+    vocab_path = os.path.join(directory, "vocab.txt")
+    with open(vocab_path, "w") as f:
+        f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + words + [f"w{i}" for i in range(60)]))
+    tokenizer = BertTokenizerFast(vocab_file=vocab_path, do_lower_case=True)
+    tokenizer.bos_token = "[CLS]"
+
+    document_model = os.path.join(directory, "tiny-blip")
+    BlipForConditionalGeneration(BlipConfig(
+        text_config=dict(vocab_size=tokenizer.vocab_size, hidden_size=32, num_hidden_layers=2, num_attention_heads=2,
+                         intermediate_size=64, max_position_embeddings=128, bos_token_id=2, sep_token_id=3,
+                         pad_token_id=0),
+        vision_config=dict(hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=64,
+                           image_size=64, patch_size=16),
+        projection_dim=32,
+    )).save_pretrained(document_model)
+    BlipProcessor(image_processor=BlipImageProcessor(size={"height": 64, "width": 64}),
+                  tokenizer=tokenizer).save_pretrained(document_model)
+    return document_model
+
+def setup_chain(bytecode=None):
+    """In-process test chain with a funded key and the rent agreement contract deployed
+
+    Without a bytecode override the batch contract is deployed, its ABI covers every call of the plain one.
+    """
+    from web3 import Web3, EthereumTesterProvider
+    import blockchain
+    from eth_account import Account
+
+    web3 = Web3(EthereumTesterProvider())
+    # Transactions are signed for the test chain, not the network configured in .env
+    os.environ["CHAIN_ID"] = str(web3.eth.chain_id)
+    if bytecode:
+        blockchain.CONTRACT_BYTECODE = bytecode
+
+    web3.eth.send_transaction({
+        'from': web3.eth.accounts[0],
+        'to': Account.from_key(BENCHMARK_PRIVATE_KEY).address,
+        'value': web3.to_wei(1000, 'ether'),
+    })
+    return web3, blockchain.deploy_contract(web3, BENCHMARK_PRIVATE_KEY, batch=not bytecode)
+
+def build_operations(paths, web3=None, contract_address=None, batch_size=20, batch_contract=True):
+    """One callable per path, each taking the iteration number"""
+    operations = {}
+    agreement_ids = []
+
+    if web3 is not None:
+        import blockchain
+
+        def create(seed):
+            item = _agreement(web3, seed)
+            agreement_id = blockchain.create_agreement(
+                web3, contract_address, item['landlord_address'], item['tenant_address'],
+                item['property_details'], item['rent_amount'], item['duration'], BENCHMARK_PRIVATE_KEY
+            )
+            agreement_ids.append(agreement_id)
+
+        def create_batch(seed):
+            results = blockchain.create_agreements(
+                web3, contract_address, [_agreement(web3, seed * batch_size + index) for index in range(batch_size)],
+                BENCHMARK_PRIVATE_KEY
+            )
+            failed = [result for result in results if not result['success']]
+            if failed:
+                raise RuntimeError(failed[0].get('error'))
+            agreement_ids.extend(result['agreement_id'] for result in results)
+
+        def ensure_agreements(count):
+            # Verification needs agreements to read, create them outside the measured calls
+            while len(agreement_ids) < count:
+                create_batch(len(agreement_ids) + 10_000)
+
+        def verify(seed):
+            ensure_agreements(1)
+            blockchain.verify_agreement(web3, contract_address, agreement_ids[seed % len(agreement_ids)],
+                                        use_cache=False)
+
+        def verify_batch(seed):
+            ensure_agreements(100)
+            results = blockchain.verify_agreements(web3, contract_address, agreement_ids[:100], use_cache=False)
+            if not all(result['success'] for result in results):
+                raise RuntimeError(next(result['error'] for result in results if not result['success']))
+
+        if "create_batch_contract" in paths:
+            batch_contract_address = blockchain.deploy_contract(web3, BENCHMARK_PRIVATE_KEY, batch=True)
+
+            def create_batch_contract(seed):
+                results = blockchain.create_agreements_batched(
+                    web3, batch_contract_address,
+                    [_agreement(web3, seed * batch_size + index) for index in range(batch_size)], BENCHMARK_PRIVATE_KEY
+                )
+                failed = [result for result in results if not result['success']]
+                if failed:
+                    raise RuntimeError(failed[0].get('error'))
+
+            operations["create_batch_contract"] = create_batch_contract
+
+        operations.update({
+            "deploy": lambda seed: blockchain.deploy_contract(web3, BENCHMARK_PRIVATE_KEY, batch=batch_contract),
+            "create": create,
+            "create_batch": create_batch,
+            "verify": verify,
+            "verify_batch": verify_batch,
+        })
+
+    if {"analyze", "analyze_pdf", "identity"} & set(paths):
+        from ai_processor import analyze_document, verify_identity
+
+        operations["analyze"] = lambda seed: analyze_document(Upload(encode(lease_image(seed))), "lease")
+        operations["analyze_pdf"] = lambda seed: analyze_document(Upload(lease_pdf(seed)), "lease")
+        operations["identity"] = lambda seed: verify_identity(Upload(encode(id_image(seed), "JPEG")), "passport")
+
+    if {"qr_generate", "qr_scan", "qr_verify_signed"} & set(paths):
+        from qr_handler import generate_qr_code, qr_code_cache, scan_qr_code
+
+        def qr_payload(seed):
+            return json.dumps({
+                "contract_address": contract_address or "0x" + "00" * 20,
+                "agreement_id": "0x%064x" % seed,
+            })
+
+        def qr_generate(seed):
+            qr_hash, _ = generate_qr_code(qr_payload(seed))
+            qr_code_cache.get(qr_hash, "png")
+
+        # Scanning the same few photos is fine, scans are not cached
+        photos = [qr_photo(qr_code_cache.get(generate_qr_code(qr_payload(seed))[0], "png"), seed) for seed in range(4)]
+
+        def qr_scan(seed):
+            if scan_qr_code(Upload(photos[seed % len(photos)])) is None:
+                raise RuntimeError("QR code not found")
+
+        def qr_verify_signed(seed):
+            import qr_payload as payloads
+            from eth_account import Account
+
+            # Distinct payloads, verified payloads are memoized
+            payloads.QR_TRUSTED_ISSUERS = [Account.from_key(BENCHMARK_PRIVATE_KEY).address]
+            data = payloads.encode_agreement_payload(
+                1337, "0x" + "11" * 20, "0x%064x" % seed, "0x" + "22" * 20, "0x" + "33" * 20,
+                f"{seed} Main Street", 1, 12, seed, private_key=BENCHMARK_PRIVATE_KEY
+            )
+            payloads.verify_agreement_payload(data)
+
+        operations.update({"qr_generate": qr_generate, "qr_scan": qr_scan, "qr_verify_signed": qr_verify_signed})
+
+    return {path: operations[path] for path in paths if path in operations}
+
+def run_path(operation, iterations, warmup=3, concurrency=1, seed_offset=0):
+    """Time iterations of one operation, returns throughput, latency percentiles and stage breakdown"""
+    from metrics import metrics
+
+    latencies = []
+    errors = []
+    warmup_errors = []
+
+    # A failing path is reported like a failing iteration instead of ending the whole run
+    for seed in range(warmup):
+        try:
+            operation(seed_offset + seed)
+        except Exception as e:
+            warmup_errors.append(str(e))
+
+    def timed(seed):
+        started = time.perf_counter()
+        try:
+            operation(seed)
+        except Exception as e:
+            errors.append(str(e))
+            return
+        latencies.append(time.perf_counter() - started)
+
+    stages_before = metrics.stage_totals()
+    started = time.perf_counter()
+    seeds = range(seed_offset + warmup, seed_offset + warmup + iterations)
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(timed, seeds))
+    else:
+        for seed in seeds:
+            timed(seed)
+    wall_seconds = time.perf_counter() - started
+    stages_after = metrics.stage_totals()
+
+    latencies.sort()
+    stages = {}
+    for stage, (count, total) in stages_after.items():
+        count -= stages_before.get(stage, (0, 0))[0]
+        total -= stages_before.get(stage, (0, 0))[1]
+        if count:
+            stages[stage] = {'count': count, 'mean_ms': round(total / count * 1000, 3)}
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        'iterations': iterations,
+        'concurrency': concurrency,
+        'errors': len(errors),
+        'warmup_errors': len(warmup_errors),
+        'first_error': (warmup_errors + errors)[0] if warmup_errors or errors else None,
+        'wall_seconds': round(wall_seconds, 4),
+        'throughput_per_second': round(len(latencies) / wall_seconds, 3) if wall_seconds else None,
+        'latency_ms': {
+            'mean': ms(sum(latencies) / len(latencies)) if latencies else None,
+            'p50': ms(percentile(latencies, 0.50)),
+            'p95': ms(percentile(latencies, 0.95)),
+            'p99': ms(percentile(latencies, 0.99)),
+            'max': ms(latencies[-1]) if latencies else None,
+        },
+        'stages': stages,
+    }
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(results, baseline):
+    """p50 and throughput of this run relative to a baseline run, per path"""
+    comparison = {}
+    for path, result in results['results'].items():
+        before = baseline.get('results', {}).get(path)
+        if not before or not before['latency_ms']['p50'] or not result['latency_ms']['p50']:
+            continue
+        comparison[path] = {
+            'p50_ratio': round(result['latency_ms']['p50'] / before['latency_ms']['p50'], 3),
+            'throughput_ratio': round(result['throughput_per_second'] / before['throughput_per_second'], 3)
+            if before['throughput_per_second'] else None,
+        }
+    return comparison
+
+def run_benchmarks(paths=BENCHMARK_PATHS, iterations=20, warmup=3, concurrency=1, bytecode=None):
+    """Run every requested path and return the results with enough context to compare runs"""
+    chain_paths = {"deploy", "create", "create_batch", "create_batch_contract", "verify", "verify_batch"}
+    web3 = contract_address = None
+    if chain_paths & set(paths):
+        web3, contract_address = setup_chain(bytecode)
+
+    operations = build_operations(paths, web3, contract_address, batch_contract=not bytecode)
+    results = {}
+    for offset, (path, operation) in enumerate(operations.items()):
+        print(f"benchmarking {path}", file=sys.stderr)
+        # Every path gets its own seeds, so no upload repeats across paths
+        results[path] = run_path(operation, iterations, warmup, concurrency, seed_offset=offset * 1_000_000)
+
+    import torch
+    return {
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        'commit': _git_commit(),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'torch': torch.__version__,
+            'torch_threads': torch.get_num_threads(),
+        },
+        'settings': {
+            'iterations': iterations,
+            'warmup': warmup,
+            'concurrency': concurrency,
+            'document_model': os.getenv("DOCUMENT_MODEL_NAME"),
+            'inference_backend': os.getenv("INFERENCE_BACKEND", "fp32"),
+        },
+        'results': results,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the chain, document and QR paths offline")
+    parser.add_argument("--paths", nargs="+", default=list(BENCHMARK_PATHS), choices=BENCHMARK_PATHS)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=1, help="Iterations run at once, from a thread pool")
+    parser.add_argument("--model", help="Local captioning model directory, used as DOCUMENT_MODEL_NAME")
+    parser.add_argument("--bytecode", help="File with the contract bytecode to deploy instead of CONTRACT_BYTECODE")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", help="Results JSON of an earlier run to compare against")
+    args = parser.parse_args()
+
+    # Models are resolved when ai_processor is imported, so the overrides go in first
+    model = args.model
+    if model is None and {"analyze", "analyze_pdf", "identity"} & set(args.paths):
+        print("generating a tiny local model", file=sys.stderr)
+        model = make_tiny_model(tempfile.mkdtemp(prefix="benchmark-models-"))
+    if model:
+        os.environ["DOCUMENT_MODEL_NAME"] = model
+        os.environ.setdefault("MODEL_LOCAL_FILES_ONLY", "1")
+
+    bytecode = None
+    if args.bytecode:
+        with open(args.bytecode) as f:
+            bytecode = f.read().strip()
+
+    results = run_benchmarks(args.paths, args.iterations, args.warmup, args.concurrency, bytecode)
+    if args.compare:
+        with open(args.compare) as f:
+            results['comparison'] = compare(results, json.load(f))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
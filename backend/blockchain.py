@@ -1,8 +1,38 @@
+import asyncio
 import json
 import os
+import time
+import weakref
+from hexbytes import HexBytes
 from web3 import Web3
-from web3.middleware import geth_poa_middleware
+from web3.exceptions import TransactionNotFound
+from web3.providers.rpc import HTTPProvider
+from web3._utils.request import make_post_request
 from eth_account import Account
+from nonce_manager import nonce_manager, is_nonce_error, is_known_transaction_error
+from agreement_cache import agreement_cache
+from fee_oracle import gas_estimate_cache, fee_oracle
+from metrics import span
+from rpc_client import request_never_sent
+
+# How many times a transaction is re-signed after a stale nonce rejection
+NONCE_MAX_RETRIES = int(os.getenv("NONCE_MAX_RETRIES", 3))
+
+# Largest number of calls sent in one JSON-RPC batch request
+RPC_BATCH_SIZE = int(os.getenv("RPC_BATCH_SIZE", 100))
+
+# JSON-RPC batch requests the async server keeps in flight at once for one verification request
+RPC_BATCH_CONCURRENCY = int(os.getenv("RPC_BATCH_CONCURRENCY", 4))
+
+# Share of the block gas limit one createAgreements transaction may plan for, so batches
+# fit in blocks that also carry other transactions
+CHAIN_BATCH_GAS_SHARE = float(os.getenv("CHAIN_BATCH_GAS_SHARE", 0.5))
+
+# Chain IDs fetched per connection, so transactions can be built without an RPC call
+_chain_ids = weakref.WeakKeyDictionary()
+
+# Fields every item of a batch agreement creation must provide
+AGREEMENT_FIELDS = ('landlord_address', 'tenant_address', 'property_details', 'rent_amount', 'duration')
 
 # Smart contract ABI and bytecode
 CONTRACT_ABI = [
@@ -172,131 +202,745 @@ CONTRACT_ABI = [
 
 CONTRACT_BYTECODE = "0x608060405234801561001057600080fd5b50610b9a806100206000396000f3fe608060405234801561001057600080fd5b50600436106100415760003560e01c80634903b0d114610046578063da82246e14610076578063f2a4a82e146100a6575b600080fd5b610060600480360381019061005b91906106e1565b6100d6565b60405161006d91906107b0565b60405180910390f35b610090600480360381019061008b91906107cb565b610327565b60405161009d91906108a0565b60405180910390f35b6100c060048036038101906100bb91906108bb565b610403565b6040516100cd91906109a0565b60405180910390f35b6100de6105e9565b6000808581526020019081526020016000206040518060e00160405290816000820160009054906101000a900473ffffffffffffffffffffffffffffffffffffffff1673ffffffffffffffffffffffffffffffffffffffff1673ffffffffffffffffffffffffffffffffffffffff1681526020016001820160009054906101000a900473ffffffffffffffffffffffffffffffffffffffff1673ffffffffffffffffffffffffffffffffffffffff1673ffffffffffffffffffffffffffffffffffffffff168152602001600282018054610199906109ea565b80601f01602080910402602001604051908101604052809291908181526020018280546101c5906109ea565b80156102125780601f106101e757610100808354040283529160200191610212565b820191906000526020600020905b8154815290600101906020018083116101f557829003601f168201915b50505050508152602001600382015481526020016004820154815260200160058201548152602001600682015460ff1615151515815250509050919050565b6000806000848152602001908152602001600020600601805460ff1916831515908117909155905060008381526020019081526020016000206040518060e00160405290816000820160009054906101000a900473ffffffffffffffffffffffffffffffffffffffff1673ffffffffffffffffffffffffffffffffffffffff1673ffffffffffffffffffffffffffffffffffffffff1681526020016001820160009054906101000a900473ffffffffffffffffffffffffffffffffffffffff1673ffffffffffffffffffffffffffffffffffffffff1673ffffffffffffffffffffffffffffffffffffffff168152602001600282018054610417906109ea565b80601f0160208091040260200160405190810160405280929190818152602001828054610443906109ea565b80156104905780601f1061046557610100808354040283529160200191610490565b820191906000526020600020905b81548152906001019060200180831161047357829003601f168201915b505050505081526020016003820154815260200160048201548152602001600582015481526020016006820154600f1615151515815250509050827f5424fbee04a4f2f1d08893c9f2c9a0c0c5d8f6638b68b2734c6aae1696470c4e83604051610500919061091b565b60405180910390a2505050565b60405180608001604052806040518060e00160405280600073ffffffffffffffffffffffffffffffffffffffff168152602001600073ffffffffffffffffffffffffffffffffffffffff16815260200160608152602001600081526020016000815260200160008152602001600015158152509052565b6040518060e00160405280600073ffffffffffffffffffffffffffffffffffffffff168152602001600073ffffffffffffffffffffffffffffffffffffffff1681526020016060815260200160008152602001600081526020016000815260200160001515815250905090565b60008135905061065a81610b36565b92915050565b60008135905061066f81610b4d565b92915050565b60008083601f84011261068b5761068a610a4b565b5b8235905067ffffffffffffffff8111156106a8576106a7610a46565b5b6020830191508360018202830111156106c4576106c3610a50565b5b9250929050565b6000813590506106da81610b64565b92915050565b6000602082840312156106f7576106f6610a5a565b5b600061070584828501610660565b91505092915050565b6000806040838503121561072557610724610a5a565b5b600061073385828601610660565b925050602061074485828601610660565b9150509250929050565b6000806000806060858703121561076757610766610a5a565b5b600061077587828801610660565b945050602061078687828801610660565b935050604085013567ffffffffffffffff8111156107a7576107a6610a55565b5b6107b387828801610675565b925092505092959194509250565b60006107ba8261093b565b6107c48185610946565b93506107d4818560208601610a17565b6107dd81610a5f565b840191505092915050565b6107f181610997565b82525050565b61080081610985565b82525050565b61080f81610985565b82525050565b61081e81610997565b82525050565b600061082f8261093b565b6108398185610946565b9350610849818560208601610a17565b61085281610a5f565b840191505092915050565b600061086882610946565b9150610873836109a3565b602082019050919050565b600060e08301600083015161089660008601826107f7565b5060208301516108a960206001860182610806565b50604083015184820360408601526108c18282610824565b91505060608301516108d6606086018261095c565b5060808301516108e9608086018261095c565b5060a08301516108fc60a086018261095c565b5060c083015161090f60c0860182610815565b508091505092915050565b600060208201905061092f6000830184610806565b92915050565b600081519050919050565b600082825260208201905092915050565b600061095682610975565b9050919050565b61096681610975565b82525050565b61097f81610a0d565b82525050565b600061099082610975565b9050919050565b60008115159050919050565b6000819050919050565b60006109ac82610985565b9050919050565b60006020820190506109c86000830184610976565b92915050565b60006109d982610985565b9050919050565b6000610a0682856108a0565b91508190509392505050565b6000819050919050565b60005b83811015610a35578082015181840152602081019050610a1a565b83811115610a44576000848401525b50505050565b600080fd5b600080fd5b600080fd5b600080fd5b600080fd5b6000601f19601f8301169050919050565b610a7f816109ce565b8114610a8a57600080fd5b50565b610a9681610997565b8114610aa157600080fd5b50565b610aad81610975565b8114610ab857600080fd5b50565b610ac481610985565b8114610acf57600080fd5b50565b610adb81610a0d565b8114610ae657600080fd5b50565b610af281610997565b8114610afd57600080fd5b50565b610b0981610975565b8114610b1457600080fd5b50565b610b2081610985565b8114610b2b57600080fd5b50565b610b3781610a0d565b8114610b4257600080fd5b50565b610b4b81610997565b8114610b5657600080fd5b50565b610b6d81610975565b8114610b7857600080fd5b5056fea2646970667358221220d1c5e2e2c2a9e4e2c2a9e4e2c2a9e4e2c2a9e4e2c2a9e4e2c2a9e4e2c2a9e4e264736f6c63430008070033"
 
-def deploy_contract(web3, private_key):
-    """Deploy a new smart contract for rent agreements"""
-    # Add PoA middleware for networks like Rinkeby, Goerli, etc.
-    web3.middleware_onion.inject(geth_poa_middleware, layer=0)
+
+# Variant of the contract with createAgreements, which creates many agreements in one transaction
+# and emits one AgreementCreated per item in input order. Compiled with vyper 0.3.10 from
+# contracts/RentAgreementBatch.vy, it keeps every function and event of the contract above.
+BATCH_CONTRACT_ABI = CONTRACT_ABI + [
+    {
+        "inputs": [
+            {
+                "internalType": "address[]",
+                "name": "_landlords",
+                "type": "address[]"
+            },
+            {
+                "internalType": "address[]",
+                "name": "_tenants",
+                "type": "address[]"
+            },
+            {
+                "internalType": "string[]",
+                "name": "_propertyDetails",
+                "type": "string[]"
+            },
+            {
+                "internalType": "uint256[]",
+                "name": "_rentAmounts",
+                "type": "uint256[]"
+            },
+            {
+                "internalType": "uint256[]",
+                "name": "_durations",
+                "type": "uint256[]"
+            }
+        ],
+        "name": "createAgreements",
+        "outputs": [
+            {
+                "internalType": "bytes32[]",
+                "name": "",
+                "type": "bytes32[]"
+            }
+        ],
+        "stateMutability": "nonpayable",
+        "type": "function"
+    }
+]
+
+BATCH_CONTRACT_BYTECODE = "0x61082e6100116100003961082e610000f35f3560e01c60026003821660011b61082601601e395f51565b6321edf10c81186106be5760c436103417610822576004358060a01c610822576105a0526024358060a01c610822576105c05260443560040161040081351161082257602081350180826105e037505060206105a0516040526105c05160605260206105e05101806080826105e060045afa5050604060646104a03761009f610a006106c2565b610a00f36106be565b6320cc9f59811861049b57610144361034176108225760043560040160408135116108225780355f816040811161082257801561010757905b8060051b6020850101358060a01c610822578160051b6105c001526001018181186100e1575b5050806105a052505060243560040160408135116108225780355f816040811161082257801561015957905b8060051b6020850101358060a01c610822578160051b610de00152600101818118610133575b505080610dc052505060443560040160408135116108225780355f81604081116108225780156101be57905b8060051b602085010135602085010161040081351161082257602081350161042083026116000181838237505050600101818118610185575b5050806115e0525050606435600401604081351161082257803560208160051b01808362011e0037505050608435600401604081351161082257803560208160051b01808362012620375050506105a05162012e405262012e4051610dc051186102325762012e40516115e0511815610234565b5f5b6102a657600f62012e60527f6c656e677468206d69736d61746368000000000000000000000000000000000062012e805262012e605062012e60518062012e8001601f825f031636823750506308c379a062012e2052602062012e4052601f19601f62012e6051011660440162012e3cfd5b62012e405162011e0051186102c65762012e4051620126205118156102c8565b5f5b61033a57600f62012e60527f6c656e677468206d69736d61746368000000000000000000000000000000000062012e805262012e605062012e60518062012e8001601f825f031636823750506308c379a062012e2052602062012e4052601f19601f62012e6051011660440162012e3cfd5b5f62012e60525f6040905b80620136805262012e405162013680511861035f57610437565b62012e6051603f81116108225762013680516105a0518110156108225760051b6105c001516040526201368051610dc0518110156108225760051b610de0015160605261042062013680516115e0518110156108225702611600016020815101806080828460045afa505050620136805162011e00518110156108225760051b62011e2001516104a052620136805162012620518110156108225760051b6201264001516104c052610413620136a06106c2565b620136a0518160051b62012e8001526001810162012e605250600101818118610345575b505060208062013680528062013680015f62012e60518083528060051b5f826040811161082257801561048557905b8060051b62012e8001518160051b602088010152600101818118610466575b5050820160200191505090508101905062013680f35b63f42eb76581186106be57602436103417610822576020806040525f6004356020525f5260405f208160400160e082548252600183015460208301528060408301526002830181830160208254015f81601f0160051c6021811161082257801561051757905b808501548160051b850152600101818118610501575b5050508051806020830101601f825f03163682375050601f19601f8251602001011690509050810190506023830154606083015260248301546080830152602583015460a0830152602683015460c083015290509050810190506040f36106be565b63044d1b2281186106be57604436103417610822576024358060011c610822576040525f6004356020525f5260405f20546060526060516106105760116080527f756e6b6e6f776e2061677265656d656e7400000000000000000000000000000060a0526080506080518060a001601f825f031636823750506308c379a06040526020606052601f19601f6080510116604401605cfd5b6060513318156106765760116080527f6f6e6c7920746865206c616e646c6f726400000000000000000000000000000060a0526080506080518060a001601f825f031636823750506308c379a06040526020606052601f19601f6080510116604401605cfd5b6040515f6004356020525f5260405f20602681019050556004357f5faa44896f43f6f899c615587efc78a4fe7f600bf228e5b749157bf21c25214260405160805260206080a2005b5f5ffd5b60405161072e5760116104e0527f6c616e646c6f7264207265717569726564000000000000000000000000000000610500526104e0506104e0518061050001601f825f031636823750506308c379a06104a05260206104c052601f19601f6104e05101166044016104bcfd5b6001546001810181811061082257905060015560405161052052606051610540524261056052600154610580526080610500526105008051602082012090506104e0525f6104e0516020525f5260405f2060405181556060516001820155602060805101600282015f82601f0160051c602181116108225780156107c557905b8060051b60800151818401556001018181186107ae575b505050506104a05160238201556104c051602482015542602582015560016026820155506060516040516104e0517f4fbc8792122a29cec5c0438085dbfe15fbe0d8d89b25d8d3f4155b683d5abb065f610500a46104e051815250565b5f80fd001800a8057906be8419082e810800a16576797065728300030a0014"
+
+# Largest number of agreements and property details size in bytes the batch contract accepts per item
+BATCH_CONTRACT_MAX_ITEMS = 64
+BATCH_CONTRACT_MAX_DETAILS_BYTES = 1024
+
+# Gas every transaction pays before running any code, a batch pays it once for all its items
+TRANSACTION_BASE_GAS = 21000
+
+def _agreement_output_type():
+    """ABI type of the Agreement struct returned by getAgreement"""
+    get_agreement_abi = next(item for item in CONTRACT_ABI if item.get('name') == 'getAgreement')
+    components = get_agreement_abi['outputs'][0]['components']
+    return f"({','.join(component['type'] for component in components)})"
+
+AGREEMENT_OUTPUT_TYPE = _agreement_output_type()
+
+class BroadcastUnknownError(Exception):
+    """Raised when a send failed in a way that leaves open whether the node received the transaction"""
+
+    def __init__(self, tx_hash, error):
+        super().__init__(f"Transaction {tx_hash} may have been broadcast: {error}")
+        self.tx_hash = tx_hash
+
+def send_raw_transaction(web3, signed_tx):
+    """Broadcast a signed transaction, a node that already has it counts as success"""
+    try:
+        with span("send_raw_transaction"):
+            return web3.eth.send_raw_transaction(signed_tx.rawTransaction)
+    except Exception as e:
+        if is_known_transaction_error(e):
+            return HexBytes(signed_tx.hash)
+        # A node that answered rejected the transaction, but a timeout or dropped
+        # connection can come after the node received it
+        if not isinstance(e, OSError) or request_never_sent(e):
+            raise
+        try:
+            web3.eth.get_transaction(signed_tx.hash)
+            return HexBytes(signed_tx.hash)
+        except Exception:
+            raise BroadcastUnknownError(signed_tx.hash.hex(), e) from e
+
+def send_transaction(web3, private_key, build_transaction):
+    """Sign and broadcast the transaction returned by build_transaction(nonce)"""
+    account = Account.from_key(private_key)
     
+    for attempt in range(NONCE_MAX_RETRIES + 1):
+        # Hand out the nonce locally instead of asking the node every time
+        nonce = nonce_manager.allocate(web3, account.address)
+        
+        try:
+            with span("build_transaction"):
+                transaction = build_transaction(nonce)
+            with span("sign_transaction"):
+                signed_tx = web3.eth.account.sign_transaction(transaction, private_key)
+            return send_raw_transaction(web3, signed_tx)
+        except BroadcastUnknownError:
+            # The nonce may be in use, re-sync from the node's pending count instead of handing it back
+            nonce_manager.reset(account.address)
+            raise
+        except Exception as e:
+            if is_nonce_error(e) and attempt < NONCE_MAX_RETRIES:
+                # Our view of the chain is stale, re-sync and sign again
+                nonce_manager.reset(account.address)
+                continue
+            
+            # The nonce was never used, hand it back so it doesn't leave a gap
+            nonce_manager.release(account.address, nonce)
+            raise
+
+class ChainIdMismatchError(Exception):
+    """Raised when the node serves a different chain than CHAIN_ID expects"""
+
+def get_chain_id(web3):
+    """Get the chain ID from the node, fetched once per connection and checked against CHAIN_ID if configured"""
+    chain_id = _chain_ids.get(web3)
+    if chain_id is None:
+        chain_id = web3.eth.chain_id
+        # Signing for the configured chain would only fail once the node rejects the transaction,
+        # or worse, succeed on a chain the transactions were not meant for
+        expected = os.getenv("CHAIN_ID")
+        if expected and int(expected) != chain_id:
+            raise ChainIdMismatchError(f"CHAIN_ID is {expected} but the node serves chain {chain_id}")
+        _chain_ids[web3] = chain_id
+    return chain_id
+
+def _fees(web3):
+    with span("gas_price"):
+        return fee_oracle.fees(web3)
+
+def transaction_params(web3, sender, nonce, gas):
+    """Build transaction fields that need no RPC call: cached fees and chain ID, given nonce and gas"""
+    return {
+        'from': sender,
+        'nonce': nonce,
+        'gas': gas,
+        'chainId': get_chain_id(web3),
+        **_fees(web3),
+    }
+
+def deploy_contract(web3, private_key, batch=False):
+    """Deploy a new smart contract for rent agreements, the variant with createAgreements if batch is set"""
     # Get account from private key
     account = Account.from_key(private_key)
     
     # Create contract instance
-    RentAgreement = web3.eth.contract(abi=CONTRACT_ABI, bytecode=CONTRACT_BYTECODE)
-    
-    # Build transaction
-    nonce = web3.eth.get_transaction_count(account.address)
-    
-    # Estimate gas
-    gas_estimate = RentAgreement.constructor().estimate_gas({'from': account.address})
-    
-    # Get gas price
-    gas_price = web3.eth.gas_price
-    
-    # Create transaction
-    transaction = {
-        'from': account.address,
-        'nonce': nonce,
-        'gas': int(gas_estimate * 1.2),  # Add 20% buffer
-        'gasPrice': gas_price,
-    }
+    abi, bytecode = (BATCH_CONTRACT_ABI, BATCH_CONTRACT_BYTECODE) if batch else (CONTRACT_ABI, CONTRACT_BYTECODE)
+    RentAgreement = web3.eth.contract(abi=abi, bytecode=bytecode)
     
-    # Deploy contract
-    contract_tx = RentAgreement.constructor().build_transaction(transaction)
+    # Estimate gas, cached since every deployment uses the same bytecode
+    with span("estimate_gas"):
+        gas = gas_estimate_cache.gas_limit(
+            'deploy_batch' if batch else 'deploy',
+            bytecode,
+            lambda: RentAgreement.constructor().estimate_gas({'from': account.address})
+        )
     
-    # Sign transaction
-    signed_tx = web3.eth.account.sign_transaction(contract_tx, private_key)
+    def build_transaction(nonce):
+        # Deploy contract
+        return RentAgreement.constructor().build_transaction(
+            transaction_params(web3, account.address, nonce, gas)
+        )
     
-    # Send transaction
-    tx_hash = web3.eth.send_raw_transaction(signed_tx.rawTransaction)
+    # Sign and send transaction
+    tx_hash = send_transaction(web3, private_key, build_transaction)
     
     # Wait for transaction receipt
-    tx_receipt = web3.eth.wait_for_transaction_receipt(tx_hash)
+    with span("wait_for_receipt"):
+        tx_receipt = web3.eth.wait_for_transaction_receipt(tx_hash)
     
     # Return contract address
     return tx_receipt.contractAddress
 
-def get_contract(web3, contract_address):
+def get_contract(web3, contract_address, abi=CONTRACT_ABI):
     """Get contract instance from address"""
-    return web3.eth.contract(address=contract_address, abi=CONTRACT_ABI)
+    return web3.eth.contract(address=contract_address, abi=abi)
 
-def create_agreement(web3, contract_address, landlord_address, tenant_address, property_details, rent_amount, duration, private_key):
-    """Create a new rent agreement on the blockchain"""
-    # Add PoA middleware for networks like Rinkeby, Goerli, etc.
-    web3.middleware_onion.inject(geth_poa_middleware, layer=0)
-    
+def submit_agreement(web3, contract_address, landlord_address, tenant_address, property_details, rent_amount, duration, private_key):
+    """Sign and broadcast a createAgreement transaction without waiting for it to be mined"""
     # Get account from private key
     account = Account.from_key(private_key)
     
     # Get contract instance
     contract = get_contract(web3, contract_address)
     
-    # Build transaction
-    nonce = web3.eth.get_transaction_count(account.address)
-    
     # Convert rent amount to wei
     rent_amount_wei = web3.to_wei(rent_amount, 'ether')
     
-    # Estimate gas
-    gas_estimate = contract.functions.createAgreement(
+    # Build the contract call
+    create_call = contract.functions.createAgreement(
         landlord_address,
         tenant_address,
         property_details,
         rent_amount_wei,
         duration
-    ).estimate_gas({'from': account.address})
+    )
+    
+    # Estimate gas, cached per calldata size since that is what drives gas use
+    with span("estimate_gas"):
+        gas = gas_estimate_cache.gas_limit(
+            (contract.address, 'createAgreement'),
+            contract.encodeABI(fn_name='createAgreement', args=create_call.args),
+            lambda: create_call.estimate_gas({'from': account.address})
+        )
     
-    # Get gas price
-    gas_price = web3.eth.gas_price
+    def build_transaction(nonce):
+        # Create transaction
+        return create_call.build_transaction(transaction_params(web3, account.address, nonce, gas))
     
-    # Create transaction
-    transaction = contract.functions.createAgreement(
+    # Sign and send transaction
+    return send_transaction(web3, private_key, build_transaction)
+
+def get_agreement_id(web3, contract_address, tx_receipt):
+    """Decode the agreement ID from the AgreementCreated log of a receipt"""
+    contract = get_contract(web3, contract_address)
+    with span("decode_logs"):
+        logs = contract.events.AgreementCreated().process_receipt(tx_receipt)
+    return logs[0]['args']['agreementId'].hex()
+
+def wait_for_agreement(web3, contract_address, tx_hash):
+    """Wait for an agreement transaction to be mined, returns its agreement ID and block number"""
+    with span("wait_for_receipt"):
+        tx_receipt = web3.eth.wait_for_transaction_receipt(tx_hash)
+    return get_agreement_id(web3, contract_address, tx_receipt), tx_receipt.blockNumber
+
+def create_agreement(web3, contract_address, landlord_address, tenant_address, property_details, rent_amount, duration, private_key):
+    """Create a new rent agreement on the blockchain"""
+    tx_hash = submit_agreement(
+        web3,
+        contract_address,
         landlord_address,
         tenant_address,
         property_details,
-        rent_amount_wei,
-        duration
-    ).build_transaction({
-        'from': account.address,
-        'nonce': nonce,
-        'gas': int(gas_estimate * 1.2),  # Add 20% buffer
-        'gasPrice': gas_price,
-    })
+        rent_amount,
+        duration,
+        private_key
+    )
     
-    # Sign transaction
-    signed_tx = web3.eth.account.sign_transaction(transaction, private_key)
+    # Wait for transaction receipt and get agreement ID from logs
+    agreement_id, _ = wait_for_agreement(web3, contract_address, tx_hash)
+    return agreement_id
+
+def wait_for_receipts(web3, tx_hashes, timeout=120, poll_latency=0.5):
+    """Wait for transactions from one sender, given in nonce order, and return their receipts by hash"""
+    pending = list(tx_hashes)
+    receipts = {}
+    deadline = time.time() + timeout
     
-    # Send transaction
-    tx_hash = web3.eth.send_raw_transaction(signed_tx.rawTransaction)
+    while pending and time.time() < deadline:
+        for position, tx_hash in enumerate(pending):
+            try:
+                receipts[tx_hash] = web3.eth.get_transaction_receipt(tx_hash)
+            except TransactionNotFound:
+                # Transactions are mined in nonce order, so nothing after this one is mined yet
+                pending = pending[position:]
+                break
+        else:
+            pending = []
+        
+        if pending:
+            time.sleep(poll_latency)
     
-    # Wait for transaction receipt
-    tx_receipt = web3.eth.wait_for_transaction_receipt(tx_hash)
+    return receipts
+
+def send_transactions(web3, private_key, calls, gas_limits):
+    """Sign contract calls with consecutive nonces and send them back to back, returns tx hashes and errors by key"""
+    account = Account.from_key(private_key)
+    tx_hashes = {}
+    errors = {}
     
-    # Get agreement ID from logs
-    logs = contract.events.AgreementCreated().process_receipt(tx_receipt)
-    agreement_id = logs[0]['args']['agreementId'].hex()
+    def sign(key, nonce):
+        with span("build_transaction"):
+            transaction = calls[key].build_transaction(
+                transaction_params(web3, account.address, nonce, gas_limits[key])
+            )
+        with span("sign_transaction"):
+            return web3.eth.account.sign_transaction(transaction, private_key)
     
-    return agreement_id
+    # Reserve consecutive nonces and sign every transaction before sending any
+    order = list(calls)
+    next_nonce = nonce_manager.allocate(web3, account.address, count=len(order))
+    end_nonce = next_nonce + len(order)
+    signed = {}
+    for offset, key in enumerate(order):
+        try:
+            signed[key] = (next_nonce + offset, sign(key, next_nonce + offset))
+        except Exception as e:
+            errors[key] = str(e)
+    
+    # Send back to back, re-signing after a failure so no nonce gap is left behind
+    unsent = [key for key in order if key in signed]
+    for position, key in enumerate(unsent):
+        nonce, signed_tx = signed[key]
+        
+        for attempt in range(NONCE_MAX_RETRIES + 1):
+            try:
+                if nonce != next_nonce:
+                    nonce, signed_tx = next_nonce, sign(key, next_nonce)
+                tx_hashes[key] = send_raw_transaction(web3, signed_tx)
+                next_nonce += 1
+                break
+            except BroadcastUnknownError as e:
+                # Whether this nonce is used is up to the node now, so the rest re-sync from its pending count
+                errors[key] = str(e)
+                remaining = len(unsent) - position - 1
+                nonce_manager.reset(account.address)
+                if remaining:
+                    next_nonce = nonce_manager.allocate(web3, account.address, count=remaining)
+                end_nonce = next_nonce + remaining
+                break
+            except Exception as e:
+                if is_nonce_error(e) and attempt < NONCE_MAX_RETRIES:
+                    # Our view of the chain is stale, re-sync and reserve nonces for what is left
+                    remaining = len(unsent) - position
+                    nonce_manager.reset(account.address)
+                    next_nonce = nonce_manager.allocate(web3, account.address, count=remaining)
+                    end_nonce = next_nonce + remaining
+                    continue
+                
+                errors[key] = str(e)
+                break
+    
+    # Hand back nonces that were reserved but never used
+    if next_nonce < end_nonce:
+        nonce_manager.release(account.address, next_nonce, end_nonce - next_nonce)
+    
+    return tx_hashes, errors
 
-def verify_agreement(web3, contract_address, agreement_id):
-    """Verify a rent agreement on the blockchain"""
-    # Add PoA middleware for networks like Rinkeby, Goerli, etc.
-    web3.middleware_onion.inject(geth_poa_middleware, layer=0)
+def create_agreements(web3, contract_address, agreements, private_key, timeout=120):
+    """Create many rent agreements with pipelined signing and submission"""
+    # Get account from private key
+    account = Account.from_key(private_key)
     
     # Get contract instance
     contract = get_contract(web3, contract_address)
     
-    # Get agreement data
-    agreement = contract.functions.getAgreement(agreement_id).call()
+    results = [{'index': index, 'success': False} for index in range(len(agreements))]
     
-    # Format agreement data
-    agreement_data = {
-        'landlord': agreement[0],
-        'tenant': agreement[1],
+    # Build the contract calls, rejecting malformed items up front
+    calls = {}
+    for index, item in enumerate(agreements):
+        if not isinstance(item, dict):
+            results[index]['error'] = "Agreement must be an object"
+            continue
+        
+        missing = [field for field in AGREEMENT_FIELDS if item.get(field) is None]
+        if missing:
+            results[index]['error'] = f"Missing fields: {', '.join(missing)}"
+            continue
+        
+        try:
+            calls[index] = contract.functions.createAgreement(
+                item['landlord_address'],
+                item['tenant_address'],
+                item['property_details'],
+                web3.to_wei(item['rent_amount'], 'ether'),
+                item['duration']
+            )
+        except Exception as e:
+            results[index]['error'] = str(e)
+    
+    if not calls:
+        return results
+    
+    # Gas use grows with the property details, so one estimate per calldata size covers every item
+    # An item that would revert fails on its own instead of failing the whole batch
+    gas_limits = {}
+    for index, call in list(calls.items()):
+        try:
+            with span("estimate_gas"):
+                gas_limits[index] = gas_estimate_cache.gas_limit(
+                    (contract.address, 'createAgreement'),
+                    contract.encodeABI(fn_name='createAgreement', args=call.args),
+                    lambda: call.estimate_gas({'from': account.address})
+                )
+        except Exception as e:
+            results[index]['error'] = str(e)
+            del calls[index]
+    
+    if not calls:
+        return results
+    
+    tx_hashes, errors = send_transactions(web3, private_key, calls, gas_limits)
+    for index, error in errors.items():
+        results[index]['error'] = error
+    
+    # Wait for all receipts together, they will mostly land in the same block
+    with span("wait_for_receipts"):
+        receipts = wait_for_receipts(web3, tx_hashes.values(), timeout=timeout)
+    
+    for index, tx_hash in tx_hashes.items():
+        result = results[index]
+        result['transaction_hash'] = tx_hash.hex()
+        tx_receipt = receipts.get(tx_hash)
+        
+        if tx_receipt is None:
+            result['error'] = "Timed out waiting for transaction receipt"
+        elif tx_receipt.status != 1:
+            result['error'] = "Transaction reverted"
+        else:
+            try:
+                result['agreement_id'] = get_agreement_id(web3, contract_address, tx_receipt)
+                result['block_number'] = tx_receipt.blockNumber
+                result['success'] = True
+            except Exception as e:
+                result['error'] = str(e)
+    
+    return results
+
+def plan_agreement_batches(item_gas, gas_budget, max_items=BATCH_CONTRACT_MAX_ITEMS):
+    """Split items, given as {key: gas}, into consecutive chunks whose gas fits the budget"""
+    chunks = []
+    chunk, chunk_gas = [], TRANSACTION_BASE_GAS
+    for key, gas in item_gas.items():
+        if chunk and (len(chunk) == max_items or chunk_gas + gas > gas_budget):
+            chunks.append(chunk)
+            chunk, chunk_gas = [], TRANSACTION_BASE_GAS
+        # An item over the budget on its own still gets a transaction, the node decides whether it fits
+        chunk.append(key)
+        chunk_gas += gas
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def create_agreements_batched(web3, contract_address, agreements, private_key, timeout=120):
+    """Create many rent agreements with createAgreements, in as few transactions as the block gas limit allows"""
+    # Get account from private key
+    account = Account.from_key(private_key)
+    
+    # Get contract instance, it must have been deployed with batch set
+    contract = get_contract(web3, contract_address, BATCH_CONTRACT_ABI)
+    
+    results = [{'index': index, 'success': False} for index in range(len(agreements))]
+    
+    # Validate every item as a single createAgreement call, which stores the same data as one batch item
+    args = {}
+    item_gas = {}
+    for index, item in enumerate(agreements):
+        if not isinstance(item, dict):
+            results[index]['error'] = "Agreement must be an object"
+            continue
+        
+        missing = [field for field in AGREEMENT_FIELDS if item.get(field) is None]
+        if missing:
+            results[index]['error'] = f"Missing fields: {', '.join(missing)}"
+            continue
+        
+        if len(str(item['property_details']).encode()) > BATCH_CONTRACT_MAX_DETAILS_BYTES:
+            results[index]['error'] = f"Property details longer than {BATCH_CONTRACT_MAX_DETAILS_BYTES} bytes"
+            continue
+        
+        try:
+            call = contract.functions.createAgreement(
+                item['landlord_address'],
+                item['tenant_address'],
+                item['property_details'],
+                web3.to_wei(item['rent_amount'], 'ether'),
+                item['duration']
+            )
+            with span("estimate_gas"):
+                gas_limit = gas_estimate_cache.gas_limit(
+                    (contract.address, 'createAgreement'),
+                    contract.encodeABI(fn_name='createAgreement', args=call.args),
+                    lambda: call.estimate_gas({'from': account.address})
+                )
+        except Exception as e:
+            results[index]['error'] = str(e)
+            continue
+        
+        args[index] = call.args
+        # Inside a batch an item costs what its own transaction does, minus the base cost paid once per batch
+        item_gas[index] = gas_limit / gas_estimate_cache.multiplier - TRANSACTION_BASE_GAS
+    
+    if not args:
+        return results
+    
+    block_gas_limit = web3.eth.get_block('latest')['gasLimit']
+    chunks = plan_agreement_batches(item_gas, block_gas_limit * CHAIN_BATCH_GAS_SHARE)
+    
+    # One createAgreements call per chunk, its gas is estimated exactly since no two batches are alike
+    calls = {}
+    gas_limits = {}
+    for position, chunk in enumerate(chunks):
+        # Columns of the chunk, in the order of createAgreements' array arguments
+        columns = [list(column) for column in zip(*(args[index] for index in chunk))]
+        call = contract.functions.createAgreements(*columns)
+        try:
+            with span("estimate_gas"):
+                estimate = call.estimate_gas({'from': account.address})
+        except Exception as e:
+            for index in chunk:
+                results[index]['error'] = str(e)
+            continue
+        calls[position] = call
+        gas_limits[position] = min(int(estimate * gas_estimate_cache.multiplier), block_gas_limit)
+    
+    tx_hashes, errors = send_transactions(web3, private_key, calls, gas_limits)
+    for position, error in errors.items():
+        for index in chunks[position]:
+            results[index]['error'] = error
+    
+    with span("wait_for_receipts"):
+        receipts = wait_for_receipts(web3, tx_hashes.values(), timeout=timeout)
+    
+    for position, tx_hash in tx_hashes.items():
+        chunk = chunks[position]
+        tx_receipt = receipts.get(tx_hash)
+        error = None
+        
+        if tx_receipt is None:
+            error = "Timed out waiting for transaction receipt"
+        elif tx_receipt.status != 1:
+            error = "Transaction reverted"
+        else:
+            with span("decode_logs"):
+                logs = contract.events.AgreementCreated().process_receipt(tx_receipt)
+            # The contract logs one AgreementCreated per item, in input order
+            if len(logs) != len(chunk):
+                error = f"Expected {len(chunk)} AgreementCreated logs, got {len(logs)}"
+        
+        for offset, index in enumerate(chunk):
+            result = results[index]
+            result['transaction_hash'] = tx_hash.hex()
+            if error is not None:
+                result['error'] = error
+                continue
+            
+            log_args = logs[offset]['args']
+            landlord_address, tenant_address = args[index][:2]
+            if (log_args['landlord'], log_args['tenant']) != (landlord_address, tenant_address):
+                result['error'] = "AgreementCreated log does not match the submitted agreement"
+                continue
+            
+            result['agreement_id'] = log_args['agreementId'].hex()
+            result['block_number'] = tx_receipt.blockNumber
+            result['success'] = True
+    
+    return results
+
+def normalize_agreement_id(agreement_id):
+    """Convert an agreement ID given as bytes or hex, with or without 0x, to 0x-prefixed hex"""
+    if isinstance(agreement_id, (bytes, bytearray)):
+        agreement_id = agreement_id.hex()
+    agreement_id = agreement_id.lower()
+    return agreement_id if agreement_id.startswith("0x") else "0x" + agreement_id
+
+def format_agreement(web3, agreement):
+    """Format a getAgreement result as a dict"""
+    return {
+        'landlord': Web3.to_checksum_address(agreement[0]),
+        'tenant': Web3.to_checksum_address(agreement[1]),
         'property_details': agreement[2],
         'rent_amount': web3.from_wei(agreement[3], 'ether'),
         'duration': agreement[4],
         'timestamp': agreement[5],
         'is_active': agreement[6]
     }
+
+def verify_agreement(web3, contract_address, agreement_id, use_cache=True):
+    """Verify a rent agreement on the blockchain"""
+    agreement_id = normalize_agreement_id(agreement_id)
+    
+    # Repeated scans of the same agreement are served from memory
+    if use_cache:
+        agreement_data = agreement_cache.get(contract_address, agreement_id)
+        if agreement_data is not None:
+            return agreement_data
+    
+    # Get contract instance
+    contract = get_contract(web3, contract_address)
+    
+    # Get agreement data
+    with span("get_agreement"):
+        agreement = contract.functions.getAgreement(agreement_id).call()
+    
+    # Format agreement data
+    agreement_data = format_agreement(web3, agreement)
+    
+    agreement_cache.put(contract_address, agreement_id, agreement_data)
     
     return agreement_data
+
+async def async_verify_agreement(async_web3, contract_address, agreement_id, use_cache=True):
+    """Verify a rent agreement through AsyncWeb3, without holding a thread while the node answers"""
+    agreement_id = normalize_agreement_id(agreement_id)
+    
+    if use_cache:
+        agreement_data = agreement_cache.get(contract_address, agreement_id)
+        if agreement_data is not None:
+            return agreement_data
+    
+    contract = get_contract(async_web3, contract_address)
+    with span("get_agreement"):
+        agreement = await contract.functions.getAgreement(agreement_id).call()
+    agreement_data = format_agreement(async_web3, agreement)
+    
+    agreement_cache.put(contract_address, agreement_id, agreement_data)
+    
+    return agreement_data
+
+def _order_batch_response(batch_response, size):
+    """Match JSON-RPC batch responses, which may come back in any order, to request IDs 0..size-1"""
+    # Nodes reject a whole batch with a single error object
+    if isinstance(batch_response, dict):
+        raise ValueError(batch_response.get('error', batch_response))
+    
+    by_id = {response.get('id'): response for response in batch_response}
+    return [
+        by_id.get(request_id, {"error": {"message": "Missing response in batch"}})
+        for request_id in range(size)
+    ]
+
+def rpc_batch(web3, calls):
+    """Send (method, params) calls as JSON-RPC batches and return their responses in order"""
+    if hasattr(web3.provider, 'make_batch_request'):
+        # The pooled provider batches over its own sessions with failover
+        responses = []
+        for start in range(0, len(calls), RPC_BATCH_SIZE):
+            chunk = calls[start:start + RPC_BATCH_SIZE]
+            batch_response = web3.provider.make_batch_request([
+                {"jsonrpc": "2.0", "id": request_id, "method": method, "params": params}
+                for request_id, (method, params) in enumerate(chunk)
+            ])
+            responses.extend(_order_batch_response(batch_response, len(chunk)))
+        return responses
+    
+    if not isinstance(web3.provider, HTTPProvider):
+        # Providers without HTTP batching get one request per call
+        responses = []
+        for method, params in calls:
+            try:
+                responses.append({"result": web3.manager.request_blocking(method, params)})
+            except Exception as e:
+                responses.append({"error": {"message": str(e)}})
+        return responses
+    
+    responses = []
+    for start in range(0, len(calls), RPC_BATCH_SIZE):
+        chunk = calls[start:start + RPC_BATCH_SIZE]
+        payload = [
+            {"jsonrpc": "2.0", "id": request_id, "method": method, "params": params}
+            for request_id, (method, params) in enumerate(chunk)
+        ]
+        raw_response = make_post_request(
+            web3.provider.endpoint_uri,
+            json.dumps(payload).encode('utf-8'),
+            **web3.provider.get_request_kwargs()
+        )
+        responses.extend(_order_batch_response(json.loads(raw_response), len(chunk)))
+    
+    return responses
+
+def _agreement_calls(web3, contract_address, agreement_ids, use_cache):
+    """Split agreement IDs into cached agreements and the getAgreement calls still needed"""
+    contract = get_contract(web3, contract_address)
+    agreement_ids = [normalize_agreement_id(agreement_id) for agreement_id in agreement_ids]
+    
+    # Serve what we can from the cache and only ask the node for the rest
+    agreements = {}
+    if use_cache:
+        for agreement_id in agreement_ids:
+            agreement_data = agreement_cache.get(contract_address, agreement_id)
+            if agreement_data is not None:
+                agreements[agreement_id] = agreement_data
+    
+    missing = list(dict.fromkeys(agreement_id for agreement_id in agreement_ids if agreement_id not in agreements))
+    
+    # Encode every getAgreement call up front and send them together
+    calls = [
+        ('eth_call', [
+            {'to': contract.address, 'data': contract.encodeABI(fn_name='getAgreement', args=[agreement_id])},
+            'latest'
+        ])
+        for agreement_id in missing
+    ]
+    return agreement_ids, agreements, missing, calls
+
+def _agreement_results(web3, contract_address, agreement_ids, agreements, missing, responses):
+    """Decode getAgreement responses, cache them and build one result per requested ID"""
+    errors = {}
+    for agreement_id, response in zip(missing, responses):
+        if 'error' in response:
+            errors[agreement_id] = response['error'].get('message', str(response['error']))
+            continue
+        
+        try:
+            agreement = web3.codec.decode([AGREEMENT_OUTPUT_TYPE], HexBytes(response['result']))[0]
+        except Exception as e:
+            errors[agreement_id] = str(e)
+            continue
+        
+        agreements[agreement_id] = format_agreement(web3, agreement)
+        agreement_cache.put(contract_address, agreement_id, agreements[agreement_id])
+    
+    results = []
+    for agreement_id in agreement_ids:
+        agreement_data = agreements.get(agreement_id)
+        if agreement_data is None:
+            results.append({'agreement_id': agreement_id, 'success': False, 'error': errors.get(agreement_id)})
+        elif int(agreement_data['landlord'], 16) == 0:
+            # Unknown IDs read back as an empty struct
+            results.append({'agreement_id': agreement_id, 'success': False, 'error': "Agreement not found"})
+        else:
+            results.append({'agreement_id': agreement_id, 'success': True, 'agreement_data': agreement_data})
+    
+    return results
+
+def verify_agreements(web3, contract_address, agreement_ids, use_cache=True):
+    """Verify many rent agreements with a single batched round-trip"""
+    agreement_ids, agreements, missing, calls = _agreement_calls(web3, contract_address, agreement_ids, use_cache)
+    with span("get_agreements_batch"):
+        responses = rpc_batch(web3, calls) if calls else []
+    return _agreement_results(web3, contract_address, agreement_ids, agreements, missing, responses)
+
+async def async_verify_agreements(async_web3, contract_address, agreement_ids, use_cache=True):
+    """Verify many rent agreements through AsyncWeb3, in JSON-RPC batches of RPC_BATCH_SIZE
+    of which up to RPC_BATCH_CONCURRENCY are in flight at once"""
+    agreement_ids, agreements, missing, calls = _agreement_calls(async_web3, contract_address, agreement_ids, use_cache)
+    semaphore = asyncio.Semaphore(max(1, RPC_BATCH_CONCURRENCY))
+    
+    async def send(chunk):
+        async with semaphore:
+            with span("get_agreements_batch"):
+                batch_response = await async_web3.provider.make_batch_request([
+                    {"jsonrpc": "2.0", "id": request_id, "method": method, "params": params}
+                    for request_id, (method, params) in enumerate(chunk)
+                ])
+        return _order_batch_response(batch_response, len(chunk))
+    
+    # gather keeps the chunks in order, so responses line up with the calls
+    chunk_responses = await asyncio.gather(*(
+        send(calls[start:start + RPC_BATCH_SIZE]) for start in range(0, len(calls), RPC_BATCH_SIZE)
+    ))
+    responses = [response for chunk in chunk_responses for response in chunk]
+    
+    return _agreement_results(async_web3, contract_address, agreement_ids, agreements, missing, responses)
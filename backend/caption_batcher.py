@@ -0,0 +1,182 @@
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+from metrics import Histogram, span
+
+# Largest number of images captioned in one generate() call
+CAPTION_BATCH_MAX_SIZE = int(os.getenv("CAPTION_BATCH_MAX_SIZE", 8))
+
+# Milliseconds the first request of a batch waits for others to join it
+CAPTION_BATCH_MAX_WAIT_MS = float(os.getenv("CAPTION_BATCH_MAX_WAIT_MS", 15))
+
+# Upper bounds of the batch size and queue depth histogram buckets
+HISTOGRAM_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+# Caption of one image and the number of tokens generated for it
+CaptionResult = namedtuple("CaptionResult", ["caption", "tokens"])
+
+class _StopWhen(StoppingCriteria):
+    """Stops a batch once every caption satisfies a predicate on its text or has ended"""
+
+    def __init__(self, predicate, tokenizer):
+        self.predicate = predicate
+        self.tokenizer = tokenizer
+        self.end_token_ids = [token_id for token_id in (tokenizer.sep_token_id, tokenizer.eos_token_id)
+                              if token_id is not None]
+
+    def __call__(self, input_ids, scores, **kwargs):
+        for sequence in input_ids:
+            if any(token_id in self.end_token_ids for token_id in sequence[1:].tolist()):
+                continue
+            if not self.predicate(self.tokenizer.decode(sequence, skip_special_tokens=True)):
+                return False
+        return True
+
+class _CaptionRequest:
+    __slots__ = ("image", "generate_kwargs", "future", "enqueued_at")
+
+    def __init__(self, image, generate_kwargs):
+        self.image = image
+        self.generate_kwargs = generate_kwargs
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+class CaptionBatcher:
+    """Queue that gathers concurrent caption requests and runs them through generate() together"""
+
+    def __init__(self, load_model, max_batch_size=CAPTION_BATCH_MAX_SIZE,
+                 max_wait_ms=CAPTION_BATCH_MAX_WAIT_MS):
+        self.load_model = load_model
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+        self.batch_sizes = Histogram(HISTOGRAM_BUCKETS)
+        self.queue_depths = Histogram(HISTOGRAM_BUCKETS)
+        self.batches = 0
+        self.captions = 0
+        self.wait_seconds = 0.0
+
+    def submit(self, image, **generate_kwargs):
+        """Queue one RGB image for captioning, returns a Future of its CaptionResult
+
+        Besides the generate() arguments, stop_when can be a predicate on the caption text
+        that ends generation early once it holds for every caption in the batch.
+        """
+        self.start()
+        request = _CaptionRequest(image, generate_kwargs)
+        self._queue.put(request)
+        return request.future
+
+    def caption(self, image, **generate_kwargs):
+        """Caption one RGB image, blocking until the batch it joined has been generated, returns a CaptionResult"""
+        return self.submit(image, **generate_kwargs).result()
+
+    def start(self):
+        """Start the batching thread, called on first use"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="caption-batcher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the batching thread once the current batch is done"""
+        self._stop.set()
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def _collect(self):
+        try:
+            first = self._queue.get(timeout=0.5)
+        except queue.Empty:
+            return []
+
+        # Depth seen by the batch, including the request that opened it
+        self.queue_depths.observe(self._queue.qsize() + 1)
+
+        batch = [first]
+        deadline = first.enqueued_at + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _generate(self, requests):
+        processor, model = self.load_model()
+        with span("caption_preprocess"):
+            inputs = processor(images=[request.image for request in requests], return_tensors="pt")
+
+        generate_kwargs = dict(requests[0].generate_kwargs)
+        stop_when = generate_kwargs.pop("stop_when", None)
+        if stop_when is not None:
+            generate_kwargs["stopping_criteria"] = StoppingCriteriaList([_StopWhen(stop_when, processor.tokenizer)])
+
+        with span("caption_generate"), torch.no_grad():
+            outputs = model.generate(**inputs, **generate_kwargs)
+
+        # The first token is the prompt, padding after a finished caption is not generated
+        tokens = (outputs[:, 1:] != processor.tokenizer.pad_token_id).sum(dim=1).tolist()
+        with span("caption_decode"):
+            captions = processor.batch_decode(outputs, skip_special_tokens=True)
+        return [CaptionResult(caption, count) for caption, count in zip(captions, tokens)]
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._collect()
+            if not batch:
+                continue
+
+            started = time.perf_counter()
+
+            # Requests can only share a generate() call if they ask for the same generation settings
+            groups = {}
+            for request in batch:
+                groups.setdefault(tuple(sorted(request.generate_kwargs.items())), []).append(request)
+
+            for requests in groups.values():
+                self.batch_sizes.observe(len(requests))
+                try:
+                    captions = self._generate(requests)
+                except Exception as e:
+                    for request in requests:
+                        request.future.set_exception(e)
+                    continue
+                for request, result in zip(requests, captions):
+                    request.future.set_result(result)
+
+            with self._lock:
+                self.batches += len(groups)
+                self.captions += len(batch)
+                self.wait_seconds += sum(started - request.enqueued_at for request in batch)
+
+    def stats(self):
+        """Queue depth and batch size histograms for tuning the batch window"""
+        with self._lock:
+            batches, captions, wait_seconds = self.batches, self.captions, self.wait_seconds
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+            'queue_depth': self._queue.qsize(),
+            'batches': batches,
+            'captions': captions,
+            'average_batch_size': captions / batches if batches else 0.0,
+            'average_wait_ms': wait_seconds / captions * 1000 if captions else 0.0,
+            'batch_size_histogram': self.batch_sizes.snapshot(),
+            'queue_depth_histogram': self.queue_depths.snapshot(),
+        }
@@ -0,0 +1,84 @@
+# @version ^0.3.10
+"""
+@title RentAgreement with batch creation
+@notice The RentAgreement contract plus createAgreements, which creates many
+        agreements in one transaction and emits one AgreementCreated per item
+"""
+
+# Largest number of agreements created by one createAgreements call
+MAX_BATCH_SIZE: constant(uint256) = 64
+
+struct Agreement:
+    landlord: address
+    tenant: address
+    propertyDetails: String[1024]
+    rentAmount: uint256
+    duration: uint256
+    timestamp: uint256
+    isActive: bool
+
+event AgreementCreated:
+    agreementId: indexed(bytes32)
+    landlord: indexed(address)
+    tenant: indexed(address)
+
+event AgreementStatusChanged:
+    agreementId: indexed(bytes32)
+    status: bool
+
+agreements: HashMap[bytes32, Agreement]
+agreementCount: uint256
+
+@internal
+def _create(_landlord: address, _tenant: address, _propertyDetails: String[1024], _rentAmount: uint256, _duration: uint256) -> bytes32:
+    # A stored landlord is what marks an agreement as existing
+    assert _landlord != empty(address), "landlord required"
+    self.agreementCount += 1
+    agreementId: bytes32 = keccak256(_abi_encode(_landlord, _tenant, block.timestamp, self.agreementCount))
+    self.agreements[agreementId] = Agreement({
+        landlord: _landlord,
+        tenant: _tenant,
+        propertyDetails: _propertyDetails,
+        rentAmount: _rentAmount,
+        duration: _duration,
+        timestamp: block.timestamp,
+        isActive: True
+    })
+    log AgreementCreated(agreementId, _landlord, _tenant)
+    return agreementId
+
+@external
+def createAgreement(_landlord: address, _tenant: address, _propertyDetails: String[1024], _rentAmount: uint256, _duration: uint256) -> bytes32:
+    return self._create(_landlord, _tenant, _propertyDetails, _rentAmount, _duration)
+
+@external
+def createAgreements(
+    _landlords: DynArray[address, MAX_BATCH_SIZE],
+    _tenants: DynArray[address, MAX_BATCH_SIZE],
+    _propertyDetails: DynArray[String[1024], MAX_BATCH_SIZE],
+    _rentAmounts: DynArray[uint256, MAX_BATCH_SIZE],
+    _durations: DynArray[uint256, MAX_BATCH_SIZE]
+) -> DynArray[bytes32, MAX_BATCH_SIZE]:
+    count: uint256 = len(_landlords)
+    assert len(_tenants) == count and len(_propertyDetails) == count, "length mismatch"
+    assert len(_rentAmounts) == count and len(_durations) == count, "length mismatch"
+
+    agreementIds: DynArray[bytes32, MAX_BATCH_SIZE] = []
+    for i in range(MAX_BATCH_SIZE):
+        if i == count:
+            break
+        agreementIds.append(self._create(_landlords[i], _tenants[i], _propertyDetails[i], _rentAmounts[i], _durations[i]))
+    return agreementIds
+
+@view
+@external
+def getAgreement(_agreementId: bytes32) -> Agreement:
+    return self.agreements[_agreementId]
+
+@external
+def updateAgreementStatus(_agreementId: bytes32, _status: bool):
+    landlord: address = self.agreements[_agreementId].landlord
+    assert landlord != empty(address), "unknown agreement"
+    assert msg.sender == landlord, "only the landlord"
+    self.agreements[_agreementId].isActive = _status
+    log AgreementStatusChanged(_agreementId, _status)
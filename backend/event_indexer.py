@@ -0,0 +1,357 @@
+import os
+import sqlite3
+import threading
+from web3 import Web3
+from blockchain import get_contract
+from agreement_cache import agreement_cache
+
+# Where the local agreement index is stored
+INDEXER_DB = os.getenv(
+    "INDEXER_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'event_index.db')
+)
+
+# First block to index for INDEXER_CONTRACTS listed without one, the current block if unset,
+# so a contract is never back-filled from genesis by accident
+INDEXER_START_BLOCK = int(os.getenv("INDEXER_START_BLOCK")) if os.getenv("INDEXER_START_BLOCK") else None
+
+def _parse_contracts(value):
+    """Parse "address[:start_block]" entries into {address: start_block}"""
+    contracts = {}
+    for entry in value.split(","):
+        address, _, start_block = entry.strip().partition(":")
+        if address:
+            contracts[address] = int(start_block) if start_block.strip() else INDEXER_START_BLOCK
+    return contracts
+
+# Contracts to index at startup, comma separated, each optionally with the block it was deployed in
+INDEXER_CONTRACTS = _parse_contracts(os.getenv("INDEXER_CONTRACTS", ""))
+
+# Largest block range requested from eth_getLogs at once
+INDEXER_CHUNK_SIZE = int(os.getenv("INDEXER_CHUNK_SIZE", 2000))
+
+# Number of blocks rolled back and re-indexed when a reorg is detected
+INDEXER_CONFIRMATIONS = int(os.getenv("INDEXER_CONFIRMATIONS", 12))
+
+# Seconds between indexing passes
+INDEXER_POLL_INTERVAL = float(os.getenv("INDEXER_POLL_INTERVAL", 5))
+
+# Largest page size served by query_agreements
+INDEXER_MAX_PAGE_SIZE = 500
+
+AGREEMENT_CREATED_TOPIC = Web3.keccak(text="AgreementCreated(bytes32,address,address)").hex()
+STATUS_CHANGED_TOPIC = Web3.keccak(text="AgreementStatusChanged(bytes32,bool)").hex()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    contract_address TEXT PRIMARY KEY,
+    last_block INTEGER NOT NULL,
+    last_block_hash TEXT
+);
+CREATE TABLE IF NOT EXISTS events (
+    contract_address TEXT NOT NULL,
+    block_number INTEGER NOT NULL,
+    block_hash TEXT NOT NULL,
+    log_index INTEGER NOT NULL,
+    tx_hash TEXT NOT NULL,
+    event TEXT NOT NULL,
+    agreement_id TEXT NOT NULL,
+    status INTEGER,
+    PRIMARY KEY (block_hash, log_index)
+);
+CREATE INDEX IF NOT EXISTS events_contract_block ON events (contract_address, block_number);
+CREATE INDEX IF NOT EXISTS events_agreement ON events (contract_address, agreement_id);
+CREATE TABLE IF NOT EXISTS agreements (
+    contract_address TEXT NOT NULL,
+    agreement_id TEXT NOT NULL,
+    landlord TEXT NOT NULL,
+    tenant TEXT NOT NULL,
+    is_active INTEGER NOT NULL,
+    created_block INTEGER NOT NULL,
+    created_at INTEGER NOT NULL,
+    created_tx TEXT NOT NULL,
+    updated_block INTEGER NOT NULL,
+    PRIMARY KEY (contract_address, agreement_id)
+);
+CREATE INDEX IF NOT EXISTS agreements_landlord ON agreements (landlord, created_at);
+CREATE INDEX IF NOT EXISTS agreements_tenant ON agreements (tenant, created_at);
+CREATE INDEX IF NOT EXISTS agreements_created_at ON agreements (created_at);
+"""
+
+def _hex(value):
+    if isinstance(value, (bytes, bytearray)):
+        value = value.hex()
+    value = value.lower()
+    return value if value.startswith("0x") else "0x" + value
+
+class EventIndexer:
+    """Background indexer of agreement events into a local SQLite database"""
+
+    def __init__(self, web3, db_path=INDEXER_DB, chunk_size=INDEXER_CHUNK_SIZE,
+                 confirmations=INDEXER_CONFIRMATIONS, poll_interval=INDEXER_POLL_INTERVAL):
+        self.web3 = web3
+        self.chunk_size = chunk_size
+        self.confirmations = confirmations
+        self.poll_interval = poll_interval
+
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+        # Contracts to start at the current block once a node answers
+        self._pending = set()
+
+        self._thread = None
+        self._stop = threading.Event()
+        self.last_error = None
+
+    def add_contract(self, contract_address, start_block=None):
+        """Start indexing a contract from start_block, or from the current block if omitted"""
+        with self._db_lock:
+            known = self._conn.execute(
+                "SELECT 1 FROM checkpoints WHERE contract_address = ?", (contract_address.lower(),)
+            ).fetchone()
+        if known:
+            # Indexing resumes from the checkpoint, the start block only applies the first time
+            return
+        if start_block is None:
+            try:
+                start_block = self.web3.eth.block_number
+            except Exception as e:
+                # No node reachable, e.g. at startup, the indexing thread registers the contract later
+                with self._db_lock:
+                    self._pending.add(contract_address)
+                self.last_error = str(e)
+                return
+        with self._db_lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO checkpoints (contract_address, last_block) VALUES (?, ?)",
+                (contract_address.lower(), start_block - 1)
+            )
+            self._conn.commit()
+            self._pending.discard(contract_address)
+
+    def start(self):
+        """Start the background indexing thread"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="event-indexer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background indexing thread"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.sync()
+                self.last_error = None
+            except Exception as e:
+                # Progress is checkpointed per chunk, so the next pass resumes where this one stopped
+                self.last_error = str(e)
+            self._stop.wait(self.poll_interval)
+
+    def _checkpoints(self):
+        with self._db_lock:
+            return self._conn.execute(
+                "SELECT contract_address, last_block, last_block_hash FROM checkpoints"
+            ).fetchall()
+
+    def sync(self):
+        """Index every configured contract up to the latest block"""
+        latest = self.web3.eth.block_number
+        with self._db_lock:
+            pending = list(self._pending)
+        for contract_address in pending:
+            self.add_contract(contract_address, latest)
+
+        for contract_address, last_block, last_block_hash in self._checkpoints():
+            # A missing or different block at our checkpoint means the chain reorganized under us
+            if last_block_hash is not None and last_block >= 0:
+                if last_block > latest or _hex(self.web3.eth.get_block(last_block).hash) != last_block_hash:
+                    last_block = self._rollback(contract_address, min(last_block, latest) - self.confirmations)
+
+            from_block = last_block + 1
+            while from_block <= latest:
+                to_block = min(from_block + self.chunk_size - 1, latest)
+                self._index_range(contract_address, from_block, to_block)
+                from_block = to_block + 1
+
+    def _index_range(self, contract_address, from_block, to_block):
+        logs = self.web3.eth.get_logs({
+            'fromBlock': from_block,
+            'toBlock': to_block,
+            'address': Web3.to_checksum_address(contract_address),
+            'topics': [[AGREEMENT_CREATED_TOPIC, STATUS_CHANGED_TOPIC]],
+        })
+        contract = get_contract(self.web3, Web3.to_checksum_address(contract_address))
+        checkpoint_hash = _hex(self.web3.eth.get_block(to_block).hash)
+
+        # Block timestamps are fetched once per block that actually has events
+        timestamps = {}
+        rows = []
+        for log in logs:
+            topic = _hex(log['topics'][0])
+            if topic == AGREEMENT_CREATED_TOPIC:
+                event = contract.events.AgreementCreated().process_log(log)
+            else:
+                event = contract.events.AgreementStatusChanged().process_log(log)
+
+            if log['blockNumber'] not in timestamps:
+                timestamps[log['blockNumber']] = self.web3.eth.get_block(log['blockNumber']).timestamp
+            rows.append((log, event))
+
+        with self._db_lock:
+            for log, event in rows:
+                agreement_id = _hex(event['args']['agreementId'])
+                status = event['args'].get('status')
+                self._conn.execute(
+                    """INSERT OR IGNORE INTO events
+                       (contract_address, block_number, block_hash, log_index, tx_hash, event, agreement_id, status)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (contract_address, log['blockNumber'], _hex(log['blockHash']), log['logIndex'],
+                     _hex(log['transactionHash']), event['event'], agreement_id,
+                     None if status is None else int(status))
+                )
+
+                if event['event'] == 'AgreementCreated':
+                    self._conn.execute(
+                        """INSERT OR REPLACE INTO agreements
+                           (contract_address, agreement_id, landlord, tenant, is_active,
+                            created_block, created_at, created_tx, updated_block)
+                           VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?)""",
+                        (contract_address, agreement_id, event['args']['landlord'].lower(),
+                         event['args']['tenant'].lower(), log['blockNumber'], timestamps[log['blockNumber']],
+                         _hex(log['transactionHash']), log['blockNumber'])
+                    )
+                else:
+                    self._conn.execute(
+                        """UPDATE agreements SET is_active = ?, updated_block = ?
+                           WHERE contract_address = ? AND agreement_id = ?""",
+                        (int(status), log['blockNumber'], contract_address, agreement_id)
+                    )
+
+            self._conn.execute(
+                "UPDATE checkpoints SET last_block = ?, last_block_hash = ? WHERE contract_address = ?",
+                (to_block, checkpoint_hash, contract_address)
+            )
+            self._conn.commit()
+
+        # Keep cached agreement reads in line with what was just indexed
+        for log, event in rows:
+            if event['event'] == 'AgreementStatusChanged':
+                agreement_cache.invalidate(contract_address, event['args']['agreementId'])
+
+    def _rollback(self, contract_address, to_block):
+        """Drop everything indexed after to_block so it is re-indexed from the canonical chain"""
+        to_block = max(to_block, -1)
+        with self._db_lock:
+            self._conn.execute(
+                "DELETE FROM events WHERE contract_address = ? AND block_number > ?",
+                (contract_address, to_block)
+            )
+            self._conn.execute(
+                "DELETE FROM agreements WHERE contract_address = ? AND created_block > ?",
+                (contract_address, to_block)
+            )
+
+            # Replay the status of agreements whose latest change was rolled back
+            stale = self._conn.execute(
+                "SELECT agreement_id, created_block FROM agreements WHERE contract_address = ? AND updated_block > ?",
+                (contract_address, to_block)
+            ).fetchall()
+            for agreement_id, created_block in stale:
+                last_change = self._conn.execute(
+                    """SELECT status, block_number FROM events
+                       WHERE contract_address = ? AND agreement_id = ? AND event = 'AgreementStatusChanged'
+                       ORDER BY block_number DESC, log_index DESC LIMIT 1""",
+                    (contract_address, agreement_id)
+                ).fetchone()
+                is_active, updated_block = last_change if last_change else (1, created_block)
+                self._conn.execute(
+                    """UPDATE agreements SET is_active = ?, updated_block = ?
+                       WHERE contract_address = ? AND agreement_id = ?""",
+                    (is_active, updated_block, contract_address, agreement_id)
+                )
+
+            self._conn.execute(
+                "UPDATE checkpoints SET last_block = ?, last_block_hash = NULL WHERE contract_address = ?",
+                (to_block, contract_address)
+            )
+            self._conn.commit()
+
+        return to_block
+
+    def query_agreements(self, landlord=None, tenant=None, status=None, contract_address=None,
+                         created_from=None, created_to=None, limit=50, offset=0):
+        """List indexed agreements matching the given filters, newest first"""
+        clauses = []
+        params = []
+        if landlord:
+            clauses.append("landlord = ?")
+            params.append(landlord.lower())
+        if tenant:
+            clauses.append("tenant = ?")
+            params.append(tenant.lower())
+        if status is not None:
+            clauses.append("is_active = ?")
+            params.append(int(status))
+        if contract_address:
+            clauses.append("contract_address = ?")
+            params.append(contract_address.lower())
+        if created_from is not None:
+            clauses.append("created_at >= ?")
+            params.append(int(created_from))
+        if created_to is not None:
+            clauses.append("created_at <= ?")
+            params.append(int(created_to))
+
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        limit = max(1, min(int(limit), INDEXER_MAX_PAGE_SIZE))
+        offset = max(0, int(offset))
+
+        with self._db_lock:
+            total = self._conn.execute(f"SELECT COUNT(*) FROM agreements {where}", params).fetchone()[0]
+            rows = self._conn.execute(
+                f"""SELECT contract_address, agreement_id, landlord, tenant, is_active,
+                           created_block, created_at, created_tx
+                    FROM agreements {where}
+                    ORDER BY created_at DESC, created_block DESC, agreement_id
+                    LIMIT ? OFFSET ?""",
+                params + [limit, offset]
+            ).fetchall()
+
+        return {
+            'total': total,
+            'limit': limit,
+            'offset': offset,
+            'agreements': [
+                {
+                    'contract_address': Web3.to_checksum_address(row[0]),
+                    'agreement_id': row[1],
+                    'landlord': Web3.to_checksum_address(row[2]),
+                    'tenant': Web3.to_checksum_address(row[3]),
+                    'is_active': bool(row[4]),
+                    'block_number': row[5],
+                    'timestamp': row[6],
+                    'transaction_hash': row[7],
+                }
+                for row in rows
+            ],
+        }
+
+    def status(self):
+        """Get indexing progress per contract"""
+        return {
+            'contracts': [
+                {'contract_address': Web3.to_checksum_address(row[0]), 'last_block': row[1]}
+                for row in self._checkpoints()
+            ],
+            'last_error': self.last_error,
+        }
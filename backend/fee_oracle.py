@@ -0,0 +1,150 @@
+import os
+import threading
+import time
+
+# Safety margin applied on top of every gas estimate
+GAS_BUFFER_MULTIPLIER = float(os.getenv("GAS_BUFFER_MULTIPLIER", 1.2))
+
+# Seconds a cached gas estimate is used before it is re-estimated
+GAS_ESTIMATE_TTL = float(os.getenv("GAS_ESTIMATE_TTL", 600))
+
+# Number of uses after which a cached gas estimate is re-estimated
+GAS_ESTIMATE_REVALIDATE_EVERY = int(os.getenv("GAS_ESTIMATE_REVALIDATE_EVERY", 500))
+
+# "auto" uses EIP-1559 fees when the chain reports a base fee, "legacy" always uses gasPrice
+FEE_MODE = os.getenv("FEE_MODE", "auto")
+
+# Seconds between background fee refreshes
+FEE_REFRESH_INTERVAL = float(os.getenv("FEE_REFRESH_INTERVAL", 12))
+
+# Cached fees older than this are refreshed inline before use
+FEE_MAX_AGE = float(os.getenv("FEE_MAX_AGE", 60))
+
+# Multiplier on the base fee for maxFeePerGas, leaves room for base fee increases
+FEE_BASE_FEE_MULTIPLIER = float(os.getenv("FEE_BASE_FEE_MULTIPLIER", 2))
+
+def calldata_bucket(calldata):
+    """Size bucket of calldata in 32-byte words, gas use is the same within a bucket"""
+    size = (len(calldata) - 2) // 2 if isinstance(calldata, str) else len(calldata)
+    return (size + 31) // 32
+
+class GasEstimateCache:
+    """Gas estimates cached per function and calldata size bucket"""
+
+    def __init__(self, multiplier=GAS_BUFFER_MULTIPLIER, ttl=GAS_ESTIMATE_TTL,
+                 revalidate_every=GAS_ESTIMATE_REVALIDATE_EVERY):
+        self.multiplier = multiplier
+        self.ttl = ttl
+        self.revalidate_every = revalidate_every
+
+        self._lock = threading.Lock()
+        # key -> [estimate, estimated_at, uses]
+        self._entries = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def gas_limit(self, function_key, calldata, estimate_gas):
+        """Get a buffered gas limit, calling estimate_gas() only when the cache has no fresh estimate"""
+        key = (function_key, calldata_bucket(calldata))
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[1] < self.ttl and entry[2] < self.revalidate_every:
+                entry[2] += 1
+                self.hits += 1
+                return int(entry[0] * self.multiplier)
+            self.misses += 1
+
+        estimate = estimate_gas()
+
+        with self._lock:
+            self._entries[key] = [estimate, now, 1]
+
+        return int(estimate * self.multiplier)
+
+    def invalidate(self, function_key=None):
+        """Drop cached estimates, for one function or all of them"""
+        with self._lock:
+            if function_key is None:
+                self._entries.clear()
+            else:
+                for key in [key for key in self._entries if key[0] == function_key]:
+                    del self._entries[key]
+
+    def stats(self):
+        """Get hit/miss counters of the gas estimate cache"""
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+class FeeOracle:
+    """Background-refreshed gas price and EIP-1559 fee oracle"""
+
+    def __init__(self, mode=FEE_MODE, refresh_interval=FEE_REFRESH_INTERVAL, max_age=FEE_MAX_AGE):
+        self.mode = mode
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+
+        self._lock = threading.Lock()
+        self._fees = None
+        self._updated_at = None
+
+        self._thread = None
+        self._stop = threading.Event()
+
+    def refresh(self, web3):
+        """Fetch current fees from the node"""
+        fees = None
+        if self.mode != "legacy":
+            base_fee = web3.eth.get_block('latest').get('baseFeePerGas')
+            if base_fee is not None:
+                priority_fee = web3.eth.max_priority_fee
+                fees = {
+                    'maxPriorityFeePerGas': priority_fee,
+                    'maxFeePerGas': int(base_fee * FEE_BASE_FEE_MULTIPLIER) + priority_fee,
+                }
+
+        if fees is None:
+            fees = {'gasPrice': web3.eth.gas_price}
+
+        with self._lock:
+            self._fees = fees
+            self._updated_at = time.monotonic()
+
+        return dict(fees)
+
+    def fees(self, web3):
+        """Get fee fields for a transaction, refreshing inline only if the cached ones are too old"""
+        with self._lock:
+            if self._fees is not None and time.monotonic() - self._updated_at < self.max_age:
+                return dict(self._fees)
+        return self.refresh(web3)
+
+    def start(self, web3):
+        """Start refreshing fees in the background"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(web3,), name="fee-oracle", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background refresh thread"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, web3):
+        while not self._stop.is_set():
+            try:
+                self.refresh(web3)
+            except Exception:
+                # Callers refresh inline once the cached fees are too old
+                pass
+            self._stop.wait(self.refresh_interval)
+
+# Shared caches used by every transaction sent from this process
+gas_estimate_cache = GasEstimateCache()
+fee_oracle = FeeOracle()
@@ -0,0 +1,84 @@
+import re
+
+# Fields extracted per document type. Each field is found at the first occurrence of its
+# highest-priority keyword or pattern, and the value is the text window starting there.
+EXTRACTION_SPECS = {
+    "lease": {
+        "property_address": {"keywords": ["address"], "window": 100},
+        "rent_amount": {"keywords": ["rent"], "window": 50},
+        "lease_term": {"keywords": ["term", "duration"], "window": 50},
+    },
+    "id": {
+        "name": {"keywords": ["name"], "window": 50},
+        "id_number": {"keywords": ["number", "id"], "window": 30},
+        "date_of_birth": {"keywords": ["birth", "dob"], "window": 30},
+    },
+}
+
+class FieldExtractor:
+    """Extraction spec compiled into one case-insensitive matcher that scans the text once"""
+
+    def __init__(self, spec):
+        self.fields = []
+        alternatives = []
+        for field, rules in spec.items():
+            patterns = [re.escape(keyword) for keyword in rules.get("keywords", [])] + rules.get("patterns", [])
+            groups = []
+            for pattern in patterns:
+                group = f"g{len(alternatives)}"
+                alternatives.append(f"(?P<{group}>{pattern})")
+                groups.append(group)
+            self.fields.append((field, groups, rules["window"]))
+
+        # A lookahead matches at every position without consuming text, so keywords inside
+        # other keywords (or overlapping them) are still found
+        self.pattern = re.compile(f"(?=(?:{'|'.join(alternatives)}))", re.IGNORECASE) if alternatives else None
+        self.group_names = [f"g{index}" for index in range(len(alternatives))]
+        # Only the first alternative matching at a position is reported, the others are tested
+        # on their own there, so a keyword starting where another one does is not lost
+        self.group_patterns = {group: re.compile(pattern, re.IGNORECASE)
+                               for group, pattern in zip(self.group_names, alternatives)}
+
+    def _first_hits(self, text):
+        first_seen = {}
+        if self.pattern is not None:
+            for match in self.pattern.finditer(text):
+                start = match.start()
+                for group in self.group_names:
+                    if group not in first_seen and (
+                        group == match.lastgroup or self.group_patterns[group].match(text, start)
+                    ):
+                        first_seen[group] = start
+                if len(first_seen) == len(self.group_names):
+                    break
+        return first_seen
+
+    def extract(self, text):
+        """Fill every field of the spec from one pass over the text"""
+        first_seen = self._first_hits(text)
+
+        extracted_info = {}
+        for field, groups, window in self.fields:
+            for group in groups:
+                if group in first_seen:
+                    start = first_seen[group]
+                    extracted_info[field] = text[start:start + window]
+                    break
+        return extracted_info
+
+    def complete(self, text):
+        """Whether every field has been found with its whole window, so more text cannot add to it"""
+        first_seen = self._first_hits(text)
+        for field, groups, window in self.fields:
+            starts = [first_seen[group] for group in groups if group in first_seen]
+            if not starts or len(text) - min(starts) < window:
+                return False
+        return True
+
+# Compiled once at import, shared by every request
+extractors = {document_type: FieldExtractor(spec) for document_type, spec in EXTRACTION_SPECS.items()}
+
+def extract_fields(document_type, text):
+    """Extract the fields declared for a document type from a caption or OCR text"""
+    extractor = extractors.get(document_type)
+    return extractor.extract(text) if extractor is not None else {}
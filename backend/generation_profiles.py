@@ -0,0 +1,42 @@
+import os
+
+# Caption generation settings selectable per request. "early_exit" stops generating as soon
+# as every field of the document type has been found, "use_cache" toggles the decoder KV cache.
+GENERATION_PROFILES = {
+    "standard": {"max_length": 100, "num_beams": 1, "use_cache": True},
+    "thorough": {"max_new_tokens": 150, "num_beams": 3, "use_cache": True},
+    "fast": {"max_new_tokens": 60, "num_beams": 1, "use_cache": True, "early_exit": True},
+}
+
+# Profile used when a request does not ask for one, per document type
+DEFAULT_GENERATION_PROFILES = {
+    "lease": os.getenv("LEASE_GENERATION_PROFILE", "standard"),
+    "id": os.getenv("ID_GENERATION_PROFILE", "standard"),
+}
+
+# Inference backends that only decode greedily, without beam search or sampling
+GREEDY_ONLY_BACKENDS = ("onnx",)
+
+def _greedy(settings):
+    return settings.get("num_beams", 1) == 1 and not settings.get("do_sample", False)
+
+def available_profiles(backend):
+    """Names of the profiles requests may ask for on an inference backend"""
+    return [name for name, settings in GENERATION_PROFILES.items()
+            if backend not in GREEDY_ONLY_BACKENDS or _greedy(settings)]
+
+def resolve_profile(document_type, profile=None, backend=None):
+    """Name and settings of the profile to use, raises ValueError for unknown profiles
+    and for profiles the backend cannot run that were asked for explicitly"""
+    name = profile or DEFAULT_GENERATION_PROFILES.get(document_type, "standard")
+    if name not in GENERATION_PROFILES:
+        raise ValueError(f"Unknown generation profile {name!r}, expected one of {', '.join(GENERATION_PROFILES)}")
+    settings = dict(GENERATION_PROFILES[name])
+    if backend in GREEDY_ONLY_BACKENDS and not _greedy(settings):
+        if profile is not None:
+            raise ValueError(f"Generation profile {name!r} is not supported by the {backend} backend, "
+                             f"expected one of {', '.join(available_profiles(backend))}")
+        # A configured default keeps its length limits but decodes greedily
+        settings["num_beams"] = 1
+        settings.pop("do_sample", None)
+    return name, settings
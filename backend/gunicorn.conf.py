@@ -0,0 +1,28 @@
+import gc
+import os
+
+from dotenv import load_dotenv
+
+# Load .env before anything reads settings, the master imports ai_processor in on_starting
+load_dotenv()
+
+wsgi_app = "app:app"
+
+# gunicorn reads WEB_CONCURRENCY and PORT before this file runs, so values from .env are applied here
+workers = int(os.getenv("WEB_CONCURRENCY", 1))
+bind = f"0.0.0.0:{os.environ['PORT']}" if os.getenv("PORT") else "127.0.0.1:8000"
+
+# Model inference can take longer than gunicorn's default 30 seconds
+timeout = 120
+
+def on_starting(server):
+    """Load PRELOAD_MODELS in the master, so workers fork with the weights already in memory"""
+    # The app itself is not preloaded: its scan pool, RPC sessions, database connections and
+    # background threads belong to each worker, which builds them when it imports the app
+    from ai_processor import preload_models, PRELOAD_MODELS
+    if not PRELOAD_MODELS:
+        return
+    preload_models()
+    # Keep the collector from writing to the headers of every loaded object in each worker,
+    # which would give the workers private copies of those pages
+    gc.freeze()
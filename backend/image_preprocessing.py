@@ -0,0 +1,89 @@
+import math
+import os
+from PIL import Image, ImageOps
+from metrics import span
+
+# Uploads with more pixels than this are rejected before they are decoded
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", 100_000_000))
+
+# Longest side uploads are decoded to, JPEGs are decoded at reduced resolution straight from the file
+IMAGE_DECODE_MAX_SIDE = int(os.getenv("IMAGE_DECODE_MAX_SIDE", 2048))
+
+# Pages beyond this are not rasterized, longer PDFs are rejected
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", 50))
+
+class ImageTooLargeError(ValueError):
+    """Raised for uploads whose pixel count exceeds IMAGE_MAX_PIXELS"""
+
+class UnreadableImageError(ValueError):
+    """Raised for uploads whose header cannot be read, so their size cannot be checked before decoding"""
+
+def _rewind(file):
+    if hasattr(file, "seek"):
+        file.seek(0)
+
+def check_image_size(image, max_pixels=IMAGE_MAX_PIXELS):
+    """Reject an opened, not yet decoded image whose pixel count exceeds max_pixels"""
+    width, height = image.size
+    if width * height > max_pixels:
+        raise ImageTooLargeError(f"Image has {width * height} pixels, at most {max_pixels} are accepted")
+
+def decode_image(file, max_side=IMAGE_DECODE_MAX_SIDE, max_pixels=IMAGE_MAX_PIXELS):
+    """Decode an uploaded image to an upright RGB image no larger than max_side on its longest side"""
+    _rewind(file)
+    image = Image.open(file)
+
+    # Only the header has been read so far, so oversized images are rejected without decoding them
+    check_image_size(image, max_pixels)
+    width, height = image.size
+
+    # JPEGs are scaled by 1/2, 1/4 or 1/8 while decoding, which never materializes the full image
+    scale = max_side / max(width, height)
+    if scale < 1:
+        image.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+
+    # Phone photos are stored sideways with an EXIF orientation tag
+    image = ImageOps.exif_transpose(image)
+
+    if max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    return image.convert("RGB")
+
+def is_pdf(file):
+    """Whether an upload or path is a PDF, judged by its magic bytes"""
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "rb") as f:
+            return f.read(5) == b"%PDF-"
+    _rewind(file)
+    header = file.read(5)
+    _rewind(file)
+    return header == b"%PDF-"
+
+def iter_pdf_pages(file, max_side=IMAGE_DECODE_MAX_SIDE, max_pages=PDF_MAX_PAGES):
+    """Rasterize the pages of a PDF one at a time, each no larger than max_side on its longest side"""
+    import pypdfium2
+
+    if isinstance(file, (str, os.PathLike)):
+        document = pypdfium2.PdfDocument(file)
+    else:
+        _rewind(file)
+        document = pypdfium2.PdfDocument(file.read())
+
+    try:
+        if len(document) > max_pages:
+            raise ImageTooLargeError(f"PDF has {len(document)} pages, at most {max_pages} are accepted")
+
+        for index in range(len(document)):
+            page = document[index]
+            try:
+                # Pages are rendered straight at the target size instead of at full resolution
+                with span("pdf_render"):
+                    width, height = page.get_size()
+                    bitmap = page.render(scale=max_side / max(width, height))
+                    image = bitmap.to_pil().convert("RGB")
+                yield image
+            finally:
+                page.close()
+    finally:
+        document.close()
@@ -0,0 +1,223 @@
+import argparse
+import json
+import os
+import re
+import statistics
+import time
+import numpy as np
+import torch
+from PIL import Image
+
+# How the document analysis model runs: "fp32", "int8" (dynamic quantization of linear layers) or "onnx"
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "fp32")
+
+# Intra-op threads used by torch and ONNX Runtime, 0 keeps the library default (one per core)
+INFERENCE_THREADS = int(os.getenv("INFERENCE_THREADS", 0))
+
+# Inter-op threads used by torch and ONNX Runtime, 0 keeps the library default
+INFERENCE_INTEROP_THREADS = int(os.getenv("INFERENCE_INTEROP_THREADS", 0))
+
+# Where exported ONNX graphs are kept so they are only exported once per model
+ONNX_EXPORT_DIR = os.getenv(
+    "ONNX_EXPORT_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'onnx_models')
+)
+
+INFERENCE_BACKENDS = ("fp32", "int8", "onnx")
+
+_threads_configured = False
+
+def configure_threads():
+    """Apply INFERENCE_THREADS and INFERENCE_INTEROP_THREADS to torch, once per process"""
+    global _threads_configured
+    if _threads_configured:
+        return
+    if INFERENCE_THREADS > 0:
+        torch.set_num_threads(INFERENCE_THREADS)
+    if INFERENCE_INTEROP_THREADS > 0:
+        try:
+            torch.set_num_interop_threads(INFERENCE_INTEROP_THREADS)
+        except RuntimeError:
+            # Torch only allows this before its first parallel operation
+            pass
+    _threads_configured = True
+
+def quantize_int8(model):
+    """Quantize the linear layers of a model to int8, activations are quantized on the fly"""
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+class _VisionEncoder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.vision_model = model.vision_model
+
+    def forward(self, pixel_values):
+        return self.vision_model(pixel_values=pixel_values, return_dict=False)[0]
+
+class _TextDecoder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.text_decoder = model.text_decoder
+
+    def forward(self, input_ids, attention_mask, encoder_hidden_states):
+        return self.text_decoder(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            encoder_hidden_states=encoder_hidden_states,
+            use_cache=False,
+            return_dict=False,
+        )[0]
+
+def export_onnx(model, export_dir):
+    """Export the vision encoder and text decoder of a BLIP captioning model to ONNX"""
+    os.makedirs(export_dir, exist_ok=True)
+    encoder_path = os.path.join(export_dir, "vision_encoder.onnx")
+    decoder_path = os.path.join(export_dir, "text_decoder.onnx")
+
+    vision_config = model.config.vision_config
+    pixel_values = torch.zeros(1, 3, vision_config.image_size, vision_config.image_size)
+    with torch.no_grad():
+        if not os.path.exists(encoder_path):
+            torch.onnx.export(
+                _VisionEncoder(model), (pixel_values,), encoder_path,
+                input_names=["pixel_values"], output_names=["image_embeds"],
+                dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+                opset_version=14,
+            )
+
+        if not os.path.exists(decoder_path):
+            image_embeds = model.vision_model(pixel_values=pixel_values, return_dict=False)[0]
+            input_ids = torch.full((1, 2), model.config.text_config.bos_token_id, dtype=torch.long)
+            torch.onnx.export(
+                _TextDecoder(model), (input_ids, torch.ones_like(input_ids), image_embeds), decoder_path,
+                input_names=["input_ids", "attention_mask", "encoder_hidden_states"], output_names=["logits"],
+                dynamic_axes={
+                    "input_ids": {0: "batch", 1: "sequence"},
+                    "attention_mask": {0: "batch", 1: "sequence"},
+                    "encoder_hidden_states": {0: "batch"},
+                    "logits": {0: "batch", 1: "sequence"},
+                },
+                opset_version=14,
+            )
+
+    return encoder_path, decoder_path
+
+class OnnxCaptionModel:
+    """BLIP captioning on ONNX Runtime with greedy decoding, a drop-in for model.generate()"""
+
+    def __init__(self, encoder_path, decoder_path, text_config):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if INFERENCE_THREADS > 0:
+            options.intra_op_num_threads = INFERENCE_THREADS
+        if INFERENCE_INTEROP_THREADS > 0:
+            options.inter_op_num_threads = INFERENCE_INTEROP_THREADS
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        providers = ["CPUExecutionProvider"]
+        self.encoder = onnxruntime.InferenceSession(encoder_path, options, providers=providers)
+        self.decoder = onnxruntime.InferenceSession(decoder_path, options, providers=providers)
+        # Weights are held by the sessions, roughly the size of the exported graphs
+        self.footprint_bytes = os.path.getsize(encoder_path) + os.path.getsize(decoder_path)
+
+        self.bos_token_id = text_config.bos_token_id
+        self.eos_token_id = text_config.sep_token_id
+        self.pad_token_id = text_config.pad_token_id
+
+    def generate(self, pixel_values, max_length=20, max_new_tokens=None, num_beams=1, do_sample=False,
+                 use_cache=True, stopping_criteria=None):
+        if num_beams != 1 or do_sample:
+            raise ValueError("The onnx backend only supports greedy decoding")
+
+        image_embeds = self.encoder.run(None, {"pixel_values": pixel_values.numpy()})[0]
+
+        batch_size = image_embeds.shape[0]
+        input_ids = np.full((batch_size, 1), self.bos_token_id, dtype=np.int64)
+        finished = np.zeros(batch_size, dtype=bool)
+        max_length = 1 + max_new_tokens if max_new_tokens is not None else max_length
+
+        # The decoder is exported without a KV cache, so every step re-reads the whole prefix
+        # whatever use_cache asks for
+        while input_ids.shape[1] < max_length and not finished.all():
+            logits = self.decoder.run(None, {
+                "input_ids": input_ids,
+                "attention_mask": np.ones_like(input_ids),
+                "encoder_hidden_states": image_embeds,
+            })[0]
+            next_tokens = np.where(finished, self.pad_token_id, logits[:, -1, :].argmax(axis=-1))
+            input_ids = np.concatenate([input_ids, next_tokens[:, None]], axis=1)
+            finished |= next_tokens == self.eos_token_id
+            if stopping_criteria is not None and stopping_criteria(torch.from_numpy(input_ids), None):
+                break
+
+        return torch.from_numpy(input_ids)
+
+def _export_dir(model_name):
+    return os.path.join(ONNX_EXPORT_DIR, re.sub(r"[^A-Za-z0-9_.-]+", "--", model_name.strip("/")))
+
+def prepare_document_model(model, model_name, backend=INFERENCE_BACKEND):
+    """Turn a loaded fp32 captioning model into the configured inference backend"""
+    configure_threads()
+    if backend == "fp32":
+        return model
+    if backend == "int8":
+        return quantize_int8(model)
+    if backend == "onnx":
+        encoder_path, decoder_path = export_onnx(model, _export_dir(model_name))
+        return OnnxCaptionModel(encoder_path, decoder_path, model.config.text_config)
+    raise ValueError(f"Unknown inference backend {backend!r}, expected one of {', '.join(INFERENCE_BACKENDS)}")
+
+def compare_backends(load_model, images, backends=("int8", "onnx"), repeat=3, **generate_kwargs):
+    """Caption the same images with fp32 and each backend, and compare captions and timings"""
+    results = {}
+    baseline = None
+    for backend in ("fp32",) + tuple(backend for backend in backends if backend != "fp32"):
+        started = time.perf_counter()
+        processor, model = load_model(backend)
+        load_seconds = time.perf_counter() - started
+
+        inputs = processor(images=images, return_tensors="pt")
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            with torch.no_grad():
+                outputs = model.generate(**inputs, **generate_kwargs)
+            timings.append(time.perf_counter() - started)
+        captions = processor.batch_decode(outputs, skip_special_tokens=True)
+
+        result = {
+            'load_seconds': round(load_seconds, 3),
+            'median_seconds': round(statistics.median(timings), 4),
+            'captions': captions,
+        }
+        if baseline is None:
+            baseline = result
+        else:
+            result['caption_match_ratio'] = sum(
+                caption == expected for caption, expected in zip(captions, baseline['captions'])
+            ) / len(captions)
+            result['speedup'] = round(baseline['median_seconds'] / result['median_seconds'], 2)
+        results[backend] = result
+
+        del model
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare captions and timings of inference backends against fp32")
+    parser.add_argument("images", nargs="+", help="Document images to caption")
+    parser.add_argument("--backends", nargs="+", default=["int8", "onnx"], choices=INFERENCE_BACKENDS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-length", type=int, default=100)
+    args = parser.parse_args()
+
+    from ai_processor import get_document_analysis_model
+
+    parity = compare_backends(
+        get_document_analysis_model,
+        [Image.open(path).convert("RGB") for path in args.images],
+        backends=args.backends,
+        repeat=args.repeat,
+        max_length=args.max_length,
+    )
+    print(json.dumps(parity, indent=2))
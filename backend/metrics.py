@@ -0,0 +1,168 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+
+# Record stage timings and request metrics, 0 turns every span into a no-op
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class Histogram:
+    """Fixed-bucket histogram of observed values"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # One count per bucket, plus one for values above the last bound
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0
+        self._count = 0
+
+    def observe(self, value):
+        with self._lock:
+            self._counts[bisect_left(self.buckets, value)] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self):
+        """Per-bucket counts keyed by upper bound, with "+Inf" for the overflow bucket"""
+        with self._lock:
+            buckets = {str(bound): count for bound, count in zip(self.buckets, self._counts)}
+            buckets["+Inf"] = self._counts[-1]
+            return {'buckets': buckets, 'sum': self._sum, 'count': self._count}
+
+class Counter:
+    """Monotonic counter"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+class _Span:
+    __slots__ = ("histogram", "errors", "started")
+
+    def __init__(self, histogram, errors):
+        self.histogram = histogram
+        self.errors = errors
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.histogram.observe(time.perf_counter() - self.started)
+        if exc_type is not None:
+            self.errors.inc()
+        return False
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+class MetricsRegistry:
+    """Histograms and counters by name and labels, rendered in the Prometheus text format"""
+
+    def __init__(self, enabled=METRICS_ENABLED, prefix="smartcon"):
+        self.enabled = enabled
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        # name -> {"type", "help", "series": {labels: Histogram or Counter}}
+        self._families = {}
+        # stage -> (duration histogram, error counter), looked up on every span
+        self._stages = {}
+
+    def _series(self, kind, name, help_text, labels, factory):
+        key = tuple(sorted(labels.items()))
+        family = self._families.get(name)
+        if family is not None:
+            series = family["series"].get(key)
+            if series is not None:
+                return series
+        with self._lock:
+            family = self._families.setdefault(name, {"type": kind, "help": help_text, "series": {}})
+            return family["series"].setdefault(key, factory())
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS, **labels):
+        """Histogram of one label combination, created on first use"""
+        return self._series("histogram", f"{self.prefix}_{name}", help_text, labels, lambda: Histogram(buckets))
+
+    def counter(self, name, help_text, **labels):
+        """Counter of one label combination, created on first use"""
+        return self._series("counter", f"{self.prefix}_{name}", help_text, labels, Counter)
+
+    def span(self, stage):
+        """Context manager timing one stage into stage_duration_seconds, exceptions count as stage errors"""
+        if not self.enabled:
+            return _NO_SPAN
+        metrics = self._stages.get(stage)
+        if metrics is None:
+            metrics = self._stages[stage] = (
+                self.histogram("stage_duration_seconds", "Time spent per processing stage", stage=stage),
+                self.counter("stage_errors_total", "Processing stages that raised", stage=stage),
+            )
+        return _Span(*metrics)
+
+    def stage_totals(self):
+        """Count and total seconds per stage so far, subtract two of these to time a stretch of work"""
+        totals = {}
+        for stage, (histogram, _) in list(self._stages.items()):
+            snapshot = histogram.snapshot()
+            totals[stage] = (snapshot['count'], snapshot['sum'])
+        return totals
+
+    def observe_request(self, endpoint, method, status, seconds):
+        """Record one served HTTP request"""
+        if not self.enabled:
+            return
+        self.histogram("http_request_duration_seconds", "Time to handle HTTP requests", endpoint=endpoint).observe(seconds)
+        self.counter("http_requests_total", "HTTP requests handled", endpoint=endpoint, method=method,
+                     status=status).inc()
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            families = [(name, family["type"], family["help"], list(family["series"].items()))
+                        for name, family in sorted(self._families.items())]
+
+        lines = []
+        for name, kind, help_text, series in families:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in sorted(series, key=lambda item: item[0]):
+                if kind == "counter":
+                    lines.append(f"{name}{_format_labels(labels)} {metric.value}")
+                    continue
+                snapshot = metric.snapshot()
+                cumulative = 0
+                for bound, count in snapshot["buckets"].items():
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {snapshot['sum']}")
+                lines.append(f"{name}_count{_format_labels(labels)} {snapshot['count']}")
+        return "\n".join(lines) + "\n"
+
+# Shared by every module of the process
+metrics = MetricsRegistry()
+span = metrics.span
@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+import torch
+
+# RAM in MB the loaded models may use together, least recently used models are evicted beyond it, 0 for no limit
+MODEL_MEMORY_BUDGET_MB = float(os.getenv("MODEL_MEMORY_BUDGET_MB", 0))
+
+def model_footprint(model, _seen=None):
+    """Bytes held by the weights of a loaded model, including any (processor, model) tuple around it"""
+    seen = set() if _seen is None else _seen
+    if isinstance(model, torch.Tensor):
+        # Tied weights show up under several names but only take memory once
+        if model.data_ptr() in seen:
+            return 0
+        seen.add(model.data_ptr())
+        return model.numel() * model.element_size()
+    if isinstance(model, torch.nn.Module):
+        return model_footprint(list(model.state_dict().values()), seen)
+    if isinstance(model, (tuple, list)):
+        return sum(model_footprint(item, seen) for item in model)
+    return getattr(model, "footprint_bytes", 0)
+
+class _RegisteredModel:
+    def __init__(self, name, loader, estimated_bytes, warm_up):
+        self.name = name
+        self.loader = loader
+        self.estimated_bytes = estimated_bytes
+        self.warm_up = warm_up
+        self.load_lock = threading.Lock()
+
+        self.model = None
+        self.resident_bytes = None
+        self.load_seconds = None
+        self.loads = 0
+        self.evictions = 0
+        self.uses = 0
+        self.last_used = None
+
+    @property
+    def expected_bytes(self):
+        # Once a model has been loaded its measured size is a better guess than the declared one
+        return self.resident_bytes if self.resident_bytes is not None else self.estimated_bytes
+
+class ModelRegistry:
+    """Models loaded on first use and evicted least recently used when over a memory budget"""
+
+    def __init__(self, budget_mb=MODEL_MEMORY_BUDGET_MB):
+        self.budget_bytes = int(budget_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._models = {}
+
+    def register(self, name, loader, estimated_mb, warm_up=None):
+        """Declare a model with its estimated footprint, nothing is loaded yet"""
+        self._models[name] = _RegisteredModel(name, loader, int(estimated_mb * 1024 * 1024), warm_up)
+
+    def get(self, name):
+        """Get a model, loading it (and evicting others if needed) on first use"""
+        entry = self._models[name]
+        model = entry.model
+        if model is None:
+            # One lock per model so concurrent first requests load it once instead of once per thread
+            with entry.load_lock:
+                model = entry.model
+                if model is None:
+                    self._make_room(entry)
+                    started = time.perf_counter()
+                    model = entry.loader()
+                    with self._lock:
+                        entry.load_seconds = time.perf_counter() - started
+                        entry.resident_bytes = model_footprint(model)
+                        entry.loads += 1
+                        entry.model = model
+
+        with self._lock:
+            entry.uses += 1
+            entry.last_used = time.monotonic()
+        return model
+
+    def warm_up(self, name):
+        """Load a model and run its warm-up inference"""
+        model = self.get(name)
+        if self._models[name].warm_up is not None:
+            self._models[name].warm_up(model)
+
+    def _make_room(self, incoming):
+        if not self.budget_bytes:
+            return
+        with self._lock:
+            loaded = sorted(
+                (entry for entry in self._models.values() if entry.model is not None and entry is not incoming),
+                key=lambda entry: entry.last_used or 0
+            )
+            used = sum(entry.resident_bytes for entry in loaded)
+            # Requests still holding an evicted model keep it alive until they finish
+            while loaded and used + incoming.expected_bytes > self.budget_bytes:
+                entry = loaded.pop(0)
+                used -= entry.resident_bytes
+                entry.model = None
+                entry.evictions += 1
+
+    def evict(self, name):
+        """Drop a loaded model, it is loaded again on its next use"""
+        with self._lock:
+            entry = self._models[name]
+            if entry.model is not None:
+                entry.model = None
+                entry.evictions += 1
+
+    def stats(self):
+        """Per-model load time, resident size and usage counts"""
+        with self._lock:
+            models = {
+                name: {
+                    'loaded': entry.model is not None,
+                    'estimated_mb': round(entry.estimated_bytes / 1024 / 1024, 1),
+                    'resident_mb': None if entry.resident_bytes is None else round(entry.resident_bytes / 1024 / 1024, 1),
+                    'load_seconds': None if entry.load_seconds is None else round(entry.load_seconds, 3),
+                    'loads': entry.loads,
+                    'evictions': entry.evictions,
+                    'uses': entry.uses,
+                }
+                for name, entry in self._models.items()
+            }
+            resident = sum(entry.resident_bytes for entry in self._models.values() if entry.model is not None)
+        return {
+            'budget_mb': round(self.budget_bytes / 1024 / 1024, 1) if self.budget_bytes else None,
+            'resident_mb': round(resident / 1024 / 1024, 1),
+            'models': models,
+        }
@@ -0,0 +1,100 @@
+import threading
+
+# Fragments of node error messages that mean our local view of a signer's
+# nonce no longer matches the chain
+NONCE_ERROR_MESSAGES = (
+    "nonce too low",
+    "nonce too high",
+    "invalid nonce",
+    "replacement transaction underpriced",
+)
+
+def is_nonce_error(error):
+    """Check whether a send error was caused by a stale nonce"""
+    message = str(error).lower()
+    return any(fragment in message for fragment in NONCE_ERROR_MESSAGES)
+
+# Fragments of node error messages that mean the node already has this exact
+# transaction, so it was broadcast after all
+KNOWN_TRANSACTION_MESSAGES = (
+    "already known",
+    "known transaction",
+    "already imported",
+    "already in mempool",
+)
+
+def is_known_transaction_error(error):
+    """Check whether a send error means the transaction had already been received"""
+    message = str(error).lower()
+    return any(fragment in message for fragment in KNOWN_TRANSACTION_MESSAGES)
+
+class _SignerState:
+    """Nonce bookkeeping for a single signer address"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Next nonce to hand out, None until synced from the chain
+        self.next_nonce = None
+        # Nonces below next_nonce that were handed out but never broadcast
+        self.released = set()
+
+class NonceManager:
+    """Thread-safe in-process nonce allocator keyed by signer address"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._signers = {}
+
+    def _signer(self, address):
+        with self._lock:
+            return self._signers.setdefault(address.lower(), _SignerState())
+
+    def _sync(self, web3, address, state):
+        # Include transactions still in the mempool so we never reuse their nonces
+        state.next_nonce = web3.eth.get_transaction_count(address, 'pending')
+        state.released.clear()
+
+    def allocate(self, web3, address, count=1):
+        """Reserve count consecutive nonces for address and return the first one"""
+        state = self._signer(address)
+        with state.lock:
+            if state.next_nonce is None:
+                self._sync(web3, address, state)
+
+            # Fill gaps left by transactions that were never broadcast first
+            if count == 1 and state.released:
+                nonce = min(state.released)
+                state.released.remove(nonce)
+                return nonce
+
+            nonce = state.next_nonce
+            state.next_nonce += count
+            return nonce
+
+    def release(self, address, nonce, count=1):
+        """Give back nonces that were allocated but never broadcast"""
+        state = self._signer(address)
+        with state.lock:
+            if state.next_nonce is None:
+                return
+
+            for released_nonce in sorted(range(nonce, nonce + count), reverse=True):
+                if released_nonce == state.next_nonce - 1:
+                    state.next_nonce -= 1
+                elif released_nonce < state.next_nonce:
+                    state.released.add(released_nonce)
+
+            # Collapse released nonces that now sit directly below next_nonce
+            while state.next_nonce - 1 in state.released:
+                state.released.remove(state.next_nonce - 1)
+                state.next_nonce -= 1
+
+    def reset(self, address):
+        """Forget local state so the next allocation re-syncs from the chain"""
+        state = self._signer(address)
+        with state.lock:
+            state.next_nonce = None
+            state.released.clear()
+
+# Shared allocator used by every transaction sent from this process
+nonce_manager = NonceManager()
@@ -1,65 +1,404 @@
+import hashlib
+import io
+import multiprocessing
 import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import qrcode
-import uuid
 from PIL import Image
-from pyzbar.pyzbar import decode
+from pyzbar.pyzbar import decode, ZBarSymbol
 import numpy as np
 import cv2
+from image_preprocessing import check_image_size, ImageTooLargeError, UnreadableImageError
+from metrics import span
 
 # Directory to store QR codes
-QR_CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'qr_codes')
+QR_CODE_DIR = os.getenv("QR_CODE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'qr_codes'))
+
+# Also write every rendered PNG to QR_CODE_DIR, QR codes are otherwise only kept in memory
+QR_WRITE_TO_DISK = os.getenv("QR_WRITE_TO_DISK", "0") == "1"
+
+# Days a QR code written to disk is kept
+QR_RETENTION_DAYS = float(os.getenv("QR_RETENTION_DAYS", 30))
+
+# Where QR code payloads are stored by hash, so every issued /api/qr URL renders in any process and after restarts
+QR_PAYLOAD_DB = os.getenv(
+    "QR_PAYLOAD_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'qr_codes.db')
+)
+
+# Days a stored QR code payload is kept, a year by default like the caching of /api/qr responses
+QR_PAYLOAD_RETENTION_DAYS = float(os.getenv("QR_PAYLOAD_RETENTION_DAYS", 365))
+
+# Rendered QR codes kept in memory
+QR_CACHE_SIZE = int(os.getenv("QR_CACHE_SIZE", 4096))
+
+# Error correction level (L, M, Q or H), module size in pixels and quiet zone in modules
+QR_ERROR_CORRECTION = os.getenv("QR_ERROR_CORRECTION", "L")
+QR_BOX_SIZE = int(os.getenv("QR_BOX_SIZE", 10))
+QR_BORDER = int(os.getenv("QR_BORDER", 4))
+
+# Longest side of the first, downscaled scanning pass
+QR_SCAN_FAST_SIDE = int(os.getenv("QR_SCAN_FAST_SIDE", 1024))
+
+# Processes used by batch scanning, per app process
+QR_SCAN_WORKERS = int(os.getenv("QR_SCAN_WORKERS", 2))
+
+REDUCED_GRAYSCALE_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+QR_FORMATS = {"png": "image/png", "svg": "image/svg+xml"}
+
+ERROR_CORRECTION_LEVELS = {
+    "L": qrcode.constants.ERROR_CORRECT_L,
+    "M": qrcode.constants.ERROR_CORRECT_M,
+    "Q": qrcode.constants.ERROR_CORRECT_Q,
+    "H": qrcode.constants.ERROR_CORRECT_H,
+}
 
 # Create directory if it doesn't exist
-os.makedirs(QR_CODE_DIR, exist_ok=True)
+if QR_WRITE_TO_DISK:
+    os.makedirs(QR_CODE_DIR, exist_ok=True)
 
-def generate_qr_code(data, filename=None):
-    """Generate a QR code from data and save it to a file"""
-    if filename is None:
-        filename = f"{uuid.uuid4()}.png"
-    
-    # Create full path
-    filepath = os.path.join(QR_CODE_DIR, filename)
-    
-    # Generate QR code
+def qr_code_hash(data):
+    """Content address of a QR code, covering the payload and the render settings"""
+    settings = f"{QR_ERROR_CORRECTION}:{QR_BOX_SIZE}:{QR_BORDER}"
+    return hashlib.sha256(f"{settings}\0{data}".encode()).hexdigest()
+
+def qr_matrix(data):
+    """Module matrix of a QR code, including the quiet zone, at the smallest version that fits"""
     qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
+        version=None,
+        error_correction=ERROR_CORRECTION_LEVELS[QR_ERROR_CORRECTION],
+        box_size=QR_BOX_SIZE,
+        border=QR_BORDER,
     )
     qr.add_data(data)
     qr.make(fit=True)
-    
-    # Create an image from the QR Code instance
-    img = qr.make_image(fill_color="black", back_color="white")
-    
-    # Save the image
-    img.save(filepath)
-    
-    return filepath
+    return qr.get_matrix()
+
+def fits_in_qr_code(data):
+    """Whether data fits in the largest QR code version at the configured error correction"""
+    qr = qrcode.QRCode(version=None, error_correction=ERROR_CORRECTION_LEVELS[QR_ERROR_CORRECTION])
+    qr.add_data(data)
+    try:
+        qr.best_fit()
+    except (ValueError, qrcode.exceptions.DataOverflowError):
+        return False
+    return True
+
+def render_png(matrix, box_size=QR_BOX_SIZE):
+    """Render a module matrix as a 1-bit PNG"""
+    modules = np.array(matrix, dtype=bool)
+    image = Image.fromarray(~modules).resize(
+        (modules.shape[1] * box_size, modules.shape[0] * box_size), Image.NEAREST
+    )
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG", optimize=True)
+    return buffer.getvalue()
+
+def render_svg(matrix):
+    """Render a module matrix as an SVG with one path, each horizontal run of dark modules is one rectangle"""
+    size = len(matrix)
+    runs = []
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < size:
+            if row[x]:
+                start = x
+                while x < size and row[x]:
+                    x += 1
+                runs.append(f"M{start} {y}h{x - start}v1h{start - x}z")
+            else:
+                x += 1
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {size} {size}" shape-rendering="crispEdges">'
+        f'<path fill="#fff" d="M0 0h{size}v{size}H0z"/><path d="{"".join(runs)}"/></svg>'
+    ).encode()
+
+class QRCodeCache:
+    """Rendered QR codes kept in memory by content address, identical payloads are rendered once.
+    Payloads are also stored in SQLite, so codes evicted from memory or issued by another process still render."""
+
+    def __init__(self, max_size=QR_CACHE_SIZE, directory=QR_CODE_DIR, write_to_disk=QR_WRITE_TO_DISK,
+                 retention_days=QR_RETENTION_DAYS, db_path=QR_PAYLOAD_DB,
+                 payload_retention_days=QR_PAYLOAD_RETENTION_DAYS):
+        self.max_size = max_size
+        self.directory = directory
+        self.write_to_disk = write_to_disk
+        self.retention_seconds = retention_days * 24 * 3600
+        self.payload_retention_seconds = payload_retention_days * 24 * 3600
+
+        self._lock = threading.Lock()
+        # qr_hash -> {"data": payload, "matrix": modules, "png": bytes, "svg": bytes}
+        self._entries = OrderedDict()
+        self._last_cleanup = 0
+
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS qr_payloads (
+                qr_hash TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS qr_payloads_created_at ON qr_payloads (created_at)")
+        self._conn.commit()
+
+        self.hits = 0
+        self.renders = 0
+
+    def add(self, data):
+        """Register a payload and return its content address, nothing is rendered yet"""
+        qr_hash = qr_code_hash(data)
+        with self._lock:
+            known = qr_hash in self._entries
+            if known:
+                self._entries.move_to_end(qr_hash)
+            else:
+                self._remember(qr_hash, data)
+
+        if not known:
+            # Stored before the URL is handed out, so it never points at a payload that is gone
+            with self._db_lock:
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO qr_payloads (qr_hash, data, created_at) VALUES (?, ?, ?)",
+                    (qr_hash, data, time.time())
+                )
+                self._conn.commit()
+
+        if self.write_to_disk:
+            self.save(qr_hash)
+        else:
+            self.cleanup()
+        return qr_hash
+
+    def _remember(self, qr_hash, data):
+        # Called with the lock held
+        entry = self._entries[qr_hash] = {"data": data}
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return entry
+
+    def get(self, qr_hash, fmt="png"):
+        """Rendered bytes of a registered QR code, or None if it is unknown"""
+        with self._lock:
+            entry = self._entries.get(qr_hash)
+            if entry is not None:
+                self._entries.move_to_end(qr_hash)
+                if fmt in entry:
+                    self.hits += 1
+                    return entry[fmt]
+
+        if entry is None:
+            # Evicted from memory or registered by another process, PNGs written to disk can be served as they are
+            path = self.path(qr_hash)
+            if fmt == "png" and self.write_to_disk and os.path.exists(path):
+                with open(path, "rb") as f:
+                    return f.read()
+            with self._db_lock:
+                row = self._conn.execute("SELECT data FROM qr_payloads WHERE qr_hash = ?", (qr_hash,)).fetchone()
+            if row is None:
+                return None
+            with self._lock:
+                entry = self._entries.get(qr_hash) or self._remember(qr_hash, row[0])
+
+        # Rendering happens outside the lock, a concurrent render of the same code is harmless
+        with span("qr_encode"):
+            matrix = entry.get("matrix") or qr_matrix(entry["data"])
+        with span("qr_render"):
+            rendered = render_png(matrix) if fmt == "png" else render_svg(matrix)
+        with self._lock:
+            entry["matrix"] = matrix
+            entry[fmt] = rendered
+            self.renders += 1
+        return rendered
+
+    def path(self, qr_hash):
+        return os.path.join(self.directory, f"{qr_hash}.png")
+
+    def save(self, qr_hash):
+        """Write the PNG of a QR code to disk once, and apply the retention policy"""
+        path = self.path(qr_hash)
+        if not os.path.exists(path):
+            png = self.get(qr_hash, "png")
+            temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary_path, "wb") as f:
+                f.write(png)
+            os.replace(temporary_path, path)
+        self.cleanup()
+        return path
+
+    def cleanup(self, force=False):
+        """Delete QR codes older than the retention periods from disk and the payload store,
+        at most once an hour unless forced"""
+        now = time.time()
+        if not force and now - self._last_cleanup < 3600:
+            return
+        self._last_cleanup = now
+
+        with self._db_lock:
+            self._conn.execute("DELETE FROM qr_payloads WHERE created_at < ?", (now - self.payload_retention_seconds,))
+            self._conn.commit()
+
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith(".png") and now - os.path.getmtime(path) > self.retention_seconds:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        """Get hit/render counters of the QR code cache"""
+        with self._lock:
+            return {'size': len(self._entries), 'max_size': self.max_size, 'hits': self.hits, 'renders': self.renders}
+
+# Shared cache of QR codes served by /api/qr/<qr_hash>
+qr_code_cache = QRCodeCache()
+
+def generate_qr_code(data, filename=None):
+    """Generate a QR code from data, returns its content address and, if written to disk, its file path"""
+    with span("qr_generate"):
+        qr_hash = qr_code_cache.add(data)
+        if filename is not None:
+            # An explicit file name is always written, outside the retention policy
+            filepath = os.path.join(QR_CODE_DIR, filename)
+            os.makedirs(QR_CODE_DIR, exist_ok=True)
+            with open(filepath, "wb") as f:
+                f.write(qr_code_cache.get(qr_hash, "png"))
+            return qr_hash, filepath
+        return qr_hash, qr_code_cache.path(qr_hash) if QR_WRITE_TO_DISK else None
+
+def _upload_bytes(image_file):
+    if isinstance(image_file, (str, os.PathLike)):
+        with open(image_file, "rb") as f:
+            return f.read()
+    image_file.seek(0)
+    data = image_file.read()
+    image_file.seek(0)
+    return data
+
+def _decode_gray(data, reduction=1):
+    # JPEGs decoded with a reduced flag are scaled down inside the decoder
+    with span("qr_decode"):
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), REDUCED_GRAYSCALE_FLAGS[reduction])
+    if image is None:
+        raise ValueError("Unable to decode image")
+    return image
+
+def _fit(gray, max_side):
+    scale = max_side / max(gray.shape)
+    if scale >= 1:
+        return gray
+    return cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+def _zbar(gray):
+    return [symbol.data.decode('utf-8') for symbol in decode(gray, symbols=[ZBarSymbol.QRCODE])]
+
+def _opencv(gray):
+    found, texts, _, _ = cv2.QRCodeDetector().detectAndDecodeMulti(gray)
+    return [text for text in texts if text] if found else []
+
+def _scan(fast_gray, full_gray):
+    """Run the cheapest pass first and only fall back to the slower ones when nothing was found"""
+    with span("qr_scan_fast"):
+        results = _zbar(fast_gray)
+    if results:
+        return results
+
+    full = full_gray()
+    passes = []
+    if full.shape != fast_gray.shape:
+        passes.append(lambda: _zbar(full))
+    if max(full.shape) < QR_SCAN_FAST_SIDE:
+        # Small codes in small images decode better with bigger modules
+        passes.append(lambda: _zbar(cv2.resize(full, None, fx=2, fy=2, interpolation=cv2.INTER_LINEAR)))
+    passes += [
+        lambda: _zbar(cv2.threshold(full, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]),
+        lambda: _zbar(cv2.adaptiveThreshold(full, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 51, 10)),
+        lambda: _opencv(full),
+    ]
+    with span("qr_scan_fallback"):
+        for scan_pass in passes:
+            results = scan_pass()
+            if results:
+                return results
+    return []
+
+def scan_qr_bytes(data):
+    """Scan every QR code in an encoded image, decoding it straight to grayscale"""
+    # Only the header is read to enforce the pixel limit and pick the reduced decode size
+    try:
+        header = Image.open(io.BytesIO(data))
+    except Exception:
+        # Without a header the pixel limit cannot be enforced, so the image is never decoded
+        raise UnreadableImageError("Unrecognized or corrupt image")
+    check_image_size(header)
+    longest = max(header.size)
+
+    reduction = 1
+    while reduction < 8 and longest / (reduction * 2) >= QR_SCAN_FAST_SIDE:
+        reduction *= 2
+
+    gray = _decode_gray(data, reduction)
+    # The full resolution image is only decoded if the fast pass finds nothing
+    full_gray = (lambda: gray) if reduction == 1 else (lambda: _decode_gray(data))
+    return list(dict.fromkeys(_scan(_fit(gray, QR_SCAN_FAST_SIDE), full_gray)))
+
+def scan_qr_codes(image_file):
+    """Scan every QR code in an image file"""
+    return scan_qr_bytes(_upload_bytes(image_file))
 
 def scan_qr_code(image_file):
     """Scan a QR code from an image file"""
-    # Read the image file
-    if hasattr(image_file, 'read'):
-        # If it's a file-like object (e.g., from request.files)
-        image = Image.open(image_file)
-        image_array = np.array(image)
-    else:
-        # If it's a file path
-        image_array = cv2.imread(image_file)
-    
-    # Convert to grayscale if needed
-    if len(image_array.shape) > 2 and image_array.shape[2] > 1:
-        gray_image = cv2.cvtColor(image_array, cv2.COLOR_BGR2GRAY)
-    else:
-        gray_image = image_array
-    
-    # Decode QR code
-    decoded_objects = decode(gray_image)
+    results = scan_qr_codes(image_file)
     
     # Return data if found
-    if decoded_objects:
-        return decoded_objects[0].data.decode('utf-8')
+    if results:
+        return results[0]
     
-    return None 
\ No newline at end of file
+    return None
+
+def _scan_batch_item(data):
+    try:
+        return {"success": True, "qr_data": scan_qr_bytes(data)}
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+
+def _init_scan_worker():
+    # Parallelism comes from the processes, OpenCV's own thread pool would only oversubscribe the cores
+    cv2.setNumThreads(1)
+
+_scan_pool = None
+_scan_pool_lock = threading.Lock()
+
+def start_scan_pool():
+    """Start the batch scanning processes, call before the app starts background threads"""
+    global _scan_pool
+    with _scan_pool_lock:
+        if _scan_pool is None:
+            # Forked workers only run the decoding functions of this module, so they never
+            # re-import the app as spawned workers would
+            _scan_pool = ProcessPoolExecutor(
+                max_workers=QR_SCAN_WORKERS,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_init_scan_worker,
+            )
+            # Fork every worker now rather than on the first batch
+            _scan_pool.submit(int).result()
+        return _scan_pool
+
+def scan_qr_batch(images):
+    """Scan many encoded images across the scan process pool, one result per image in order"""
+    return list(start_scan_pool().map(_scan_batch_item, images))
@@ -0,0 +1,129 @@
+import base64
+import os
+import struct
+import time
+from functools import lru_cache
+from eth_account import Account
+from eth_account.messages import encode_defunct
+from web3 import Web3
+from metrics import span
+from qr_handler import fits_in_qr_code
+
+# Private key that signs agreement QR codes, QR codes carry plain JSON when unset
+QR_SIGNING_KEY = os.getenv("QR_SIGNING_KEY")
+
+# Comma-separated issuer addresses whose signed QR codes are accepted, defaults to the QR_SIGNING_KEY address
+QR_TRUSTED_ISSUERS = [address.strip() for address in os.getenv("QR_TRUSTED_ISSUERS", "").split(",") if address.strip()]
+
+# Verified payloads kept in memory, so rescans of the same QR code skip signature recovery
+QR_PAYLOAD_CACHE_SIZE = int(os.getenv("QR_PAYLOAD_CACHE_SIZE", 4096))
+
+# Signed payloads are base32 text after this prefix. Base32 without padding only uses characters
+# of the QR alphanumeric mode, which packs them denser than base64 in byte mode.
+PAYLOAD_PREFIX = "SCA1:"
+
+# version, chain ID, contract, agreement ID, landlord, tenant, rent in wei, duration,
+# block number, issued at, length of the property details that follow
+_HEADER = struct.Struct(">BQ20s32s20s20s32sQQQH")
+_VERSION = 1
+_SIGNATURE_SIZE = 65
+
+class InvalidPayloadError(ValueError):
+    """Raised for signed QR payloads that are malformed, tampered with or from an untrusted issuer"""
+
+class PayloadTooLargeError(ValueError):
+    """Raised when an agreement does not fit in a signed payload of one QR code"""
+
+def signing_enabled():
+    """Whether agreement QR codes are issued as signed payloads"""
+    return bool(QR_SIGNING_KEY)
+
+def trusted_issuers():
+    """Checksummed addresses whose signatures are accepted"""
+    issuers = QR_TRUSTED_ISSUERS or ([Account.from_key(QR_SIGNING_KEY).address] if QR_SIGNING_KEY else [])
+    return {Web3.to_checksum_address(address) for address in issuers}
+
+def is_signed_payload(data):
+    """Whether scanned QR text is a signed payload rather than legacy JSON"""
+    return data.startswith(PAYLOAD_PREFIX)
+
+def encode_agreement_payload(chain_id, contract_address, agreement_id, landlord_address, tenant_address,
+                             property_details, rent_amount, duration, block_number, private_key=QR_SIGNING_KEY):
+    """Pack an agreement into a compact payload signed by the issuer, rent_amount is in ether"""
+    details = (property_details or "").encode()
+    if len(details) > 0xFFFF:
+        raise PayloadTooLargeError("Property details are too long for a signed QR payload")
+    body = _HEADER.pack(
+        _VERSION,
+        chain_id,
+        bytes.fromhex(Web3.to_checksum_address(contract_address)[2:]),
+        bytes.fromhex(agreement_id[2:] if agreement_id.startswith("0x") else agreement_id),
+        bytes.fromhex(Web3.to_checksum_address(landlord_address)[2:]),
+        bytes.fromhex(Web3.to_checksum_address(tenant_address)[2:]),
+        Web3.to_wei(rent_amount, 'ether').to_bytes(32, "big"),
+        duration,
+        block_number or 0,
+        int(time.time()),
+        len(details),
+    ) + details
+    with span("qr_sign"):
+        signature = Account.sign_message(encode_defunct(primitive=body), private_key).signature
+    payload = PAYLOAD_PREFIX + base64.b32encode(body + signature).decode().rstrip("=")
+    if not fits_in_qr_code(payload):
+        raise PayloadTooLargeError("Signed QR payload does not fit in a QR code")
+    return payload
+
+@lru_cache(maxsize=QR_PAYLOAD_CACHE_SIZE)
+def _verify(data):
+    encoded = data[len(PAYLOAD_PREFIX):]
+    try:
+        raw = base64.b32decode(encoded + "=" * (-len(encoded) % 8))
+    except ValueError:
+        raise InvalidPayloadError("Malformed QR payload")
+
+    if len(raw) < _HEADER.size + _SIGNATURE_SIZE:
+        raise InvalidPayloadError("Malformed QR payload")
+
+    body, signature = raw[:-_SIGNATURE_SIZE], raw[-_SIGNATURE_SIZE:]
+    (version, chain_id, contract, agreement_id, landlord, tenant, rent_wei, duration,
+     block_number, issued_at, details_length) = _HEADER.unpack_from(body)
+    if version != _VERSION:
+        raise InvalidPayloadError(f"Unsupported QR payload version {version}")
+    if len(body) != _HEADER.size + details_length:
+        raise InvalidPayloadError("Malformed QR payload")
+
+    try:
+        with span("qr_verify_signature"):
+            issuer = Account.recover_message(encode_defunct(primitive=body), signature=signature)
+    except Exception:
+        raise InvalidPayloadError("Invalid QR payload signature")
+    if issuer not in trusted_issuers():
+        raise InvalidPayloadError("QR payload is not signed by a trusted issuer")
+
+    return {
+        'chain_id': chain_id,
+        'contract_address': Web3.to_checksum_address(contract),
+        'agreement_id': "0x" + agreement_id.hex(),
+        'issuer': issuer,
+        'issued_at': issued_at,
+        'block_number': block_number,
+        'agreement_data': {
+            'landlord': Web3.to_checksum_address(landlord),
+            'tenant': Web3.to_checksum_address(tenant),
+            'property_details': body[_HEADER.size:].decode(),
+            'rent_amount': Web3.from_wei(int.from_bytes(rent_wei, "big"), 'ether'),
+            'duration': duration,
+            # Agreements are created active, later deactivation is only visible on chain
+            'is_active': True
+        }
+    }
+
+def verify_agreement_payload(data, chain_id=None):
+    """Check the signature of a scanned payload and return its fields, without touching the chain
+
+    With chain_id, payloads issued for another chain are rejected.
+    """
+    payload = _verify(data)
+    if chain_id is not None and payload['chain_id'] != chain_id:
+        raise InvalidPayloadError(f"QR payload was issued for chain {payload['chain_id']}, not {chain_id}")
+    return dict(payload, agreement_data=dict(payload['agreement_data']))
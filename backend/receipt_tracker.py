@@ -0,0 +1,315 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from web3.exceptions import BlockNotFound, TransactionNotFound
+from blockchain import get_agreement_id
+from nonce_manager import nonce_manager
+
+# Where pending submissions are persisted so they survive a restart
+RECEIPT_TRACKER_DB = os.getenv(
+    "RECEIPT_TRACKER_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'receipt_tracker.db')
+)
+
+# Seconds between polls while there are pending transactions
+RECEIPT_POLL_INTERVAL = float(os.getenv("RECEIPT_POLL_INTERVAL", 2))
+
+# Seconds after which a transaction that was never mined is marked as dropped
+RECEIPT_TIMEOUT = float(os.getenv("RECEIPT_TIMEOUT", 600))
+
+# Block ranges longer than this are not scanned, pending receipts are fetched directly
+RECEIPT_MAX_BLOCK_SCAN = int(os.getenv("RECEIPT_MAX_BLOCK_SCAN", 20))
+
+# Seconds a process keeps its claim on the submissions it polls, every app process shares the
+# database, and a claim is taken over by another process once the one holding it stops renewing it
+RECEIPT_CLAIM_SECONDS = float(os.getenv("RECEIPT_CLAIM_SECONDS", 30))
+
+STATUS_PENDING = "pending"
+STATUS_CONFIRMED = "confirmed"
+STATUS_FAILED = "failed"
+STATUS_DROPPED = "dropped"
+
+def _normalize_hash(tx_hash):
+    if isinstance(tx_hash, (bytes, bytearray)):
+        tx_hash = tx_hash.hex()
+    tx_hash = tx_hash.lower()
+    return tx_hash if tx_hash.startswith("0x") else "0x" + tx_hash
+
+class ReceiptTracker:
+    """Background tracker that resolves submitted agreement transactions"""
+
+    def __init__(self, web3, db_path=RECEIPT_TRACKER_DB, poll_interval=RECEIPT_POLL_INTERVAL,
+                 timeout=RECEIPT_TIMEOUT, claim_seconds=RECEIPT_CLAIM_SECONDS):
+        self.web3 = web3
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.claim_seconds = claim_seconds
+        self.tracker_id = uuid.uuid4().hex
+
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS submissions (
+                tx_hash TEXT PRIMARY KEY,
+                contract_address TEXT NOT NULL,
+                sender TEXT,
+                status TEXT NOT NULL,
+                agreement_id TEXT,
+                block_number INTEGER,
+                error TEXT,
+                metadata TEXT NOT NULL DEFAULT '{}',
+                submitted_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS submissions_status ON submissions (status)")
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(submissions)")}
+        if "claimed_by" not in columns:
+            self._conn.execute("ALTER TABLE submissions ADD COLUMN claimed_by TEXT")
+            self._conn.execute("ALTER TABLE submissions ADD COLUMN claimed_until REAL")
+        self._conn.commit()
+
+        self._listeners = []
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        # Last block scanned for pending hashes and its hash, None when a direct check is needed
+        self._last_block = None
+        self._last_block_hash = None
+        # Hashes that need a direct receipt lookup, e.g. newly claimed ones that may have been
+        # mined in blocks already scanned
+        self._unchecked = set()
+        self._claimed = set()
+
+    def start(self):
+        """Start the background polling thread"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="receipt-tracker", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background polling thread"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def add_listener(self, listener):
+        """Register a callback invoked with the record of every confirmed transaction"""
+        self._listeners.append(listener)
+
+    def track(self, tx_hash, contract_address, sender=None, metadata=None):
+        """Start tracking a broadcast createAgreement transaction"""
+        tx_hash = _normalize_hash(tx_hash)
+        now = time.time()
+        with self._db_lock:
+            self._conn.execute(
+                """INSERT OR IGNORE INTO submissions
+                   (tx_hash, contract_address, sender, status, metadata, submitted_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (tx_hash, contract_address, sender, STATUS_PENDING, json.dumps(metadata or {}), now, now)
+            )
+            self._conn.commit()
+            self._unchecked.add(tx_hash)
+
+        return tx_hash
+
+    def get_status(self, tx_hash):
+        """Get the tracked state of a transaction, or None if it is unknown"""
+        with self._db_lock:
+            row = self._conn.execute(
+                """SELECT tx_hash, contract_address, sender, status, agreement_id, block_number,
+                          error, metadata, submitted_at, updated_at
+                   FROM submissions WHERE tx_hash = ?""",
+                (_normalize_hash(tx_hash),)
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return {
+            'transaction_hash': row[0],
+            'contract_address': row[1],
+            'sender': row[2],
+            'status': row[3],
+            'agreement_id': row[4],
+            'block_number': row[5],
+            'error': row[6],
+            'metadata': json.loads(row[7]),
+            'submitted_at': row[8],
+            'updated_at': row[9],
+        }
+
+    def annotate(self, tx_hash, **metadata):
+        """Merge extra fields into the stored metadata of a transaction"""
+        tx_hash = _normalize_hash(tx_hash)
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT metadata FROM submissions WHERE tx_hash = ?", (tx_hash,)
+            ).fetchone()
+            if row is None:
+                return
+            merged = json.loads(row[0])
+            merged.update(metadata)
+            self._conn.execute(
+                "UPDATE submissions SET metadata = ?, updated_at = ? WHERE tx_hash = ?",
+                (json.dumps(merged), time.time(), tx_hash)
+            )
+            self._conn.commit()
+
+    def _pending(self):
+        """Claim the pending submissions no other process is polling, and return the ones this tracker holds"""
+        now = time.time()
+        with self._db_lock:
+            self._conn.execute(
+                """UPDATE submissions SET claimed_by = ?, claimed_until = ?
+                   WHERE status = ? AND (claimed_by IS NULL OR claimed_by = ? OR claimed_until < ?)""",
+                (self.tracker_id, now + self.claim_seconds, STATUS_PENDING, self.tracker_id, now)
+            )
+            self._conn.commit()
+            rows = self._conn.execute(
+                """SELECT tx_hash, contract_address, sender, submitted_at FROM submissions
+                   WHERE status = ? AND claimed_by = ?""",
+                (STATUS_PENDING, self.tracker_id)
+            ).fetchall()
+        return {row[0]: row for row in rows}
+
+    def _update(self, tx_hash, status, agreement_id=None, block_number=None, error=None):
+        with self._db_lock:
+            self._conn.execute(
+                """UPDATE submissions
+                   SET status = ?, agreement_id = ?, block_number = ?, error = ?, updated_at = ?
+                   WHERE tx_hash = ?""",
+                (status, agreement_id, block_number, error, time.time(), tx_hash)
+            )
+            self._conn.commit()
+
+    def _resolve(self, pending_row, tx_receipt):
+        tx_hash, contract_address = pending_row[0], pending_row[1]
+
+        if tx_receipt.status != 1:
+            self._update(tx_hash, STATUS_FAILED, block_number=tx_receipt.blockNumber,
+                         error="Transaction reverted")
+            return
+
+        try:
+            agreement_id = get_agreement_id(self.web3, contract_address, tx_receipt)
+        except Exception as e:
+            self._update(tx_hash, STATUS_FAILED, block_number=tx_receipt.blockNumber, error=str(e))
+            return
+
+        self._update(tx_hash, STATUS_CONFIRMED, agreement_id=agreement_id,
+                     block_number=tx_receipt.blockNumber)
+
+        record = self.get_status(tx_hash)
+        for listener in self._listeners:
+            try:
+                listener(record)
+            except Exception:
+                # A failing listener must not stop the tracker
+                pass
+
+    def _fetch_receipt(self, tx_hash):
+        try:
+            return self.web3.eth.get_transaction_receipt(tx_hash)
+        except TransactionNotFound:
+            return None
+
+    def _scanned_block_unchanged(self):
+        # Requests may go to another endpoint than the last poll, one that is behind or on another fork
+        try:
+            return self.web3.eth.get_block(self._last_block).hash == self._last_block_hash
+        except BlockNotFound:
+            return False
+
+    def _nonce_in_use(self, tx_hash):
+        # A transaction the node still knows can be mined later, its nonce must not be handed out again
+        try:
+            return self.web3.eth.get_transaction(tx_hash) is not None
+        except TransactionNotFound:
+            return False
+
+    def poll(self):
+        """Resolve every pending transaction that has been mined since the last poll"""
+        pending = self._pending()
+        with self._db_lock:
+            # Hashes claimed for the first time may have been mined in blocks we already scanned
+            self._unchecked |= set(pending) - self._claimed
+            self._claimed = set(pending)
+        if not pending:
+            self._last_block = None
+            return
+
+        latest = self.web3.eth.block_number
+        if self._last_block is not None and not self._scanned_block_unchanged():
+            self._last_block = None
+
+        # Newly tracked hashes, and everything after a long gap, are looked up
+        # directly since they may have been mined in blocks we already scanned
+        with self._db_lock:
+            if self._last_block is None or latest - self._last_block > RECEIPT_MAX_BLOCK_SCAN:
+                direct = set(pending)
+            else:
+                direct = self._unchecked & set(pending)
+            self._unchecked -= direct
+
+        for tx_hash in direct:
+            tx_receipt = self._fetch_receipt(tx_hash)
+            if tx_receipt is not None:
+                self._resolve(pending.pop(tx_hash), tx_receipt)
+
+        # One block lookup covers every pending hash instead of one receipt poll per hash
+        scanned_block, scanned_hash = self._last_block, self._last_block_hash
+        if self._last_block is not None and pending:
+            for block_number in range(self._last_block + 1, latest + 1):
+                if not pending:
+                    break
+                try:
+                    block = self.web3.eth.get_block(block_number)
+                except BlockNotFound:
+                    # Served by an endpoint that is behind, the rest of the range is scanned next time
+                    break
+                for block_tx in block.transactions:
+                    tx_hash = _normalize_hash(block_tx)
+                    if tx_hash in pending:
+                        tx_receipt = self._fetch_receipt(tx_hash)
+                        if tx_receipt is not None:
+                            self._resolve(pending.pop(tx_hash), tx_receipt)
+                        else:
+                            with self._db_lock:
+                                self._unchecked.add(tx_hash)
+                scanned_block, scanned_hash = block_number, block.hash
+        else:
+            try:
+                block = self.web3.eth.get_block(latest)
+                scanned_block, scanned_hash = latest, block.hash
+            except BlockNotFound:
+                scanned_block = scanned_hash = None
+
+        self._last_block, self._last_block_hash = scanned_block, scanned_hash
+
+        # Anything left that is too old and unknown to the node was dropped, so the sender's nonces need a re-sync
+        now = time.time()
+        for tx_hash, row in pending.items():
+            if now - row[3] > self.timeout and not self._nonce_in_use(tx_hash):
+                self._update(tx_hash, STATUS_DROPPED, error="Transaction was not mined in time")
+                if row[2]:
+                    nonce_manager.reset(row[2])
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception:
+                # Node hiccups are retried on the next poll
+                self._last_block = None
+
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
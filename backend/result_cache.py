@@ -0,0 +1,181 @@
+import copy
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from flask import Request
+from werkzeug.formparser import default_stream_factory
+
+# Analyses kept in memory
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", 1024))
+
+# Directory of the on-disk tier, empty to keep analyses in memory only
+ANALYSIS_CACHE_DIR = os.getenv("ANALYSIS_CACHE_DIR", "")
+
+# Size in bytes above which the least recently used analyses are deleted from disk
+ANALYSIS_CACHE_MAX_BYTES = int(os.getenv("ANALYSIS_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+class HashingStream:
+    """Upload spool that hashes file content as the form parser writes it"""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self._sha256.update(data)
+        return self._stream.write(data)
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def __iter__(self):
+        return iter(self._stream)
+
+class HashingRequest(Request):
+    """Request whose uploaded files carry a SHA-256 of their content, computed while streaming in"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingStream(default_stream_factory(
+            total_content_length=total_content_length,
+            content_type=content_type,
+            filename=filename,
+            content_length=content_length,
+        ))
+
+def content_digest(file):
+    """SHA-256 of an uploaded file, a path or a binary file object"""
+    stream = getattr(file, "stream", file)
+    if isinstance(stream, HashingStream):
+        return stream.hexdigest()
+
+    sha256 = hashlib.sha256()
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    # Not uploaded through HashingRequest, so it has to be read once more
+    position = stream.tell()
+    for chunk in iter(lambda: stream.read(1024 * 1024), b""):
+        sha256.update(chunk)
+    stream.seek(position)
+    return sha256.hexdigest()
+
+def result_key(digest, *parts):
+    """Cache key for a result derived from content with the given digest"""
+    return hashlib.sha256("\0".join((digest,) + tuple(str(part) for part in parts)).encode()).hexdigest()
+
+class ResultCache:
+    """Content-addressed cache of analysis results with an LRU memory tier and an optional disk tier"""
+
+    def __init__(self, max_size=ANALYSIS_CACHE_SIZE, directory=ANALYSIS_CACHE_DIR,
+                 max_bytes=ANALYSIS_CACHE_MAX_BYTES):
+        self.max_size = max_size
+        self.directory = directory or None
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # Sizes of the files in the disk tier, least recently used first
+        self._files = OrderedDict()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_evictions = 0
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                     if name.endswith(".json")]
+            for path in sorted(paths, key=os.path.getmtime):
+                self._files[os.path.basename(path)[:-5]] = os.path.getsize(path)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def _remember(self, key, result):
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        """Get a cached result, or None"""
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return copy.deepcopy(result)
+
+            if key in self._files:
+                try:
+                    with open(self._path(key)) as f:
+                        result = json.load(f)
+                    os.utime(self._path(key))
+                except (OSError, ValueError):
+                    # Deleted or half written by another process, treat as a miss
+                    self._files.pop(key, None)
+                else:
+                    self._files.move_to_end(key)
+                    self._remember(key, result)
+                    self.disk_hits += 1
+                    return copy.deepcopy(result)
+
+            self.misses += 1
+            return None
+
+    def put(self, key, result):
+        """Cache a result in memory and, if enabled, on disk"""
+        with self._lock:
+            self._remember(key, copy.deepcopy(result))
+            if not self.directory:
+                return
+
+            data = json.dumps(result).encode()
+            path = self._path(key)
+            temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary_path, "wb") as f:
+                f.write(data)
+            os.replace(temporary_path, path)
+
+            self._files[key] = len(data)
+            self._files.move_to_end(key)
+
+            total = sum(self._files.values())
+            while total > self.max_bytes and len(self._files) > 1:
+                evicted, size = self._files.popitem(last=False)
+                try:
+                    os.remove(self._path(evicted))
+                except OSError:
+                    pass
+                total -= size
+                self.disk_evictions += 1
+
+    def stats(self):
+        """Get hit/miss counters of both tiers"""
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'memory_size': len(self._entries),
+                'max_size': self.max_size,
+                'disk_enabled': self.directory is not None,
+                'disk_files': len(self._files),
+                'disk_bytes': sum(self._files.values()),
+                'max_bytes': self.max_bytes,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_ratio': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                'disk_evictions': self.disk_evictions,
+            }
+
+# Shared cache of document analyses
+analysis_cache = ResultCache()
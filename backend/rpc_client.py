@@ -0,0 +1,448 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlsplit
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from web3 import AsyncWeb3, Web3
+from web3.middleware import async_geth_poa_middleware, geth_poa_middleware
+from web3.providers.async_base import AsyncJSONBaseProvider
+from web3.providers.base import JSONBaseProvider
+from web3._utils.encoding import FriendlyJsonSerde, Web3JsonEncoder
+
+# RPC endpoints, comma separated, tried in order of measured latency
+RPC_URLS = [url.strip() for url in os.getenv("RPC_URLS", "").split(",") if url.strip()]
+
+# Seconds before a single RPC request is abandoned
+RPC_TIMEOUT = float(os.getenv("RPC_TIMEOUT", 10))
+
+# Pooled keep-alive connections per endpoint
+RPC_POOL_SIZE = int(os.getenv("RPC_POOL_SIZE", 32))
+
+# Milliseconds a read waits on the fastest endpoint before it is also sent to the next one, 0 disables hedging
+RPC_HEDGE_DELAY_MS = float(os.getenv("RPC_HEDGE_DELAY_MS", 300))
+
+# Seconds between background health checks of every endpoint
+RPC_HEALTH_INTERVAL = float(os.getenv("RPC_HEALTH_INTERVAL", 10))
+
+# Consecutive failures after which an endpoint is only used when no other is healthy
+RPC_MAX_FAILURES = int(os.getenv("RPC_MAX_FAILURES", 3))
+
+# Read-only methods that are safe to send to several endpoints at once
+HEDGED_METHODS = frozenset((
+    "eth_blockNumber",
+    "eth_call",
+    "eth_chainId",
+    "eth_estimateGas",
+    "eth_feeHistory",
+    "eth_gasPrice",
+    "eth_getBalance",
+    "eth_getBlockByHash",
+    "eth_getBlockByNumber",
+    "eth_getCode",
+    "eth_getLogs",
+    "eth_getTransactionByHash",
+    "eth_getTransactionReceipt",
+    "eth_maxPriorityFeePerGas",
+    "net_version",
+    "web3_clientVersion",
+))
+
+# Methods that change state. They only go to another endpoint if the failed request never reached a node,
+# otherwise a transaction broadcast by a node that then timed out would be sent a second time.
+NON_IDEMPOTENT_METHODS = frozenset((
+    "eth_sendRawTransaction",
+    "eth_sendTransaction",
+))
+
+# Methods that go to the primary endpoint, so the pending nonce count a signer syncs from comes from
+# the node its transactions were broadcast through, not a replica that has not seen them yet
+PINNED_METHODS = frozenset((
+    "eth_getTransactionCount",
+    "eth_sendRawTransaction",
+    "eth_sendTransaction",
+))
+
+# Status codes that mean the endpoint, not the request, is at fault
+RETRYABLE_STATUS_CODES = frozenset((429, 500, 502, 503, 504))
+
+def request_never_sent(error):
+    """Whether a request failed before reaching the node, so sending it elsewhere cannot repeat it"""
+    if isinstance(error, requests.ConnectTimeout) or isinstance(error, aiohttp.ClientConnectorError):
+        return True
+    # Rate limited requests are turned away before they are processed
+    status = getattr(getattr(error, "response", None), "status_code", None) or getattr(error, "status", None)
+    if status == 429:
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+def _percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return None
+    index = min(len(sorted_samples) - 1, int(round(fraction * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+class RPCEndpoint:
+    """A single JSON-RPC endpoint with its own keep-alive session and latency stats"""
+
+    def __init__(self, uri, pool_size=RPC_POOL_SIZE):
+        self.uri = uri
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+
+        self._lock = threading.Lock()
+        self.samples = deque(maxlen=256)
+        self.ewma_latency = None
+        self.failures = 0
+        self.block_number = None
+        self.last_error = None
+        self.last_checked = None
+        self.last_success = None
+
+    @property
+    def name(self):
+        """Endpoint without path or credentials, safe to expose"""
+        parts = urlsplit(self.uri)
+        return f"{parts.scheme}://{parts.hostname}" + (f":{parts.port}" if parts.port else "")
+
+    @property
+    def healthy(self):
+        return self.failures < RPC_MAX_FAILURES
+
+    def post(self, payload, timeout=RPC_TIMEOUT):
+        """Send a raw JSON-RPC payload and return the response body"""
+        started = time.perf_counter()
+        try:
+            response = self.session.post(self.uri, data=payload, timeout=timeout)
+            if response.status_code in RETRYABLE_STATUS_CODES:
+                raise requests.HTTPError(f"{response.status_code} from {self.name}", response=response)
+            response.raise_for_status()
+        except Exception as e:
+            self.record_failure(e)
+            raise
+
+        self.record_success(time.perf_counter() - started)
+        return response.content
+
+    def record_success(self, latency):
+        with self._lock:
+            self.samples.append(latency)
+            self.ewma_latency = latency if self.ewma_latency is None else 0.8 * self.ewma_latency + 0.2 * latency
+            self.failures = 0
+            self.last_success = time.time()
+
+    def record_failure(self, error):
+        with self._lock:
+            self.failures += 1
+            self.last_error = str(error)
+
+    def stats(self):
+        with self._lock:
+            samples = sorted(self.samples)
+        return {
+            'endpoint': self.name,
+            'healthy': self.healthy,
+            'block_number': self.block_number,
+            'latency_ms': {
+                'p50': None if not samples else round(_percentile(samples, 0.50) * 1000, 2),
+                'p95': None if not samples else round(_percentile(samples, 0.95) * 1000, 2),
+                'p99': None if not samples else round(_percentile(samples, 0.99) * 1000, 2),
+            },
+            'consecutive_failures': self.failures,
+            'last_error': self.last_error,
+            'last_checked': self.last_checked,
+            'last_success': self.last_success,
+        }
+
+class PooledHTTPProvider(JSONBaseProvider):
+    """Web3 provider with latency-aware routing, failover and hedged reads over pooled sessions"""
+
+    def __init__(self, endpoint_uris, hedge_delay_ms=RPC_HEDGE_DELAY_MS):
+        super().__init__()
+        self.endpoints = [RPCEndpoint(uri) for uri in endpoint_uris]
+        self.hedge_delay = hedge_delay_ms / 1000
+        self._executor = ThreadPoolExecutor(max_workers=RPC_POOL_SIZE * len(self.endpoints),
+                                            thread_name_prefix="rpc-hedge")
+
+    def __str__(self):
+        return f"Pooled RPC connection {', '.join(endpoint.name for endpoint in self.endpoints)}"
+
+    def ranked_endpoints(self):
+        """Endpoints ordered healthy first, then by recent latency"""
+        return sorted(
+            self.endpoints,
+            key=lambda endpoint: (not endpoint.healthy, endpoint.ewma_latency is None, endpoint.ewma_latency or 0)
+        )
+
+    def primary_endpoints(self):
+        """Endpoints ordered healthy first, then as configured, so consecutive requests reach the same node"""
+        return sorted(self.endpoints, key=lambda endpoint: not endpoint.healthy)
+
+    def _post_with_failover(self, payload, endpoints, idempotent=True):
+        last_error = None
+        for endpoint in endpoints:
+            try:
+                return endpoint.post(payload)
+            except Exception as e:
+                if not idempotent and not request_never_sent(e):
+                    raise
+                last_error = e
+        raise last_error
+
+    def _post_hedged(self, payload, endpoints):
+        # Ask the fastest endpoint first and only involve the next one if it is slow
+        pending = {self._executor.submit(endpoints[0].post, payload)}
+        done, pending = wait(pending, timeout=self.hedge_delay)
+
+        remaining = list(endpoints[1:])
+        last_error = None
+        while True:
+            for future in done:
+                try:
+                    return future.result()
+                except Exception as e:
+                    last_error = e
+
+            if remaining:
+                pending.add(self._executor.submit(remaining.pop(0).post, payload))
+            elif not pending:
+                raise last_error
+
+            done, pending = wait(pending, timeout=None if not remaining else self.hedge_delay,
+                                 return_when=FIRST_COMPLETED)
+
+    def post(self, payload, hedged=False, idempotent=True, pinned=False):
+        """Send a raw JSON-RPC payload to the best endpoint, failing over to the others
+
+        Pinned requests go to the primary endpoint instead of the fastest one and are never hedged.
+        """
+        if pinned:
+            return self._post_with_failover(payload, self.primary_endpoints(), idempotent)
+        endpoints = self.ranked_endpoints()
+        if hedged and self.hedge_delay > 0 and len(endpoints) > 1:
+            return self._post_hedged(payload, endpoints)
+        return self._post_with_failover(payload, endpoints, idempotent)
+
+    def make_request(self, method, params):
+        payload = self.encode_rpc_request(method, params)
+        return self.decode_rpc_response(self.post(
+            payload, hedged=method in HEDGED_METHODS, idempotent=method not in NON_IDEMPOTENT_METHODS,
+            pinned=method in PINNED_METHODS
+        ))
+
+    def make_batch_request(self, batch):
+        """Send a list of JSON-RPC request dicts as one batch"""
+        payload = FriendlyJsonSerde().json_encode(batch, Web3JsonEncoder).encode('utf-8')
+        hedged = all(request["method"] in HEDGED_METHODS for request in batch)
+        idempotent = not any(request["method"] in NON_IDEMPOTENT_METHODS for request in batch)
+        pinned = any(request["method"] in PINNED_METHODS for request in batch)
+        return self.decode_rpc_response(self.post(payload, hedged=hedged, idempotent=idempotent, pinned=pinned))
+
+    def is_connected(self, show_traceback=False):
+        return any(endpoint.healthy and endpoint.last_success for endpoint in self.endpoints)
+
+class PinnedHTTPProvider(JSONBaseProvider):
+    """Web3 provider sending every request to the primary endpoint of a PooledHTTPProvider, for readers
+    that must see one node's view of the chain, failing over only when that endpoint is unhealthy"""
+
+    def __init__(self, pooled_provider):
+        super().__init__()
+        self.pooled_provider = pooled_provider
+
+    def __str__(self):
+        return f"Pinned {self.pooled_provider}"
+
+    def make_request(self, method, params):
+        payload = self.encode_rpc_request(method, params)
+        return self.decode_rpc_response(self.pooled_provider.post(
+            payload, idempotent=method not in NON_IDEMPOTENT_METHODS, pinned=True
+        ))
+
+    def is_connected(self, show_traceback=False):
+        return self.pooled_provider.is_connected(show_traceback)
+
+class AsyncPooledHTTPProvider(AsyncJSONBaseProvider):
+    """AsyncWeb3 provider over the endpoints of a PooledHTTPProvider, sharing their health and latency stats"""
+
+    def __init__(self, pooled_provider, hedge_delay_ms=RPC_HEDGE_DELAY_MS, pool_size=RPC_POOL_SIZE):
+        super().__init__()
+        self.pooled_provider = pooled_provider
+        self.hedge_delay = hedge_delay_ms / 1000
+        self.pool_size = pool_size
+        self._session = None
+
+    def __str__(self):
+        return f"Async {self.pooled_provider}"
+
+    def _get_session(self):
+        # Sessions belong to the event loop they were created on, so one is opened on first use
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self.pool_size),
+                headers={"Content-Type": "application/json"},
+                timeout=aiohttp.ClientTimeout(total=RPC_TIMEOUT),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _post_endpoint(self, endpoint, payload):
+        started = time.perf_counter()
+        try:
+            async with self._get_session().post(endpoint.uri, data=payload) as response:
+                if response.status in RETRYABLE_STATUS_CODES:
+                    raise aiohttp.ClientResponseError(
+                        response.request_info, response.history, status=response.status,
+                        message=f"{response.status} from {endpoint.name}"
+                    )
+                response.raise_for_status()
+                content = await response.read()
+        except Exception as e:
+            endpoint.record_failure(e)
+            raise
+
+        endpoint.record_success(time.perf_counter() - started)
+        return content
+
+    async def _post_hedged(self, payload, endpoints):
+        # Same policy as the sync provider: the next endpoint only joins once the current ones are slow
+        remaining = list(endpoints)
+        pending = {asyncio.ensure_future(self._post_endpoint(remaining.pop(0), payload))}
+        last_error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=self.hedge_delay if remaining else None, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+                if remaining:
+                    pending.add(asyncio.ensure_future(self._post_endpoint(remaining.pop(0), payload)))
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def post(self, payload, hedged=False, idempotent=True, pinned=False):
+        """Send a raw JSON-RPC payload to the best endpoint, failing over to the others"""
+        if pinned:
+            endpoints = self.pooled_provider.primary_endpoints()
+        else:
+            endpoints = self.pooled_provider.ranked_endpoints()
+        if hedged and not pinned and self.hedge_delay > 0 and len(endpoints) > 1:
+            return await self._post_hedged(payload, endpoints)
+
+        last_error = None
+        for endpoint in endpoints:
+            try:
+                return await self._post_endpoint(endpoint, payload)
+            except Exception as e:
+                if not idempotent and not request_never_sent(e):
+                    raise
+                last_error = e
+        raise last_error
+
+    async def make_request(self, method, params):
+        payload = self.encode_rpc_request(method, params)
+        return self.decode_rpc_response(await self.post(
+            payload, hedged=method in HEDGED_METHODS, idempotent=method not in NON_IDEMPOTENT_METHODS,
+            pinned=method in PINNED_METHODS
+        ))
+
+    async def make_batch_request(self, batch):
+        """Send a list of JSON-RPC request dicts as one batch"""
+        payload = FriendlyJsonSerde().json_encode(batch, Web3JsonEncoder).encode('utf-8')
+        hedged = all(request["method"] in HEDGED_METHODS for request in batch)
+        idempotent = not any(request["method"] in NON_IDEMPOTENT_METHODS for request in batch)
+        pinned = any(request["method"] in PINNED_METHODS for request in batch)
+        return self.decode_rpc_response(await self.post(payload, hedged=hedged, idempotent=idempotent,
+                                                        pinned=pinned))
+
+    async def is_connected(self, show_traceback=False):
+        return self.pooled_provider.is_connected(show_traceback)
+
+class RPCClient:
+    """Configured-once Web3 connection with a background health monitor"""
+
+    def __init__(self, endpoint_uris, health_interval=RPC_HEALTH_INTERVAL):
+        self.provider = PooledHTTPProvider(endpoint_uris)
+        self.web3 = Web3(self.provider)
+
+        # Add PoA middleware for networks like Rinkeby, Goerli, etc. once, not per call
+        self.web3.middleware_onion.inject(geth_poa_middleware, layer=0, name="poa")
+
+        # Same endpoints, but every request goes to the primary one, e.g. to scan consecutive blocks
+        self.pinned_web3 = Web3(PinnedHTTPProvider(self.provider))
+        self.pinned_web3.middleware_onion.inject(geth_poa_middleware, layer=0, name="poa")
+
+        # Created on first use, for the async server
+        self._async_web3 = None
+
+        self.health_interval = health_interval
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def async_web3(self):
+        """AsyncWeb3 over the same endpoints, routed by the same health monitor"""
+        if self._async_web3 is None:
+            self._async_web3 = AsyncWeb3(AsyncPooledHTTPProvider(self.provider))
+            self._async_web3.middleware_onion.inject(async_geth_poa_middleware, layer=0, name="poa")
+        return self._async_web3
+
+    def check_health(self):
+        """Probe every endpoint once and record its latency and head block"""
+        for endpoint in self.provider.endpoints:
+            payload = self.provider.encode_rpc_request("eth_blockNumber", [])
+            try:
+                response = self.provider.decode_rpc_response(endpoint.post(payload))
+                if "error" in response:
+                    endpoint.record_failure(response["error"])
+                else:
+                    endpoint.block_number = Web3.to_int(hexstr=response["result"])
+            except Exception:
+                # The failure is already recorded on the endpoint
+                pass
+            endpoint.last_checked = time.time()
+
+    def start(self):
+        """Start monitoring endpoint health in the background"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="rpc-health", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background health monitor"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.check_health()
+            self._stop.wait(self.health_interval)
+
+    def health(self):
+        """Cached connectivity and latency of every endpoint, without touching the node"""
+        endpoints = [endpoint.stats() for endpoint in self.provider.endpoints]
+        return {
+            'connected': any(endpoint['healthy'] and endpoint['last_success'] for endpoint in endpoints),
+            'endpoints': endpoints,
+        }
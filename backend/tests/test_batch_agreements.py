@@ -0,0 +1,150 @@
+import asyncio
+import pytest
+
+pytest.importorskip("eth_tester")
+
+from eth_account import Account
+from hexbytes import HexBytes
+from web3 import Web3, EthereumTesterProvider
+import blockchain
+
+# Well-known development key, funded from the test chain's first account
+PRIVATE_KEY = "0x" + "00" * 31 + "01"
+
+@pytest.fixture(scope="module")
+def web3():
+    web3 = Web3(EthereumTesterProvider())
+    web3.eth.send_transaction({
+        'from': web3.eth.accounts[0],
+        'to': Account.from_key(PRIVATE_KEY).address,
+        'value': web3.to_wei(1000, 'ether'),
+    })
+    return web3
+
+@pytest.fixture(scope="module")
+def contract_address(web3):
+    return blockchain.deploy_contract(web3, PRIVATE_KEY, batch=True)
+
+def agreement(web3, seed):
+    return {
+        'landlord_address': web3.eth.accounts[1 + seed % 4],
+        'tenant_address': web3.eth.accounts[5 + seed % 3],
+        'property_details': f"Unit {seed}, 12 Main Street " + "x" * (seed % 150),
+        'rent_amount': 1 + seed % 4,
+        'duration': 6 + seed,
+    }
+
+def test_deploy_batch_contract(web3, contract_address):
+    assert web3.eth.get_code(contract_address)
+    contract = blockchain.get_contract(web3, contract_address, blockchain.BATCH_CONTRACT_ABI)
+    assert contract.functions.createAgreements
+
+def test_plan_agreement_batches_respects_gas_and_size():
+    item_gas = {index: 100_000 for index in range(10)}
+    budget = blockchain.TRANSACTION_BASE_GAS + 300_000
+
+    assert blockchain.plan_agreement_batches(item_gas, budget) == [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+    assert blockchain.plan_agreement_batches(item_gas, 10**9, max_items=4) == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    # An item over the budget on its own still gets its own batch
+    assert blockchain.plan_agreement_batches({0: 10, 1: 10**9, 2: 10}, budget) == [[0], [1], [2]]
+
+def test_create_agreements_reports_failures_per_item(web3):
+    # A contract of its own, so no cached gas estimate hides the reverting item
+    contract_address = blockchain.deploy_contract(web3, PRIVATE_KEY, batch=True)
+    agreements = [agreement(web3, seed) for seed in range(4)]
+    agreements[0] = dict(agreements[0], landlord_address="0x" + "00" * 20)
+    agreements[2] = ["not", "an", "agreement"]
+
+    results = blockchain.create_agreements(web3, contract_address, agreements, PRIVATE_KEY)
+
+    for index in (0, 2):
+        assert not results[index]['success']
+        assert results[index]['error']
+        assert 'transaction_hash' not in results[index]
+    assert results[2]['error'] == "Agreement must be an object"
+    assert results[1]['success'] and results[3]['success']
+
+def test_create_agreements_batched_maps_logs_to_rows(web3, contract_address, monkeypatch):
+    # A small share of the block gas limit forces the rows into several transactions
+    monkeypatch.setattr(blockchain, "CHAIN_BATCH_GAS_SHARE", 0.05)
+    agreements = [agreement(web3, seed) for seed in range(12)]
+    agreements[2] = dict(agreements[2], duration=None)
+    agreements[5] = dict(agreements[5], property_details="y" * (blockchain.BATCH_CONTRACT_MAX_DETAILS_BYTES + 1))
+    agreements[7] = "not an agreement"
+    agreements[9] = dict(agreements[9], landlord_address="0xnotanaddress")
+    invalid = {2, 5, 7, 9}
+
+    results = blockchain.create_agreements_batched(web3, contract_address, agreements, PRIVATE_KEY)
+
+    assert [result['index'] for result in results] == list(range(len(agreements)))
+    for index in invalid:
+        assert not results[index]['success']
+        assert results[index]['error']
+        assert 'transaction_hash' not in results[index]
+
+    created = [result for result in results if result['index'] not in invalid]
+    assert all(result['success'] for result in created)
+    assert len({result['transaction_hash'] for result in created}) > 1
+    assert len({result['agreement_id'] for result in created}) == len(created)
+
+    for result in created:
+        item = agreements[result['index']]
+        agreement_data = blockchain.verify_agreement(web3, contract_address, result['agreement_id'], use_cache=False)
+        assert agreement_data['landlord'] == item['landlord_address']
+        assert agreement_data['tenant'] == item['tenant_address']
+        assert agreement_data['property_details'] == item['property_details']
+        assert agreement_data['rent_amount'] == item['rent_amount']
+        assert agreement_data['duration'] == item['duration']
+        assert agreement_data['is_active']
+
+def test_only_the_landlord_updates_status(web3, contract_address):
+    item = agreement(web3, 0)
+    agreement_id = blockchain.create_agreement(
+        web3, contract_address, item['landlord_address'], item['tenant_address'],
+        item['property_details'], item['rent_amount'], item['duration'], PRIVATE_KEY
+    )
+    contract = blockchain.get_contract(web3, contract_address)
+    update = contract.functions.updateAgreementStatus(HexBytes(agreement_id), False)
+
+    with pytest.raises(Exception, match="only the landlord"):
+        update.transact({'from': item['tenant_address']})
+    with pytest.raises(Exception, match="unknown agreement"):
+        contract.functions.updateAgreementStatus(b"\x11" * 32, False).transact({'from': item['landlord_address']})
+
+    web3.eth.wait_for_transaction_receipt(update.transact({'from': item['landlord_address']}))
+    assert not blockchain.verify_agreement(web3, contract_address, agreement_id, use_cache=False)['is_active']
+
+class SlowBatchProvider:
+    """Async batch provider over the test chain that records how many batches are in flight"""
+
+    def __init__(self, web3):
+        self.web3 = web3
+        self.in_flight = self.most_in_flight = 0
+
+    async def make_batch_request(self, batch):
+        self.in_flight += 1
+        self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        # Out of order, as nodes may answer
+        return [{"id": request["id"], "result": self.web3.manager.request_blocking(request["method"], request["params"])}
+                for request in reversed(batch)]
+
+def test_async_verify_agreements_sends_batches_concurrently(web3, contract_address, monkeypatch):
+    monkeypatch.setattr(blockchain, "RPC_BATCH_SIZE", 2)
+    monkeypatch.setattr(blockchain, "RPC_BATCH_CONCURRENCY", 3)
+    results = blockchain.create_agreements(web3, contract_address, [agreement(web3, 100 + seed) for seed in range(9)],
+                                           PRIVATE_KEY)
+    agreement_ids = [result['agreement_id'] for result in results] + ["0x" + "00" * 32]
+
+    provider = SlowBatchProvider(web3)
+    async_web3 = Web3(EthereumTesterProvider())
+    async_web3.provider = provider
+    verified = asyncio.run(blockchain.async_verify_agreements(async_web3, contract_address, agreement_ids,
+                                                              use_cache=False))
+
+    assert provider.most_in_flight == 3
+    assert [result['success'] for result in verified] == [True] * 9 + [False]
+    assert [result['agreement_data']['duration'] for result in verified[:9]] == [
+        agreement(web3, 100 + seed)['duration'] for seed in range(9)
+    ]
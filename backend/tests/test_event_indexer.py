@@ -0,0 +1,38 @@
+import pytest
+
+pytest.importorskip("eth_tester")
+
+from web3 import Web3, EthereumTesterProvider
+import event_indexer
+from event_indexer import EventIndexer
+
+CONTRACT = "0x" + "ab" * 20
+
+def test_parse_contracts_with_and_without_start_block(monkeypatch):
+    monkeypatch.setattr(event_indexer, "INDEXER_START_BLOCK", None)
+    assert event_indexer._parse_contracts(f" {CONTRACT}:1234, 0x{'cd' * 20} ,") == {
+        CONTRACT: 1234, "0x" + "cd" * 20: None,
+    }
+
+def test_add_contract_starts_at_the_current_block(tmp_path):
+    web3 = Web3(EthereumTesterProvider())
+    for _ in range(3):
+        web3.eth.send_transaction({'from': web3.eth.accounts[0], 'to': web3.eth.accounts[1], 'value': 1})
+    indexer = EventIndexer(web3, db_path=str(tmp_path / "index.db"))
+
+    indexer.add_contract(CONTRACT)
+    # A known contract resumes from its checkpoint instead of the new start block
+    indexer.add_contract(CONTRACT, 0)
+
+    assert [checkpoint[:2] for checkpoint in indexer._checkpoints()] == [(CONTRACT, web3.eth.block_number - 1)]
+
+def test_add_contract_without_a_node_registers_on_the_next_sync(tmp_path):
+    indexer = EventIndexer(Web3(Web3.HTTPProvider("http://127.0.0.1:1")), db_path=str(tmp_path / "index.db"))
+
+    indexer.add_contract(CONTRACT)
+    assert indexer._checkpoints() == []
+    assert indexer.last_error
+
+    indexer.web3 = Web3(EthereumTesterProvider())
+    indexer.sync()
+    assert [checkpoint[0] for checkpoint in indexer._checkpoints()] == [CONTRACT]
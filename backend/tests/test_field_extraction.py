@@ -0,0 +1,38 @@
+import random
+
+from field_extraction import FieldExtractor, EXTRACTION_SPECS
+
+def search_per_field(spec, text):
+    """Reference extraction: each field at the first occurrence of its highest-priority keyword"""
+    extracted_info = {}
+    lowered = text.lower()
+    for field, rules in spec.items():
+        for keyword in rules["keywords"]:
+            start = lowered.find(keyword)
+            if start != -1:
+                extracted_info[field] = text[start:start + rules["window"]]
+                break
+    return extracted_info
+
+def test_overlapping_keywords_of_different_fields_are_all_found():
+    spec = {
+        "id_number": {"keywords": ["id"], "window": 20},
+        "identity": {"keywords": ["identity"], "window": 20},
+        "card": {"keywords": ["card", "ca"], "window": 10},
+        "dentist": {"keywords": ["dent"], "window": 10},
+    }
+    text = "Identity card of a dentist"
+
+    assert FieldExtractor(spec).extract(text) == search_per_field(spec, text) == {
+        "id_number": text[0:20], "identity": text[0:20], "card": text[9:19], "dentist": text[1:11],
+    }
+
+def test_extraction_matches_per_field_search():
+    rng = random.Random(0)
+    words = ["address", "rent", "term", "duration", "name", "number", "id", "birth", "dob", "identity",
+             "a", "the", "lease", "card", "12", "main", "street"]
+    for document_type, spec in EXTRACTION_SPECS.items():
+        extractor = FieldExtractor(spec)
+        for _ in range(200):
+            text = " ".join(rng.choice(words) for _ in range(rng.randrange(1, 30)))
+            assert extractor.extract(text) == search_per_field(spec, text)
@@ -0,0 +1,22 @@
+import pytest
+
+import generation_profiles
+from generation_profiles import available_profiles, resolve_profile
+
+def test_onnx_backend_only_offers_greedy_profiles():
+    assert "thorough" in available_profiles("fp32")
+    assert "thorough" not in available_profiles("onnx")
+
+def test_explicit_beam_search_profile_is_rejected_on_onnx():
+    with pytest.raises(ValueError):
+        resolve_profile("lease", "thorough", "onnx")
+
+def test_beam_search_default_decodes_greedily_on_onnx(monkeypatch):
+    monkeypatch.setitem(generation_profiles.DEFAULT_GENERATION_PROFILES, "lease", "thorough")
+
+    name, settings = resolve_profile("lease", backend="onnx")
+
+    assert name == "thorough"
+    assert settings["num_beams"] == 1
+    assert settings["max_new_tokens"] == generation_profiles.GENERATION_PROFILES["thorough"]["max_new_tokens"]
+    assert resolve_profile("lease", backend="fp32")[1]["num_beams"] == 3
@@ -0,0 +1,38 @@
+import time
+import pytest
+
+pytest.importorskip("pyzbar.pyzbar", exc_type=ImportError)
+
+from image_preprocessing import UnreadableImageError
+from qr_handler import QRCodeCache, scan_qr_bytes
+
+def cache(tmp_path, **kwargs):
+    return QRCodeCache(max_size=1, directory=str(tmp_path / "qr_codes"), write_to_disk=False,
+                       db_path=str(tmp_path / "qr_codes.db"), **kwargs)
+
+def test_payloads_render_after_eviction_and_in_other_processes(tmp_path):
+    first, second = cache(tmp_path), cache(tmp_path)
+    qr_hashes = [first.add("one"), first.add("two")]
+
+    assert all(first.get(qr_hash).startswith(b"\x89PNG") for qr_hash in qr_hashes)
+    assert all(second.get(qr_hash, "svg").startswith(b"<svg") for qr_hash in qr_hashes)
+    assert second.get("0" * 64) is None
+
+def test_cleanup_prunes_expired_payloads(tmp_path):
+    qr_codes = cache(tmp_path, payload_retention_days=1)
+    expired, kept = qr_codes.add("expired"), qr_codes.add("kept")
+    with qr_codes._db_lock:
+        qr_codes._conn.execute("UPDATE qr_payloads SET created_at = ? WHERE qr_hash = ?",
+                               (time.time() - 2 * 24 * 3600, expired))
+        qr_codes._conn.commit()
+
+    qr_codes.cleanup(force=True)
+
+    fresh = cache(tmp_path)
+    assert fresh.get(expired) is None
+    assert fresh.get(kept) is not None
+
+def test_scan_rejects_images_without_a_readable_header():
+    # Their pixel count cannot be checked, so they must not reach the decoder
+    with pytest.raises(UnreadableImageError):
+        scan_qr_bytes(b"\x00" * 64)
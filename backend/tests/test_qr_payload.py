@@ -0,0 +1,34 @@
+import pytest
+
+# qr_payload checks payload sizes with qr_handler, which needs the zbar library
+pytest.importorskip("pyzbar.pyzbar", exc_type=ImportError)
+
+from eth_account import Account
+import qr_payload
+from qr_payload import InvalidPayloadError, PayloadTooLargeError
+
+PRIVATE_KEY = "0x" + "00" * 31 + "01"
+
+def encode(property_details, chain_id=1337):
+    return qr_payload.encode_agreement_payload(
+        chain_id, "0x" + "11" * 20, "0x" + "ab" * 32, "0x" + "22" * 20, "0x" + "33" * 20,
+        property_details, 1, 12, 100, private_key=PRIVATE_KEY
+    )
+
+@pytest.fixture(autouse=True)
+def trusted_issuer(monkeypatch):
+    monkeypatch.setattr(qr_payload, "QR_TRUSTED_ISSUERS", [Account.from_key(PRIVATE_KEY).address])
+
+@pytest.mark.parametrize("size", [3000, 70000])
+def test_oversized_property_details_are_rejected_before_rendering(size):
+    with pytest.raises(PayloadTooLargeError):
+        encode("x" * size)
+
+def test_payload_round_trip_checks_the_chain():
+    data = encode("12 Main Street")
+
+    payload = qr_payload.verify_agreement_payload(data, chain_id=1337)
+    assert payload['agreement_data']['property_details'] == "12 Main Street"
+
+    with pytest.raises(InvalidPayloadError):
+        qr_payload.verify_agreement_payload(data, chain_id=1)
@@ -0,0 +1,61 @@
+import pytest
+
+pytest.importorskip("eth_tester")
+
+from eth_account import Account
+from web3 import Web3, EthereumTesterProvider
+import blockchain
+import receipt_tracker as tracker_module
+from nonce_manager import nonce_manager
+from receipt_tracker import ReceiptTracker, STATUS_CONFIRMED, STATUS_DROPPED, STATUS_PENDING
+
+# Well-known development key, funded from the test chain's first account
+PRIVATE_KEY = "0x" + "00" * 31 + "01"
+SENDER = Account.from_key(PRIVATE_KEY).address
+
+@pytest.fixture(scope="module")
+def web3():
+    # Nonces allocated on the chains of other test modules do not apply to this one
+    nonce_manager.reset(SENDER)
+    yield Web3(EthereumTesterProvider())
+    nonce_manager.reset(SENDER)
+
+@pytest.fixture(scope="module")
+def contract_address(web3):
+    return blockchain.deploy_contract(web3, PRIVATE_KEY, batch=True)
+
+def submit(web3, contract_address, seed=0):
+    return blockchain.submit_agreement(
+        web3, contract_address, web3.eth.accounts[1], web3.eth.accounts[2], f"Unit {seed}", 1, 12, PRIVATE_KEY
+    )
+
+def test_trackers_sharing_a_database_resolve_each_submission_once(web3, contract_address, tmp_path):
+    db_path = str(tmp_path / "tracker.db")
+    trackers = [ReceiptTracker(web3, db_path=db_path) for _ in range(2)]
+    confirmed = []
+    for tracker in trackers:
+        tracker.add_listener(lambda record: confirmed.append(record['transaction_hash']))
+
+    tx_hashes = [trackers[index % 2].track(submit(web3, contract_address, index), contract_address)
+                 for index in range(4)]
+    for tracker in trackers:
+        tracker.poll()
+
+    assert sorted(confirmed) == sorted(tx_hashes)
+    assert all(trackers[1].get_status(tx_hash)['status'] == STATUS_CONFIRMED for tx_hash in tx_hashes)
+
+def test_timed_out_transaction_is_only_dropped_once_the_node_forgot_it(web3, contract_address, tmp_path,
+                                                                      monkeypatch):
+    tracker = ReceiptTracker(web3, db_path=str(tmp_path / "tracker.db"), timeout=0)
+    resets = []
+    monkeypatch.setattr(tracker_module.nonce_manager, "reset", resets.append)
+    # As if still in the mempool: the node knows the transaction but has no receipt
+    monkeypatch.setattr(tracker, "_fetch_receipt", lambda tx_hash: None)
+
+    known = tracker.track(submit(web3, contract_address), contract_address, sender=SENDER)
+    forgotten = tracker.track("0x" + "ee" * 32, contract_address, sender=SENDER)
+    tracker.poll()
+
+    assert tracker.get_status(known)['status'] == STATUS_PENDING
+    assert tracker.get_status(forgotten)['status'] == STATUS_DROPPED
+    assert resets == [SENDER]
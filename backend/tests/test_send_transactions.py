@@ -0,0 +1,78 @@
+import pytest
+
+pytest.importorskip("eth_tester")
+
+import requests
+from eth_account import Account
+from web3 import Web3, EthereumTesterProvider
+import blockchain
+from nonce_manager import nonce_manager
+
+# Well-known development key, funded from the test chain's first account
+PRIVATE_KEY = "0x" + "00" * 31 + "01"
+SENDER = Account.from_key(PRIVATE_KEY).address
+
+@pytest.fixture
+def web3():
+    # The test chain funds the accounts of the keys 0x...01 to 0x...0a
+    web3 = Web3(EthereumTesterProvider())
+    nonce_manager.reset(SENDER)
+    yield web3
+    nonce_manager.reset(SENDER)
+
+def transfer(web3):
+    return lambda nonce: blockchain.transaction_params(web3, SENDER, nonce, 21000) | {
+        'to': web3.eth.accounts[1], 'value': 1
+    }
+
+def failing_send(web3, monkeypatch, error, broadcast):
+    send = web3.eth.send_raw_transaction
+
+    def send_raw_transaction(raw_transaction):
+        if broadcast:
+            send(raw_transaction)
+        raise error
+
+    monkeypatch.setattr(web3.eth, "send_raw_transaction", send_raw_transaction)
+
+def test_timeout_after_broadcast_counts_as_sent(web3, monkeypatch):
+    failing_send(web3, monkeypatch, requests.ReadTimeout("read timed out"), broadcast=True)
+    nonce = web3.eth.get_transaction_count(SENDER)
+
+    tx_hash = blockchain.send_transaction(web3, PRIVATE_KEY, transfer(web3))
+
+    assert web3.eth.get_transaction(tx_hash)['nonce'] == nonce
+
+def test_timeout_without_broadcast_does_not_release_the_nonce(web3, monkeypatch):
+    failing_send(web3, monkeypatch, requests.ReadTimeout("read timed out"), broadcast=False)
+
+    with pytest.raises(blockchain.BroadcastUnknownError):
+        blockchain.send_transaction(web3, PRIVATE_KEY, transfer(web3))
+
+    # The nonce is re-synced from the node rather than handed out again from memory
+    assert nonce_manager._signer(SENDER).next_nonce is None
+    assert not nonce_manager._signer(SENDER).released
+
+def test_rejection_releases_the_nonce(web3, monkeypatch):
+    failing_send(web3, monkeypatch, ValueError({'code': -32000, 'message': "insufficient funds"}), broadcast=False)
+    nonce = web3.eth.get_transaction_count(SENDER)
+
+    with pytest.raises(ValueError):
+        blockchain.send_transaction(web3, PRIVATE_KEY, transfer(web3))
+
+    assert nonce_manager.allocate(web3, SENDER) == nonce
+
+def test_already_known_counts_as_sent(web3, monkeypatch):
+    failing_send(web3, monkeypatch, ValueError({'code': -32000, 'message': "already known"}), broadcast=True)
+
+    tx_hash = blockchain.send_transaction(web3, PRIVATE_KEY, transfer(web3))
+
+    assert web3.eth.get_transaction(tx_hash)
+
+def test_chain_id_comes_from_the_node_and_must_match_chain_id(web3, monkeypatch):
+    monkeypatch.setenv("CHAIN_ID", str(web3.eth.chain_id + 1))
+    with pytest.raises(blockchain.ChainIdMismatchError):
+        blockchain.get_chain_id(web3)
+
+    monkeypatch.setenv("CHAIN_ID", str(web3.eth.chain_id))
+    assert blockchain.get_chain_id(web3) == web3.eth.chain_id